@@ -0,0 +1,146 @@
+"""
+Compare the throughput of BM25Scorer scoring one row at a time against
+batch scoring, for both raw documents and indexed documents, on the msmarco
+sample data, and full-corpus top-k retrieval against exhaustive scoring,
+startup from a saved index against training, and analysis of texts with and
+without a cache. Retrieval is also measured on a
+synthetic corpus of NUM_SYNTHETIC_DOCS documents with Zipfian term
+frequencies, where multi-term queries have long postings.
+"""
+from mini_rec_sys.sample_data import get_msmarco_sample_data
+from mini_rec_sys.scorers import BM25Scorer
+from mini_rec_sys.analyzers import Analyzer
+import numpy as np
+import os
+import tempfile
+import time
+
+NUM_SYNTHETIC_DOCS = int(os.environ.get("NUM_SYNTHETIC_DOCS", 1000000))
+
+items, sessions = get_msmarco_sample_data()
+documents = {k: {"text": v} for k, v in items.items()}
+scorer = BM25Scorer("query", "docs", documents, fields=["text"])
+
+rows, indexed_rows = [], []
+for session in sessions.values():
+    ids = session["positive_items"] + session["negative_items"]
+    rows.append({"query": session["query"], "docs": [documents[i] for i in ids]})
+    indexed_rows.append(
+        {
+            "query": session["query"],
+            "docs": [{"item_id": i, **documents[i]} for i in ids],
+        }
+    )
+# Repeat the sessions to simulate a larger evaluation
+rows, indexed_rows = rows * 100, indexed_rows * 100
+num_pairs = sum(len(row["docs"]) for row in rows)
+
+# Time both paths on the same inputs: raw documents, which are tokenized on
+# the fly, and documents with the ids of indexed documents
+for name, inputs in [("raw", rows), ("indexed", indexed_rows)]:
+    start = time.time()
+    expected = [scorer.score_single(row) for row in inputs]
+    single_elapsed = time.time() - start
+    print(f"score_single, {name}: {num_pairs / single_elapsed:,.0f} pairs/sec")
+
+    start = time.time()
+    scores = scorer.score(inputs)
+    batch_elapsed = time.time() - start
+    print(f"score_batch, {name}: {num_pairs / batch_elapsed:,.0f} pairs/sec")
+    print(f"Speedup, {name}: {single_elapsed / batch_elapsed:.1f}x")
+    assert all(np.allclose(a, b) for a, b in zip(scores, expected))
+
+# Full-corpus top-k retrieval against exhaustive scoring of every document
+queries = [session["query"] for session in sessions.values()]
+all_docs = list(documents)
+start = time.time()
+expected = [
+    sorted(scorer.score({"query": q, "docs": all_docs}), reverse=True)[:10]
+    for q in queries
+]
+exhaustive_elapsed = time.time() - start
+print(f"Exhaustive top-10: {1000 * exhaustive_elapsed / len(queries):.2f} ms/query")
+
+scorer.retrieve(queries[0])  # Build the impact index
+start = time.time()
+retrieved = [scorer.retrieve(q, k=10, return_scores=True)[1] for q in queries]
+retrieve_elapsed = time.time() - start
+print(f"retrieve top-10: {1000 * retrieve_elapsed / len(queries):.2f} ms/query")
+assert all(np.allclose(a, b[: len(a)]) for a, b in zip(retrieved, expected))
+
+# Startup from a saved, memory-mapped index against training from scratch
+with tempfile.TemporaryDirectory() as directory:
+    start = time.time()
+    BM25Scorer("query", "docs", documents, fields=["text"])
+    print(f"Train: {time.time() - start:.3f}s")
+    scorer.save(directory)
+    start = time.time()
+    loaded = BM25Scorer.load(directory)
+    print(f"Load: {time.time() - start:.3f}s")
+    assert loaded.retrieve(queries[0]) == scorer.retrieve(queries[0])
+
+# Repeated analysis of the catalog texts, e.g. across evaluations, with and
+# without an analyzer cache
+texts = [doc["text"] for doc in documents.values()]
+for name, analyzer in [
+    ("uncached", Analyzer()),
+    ("cached", Analyzer(cache_size=len(texts))),
+]:
+    analyzer.analyze_batch(texts)  # Warm up the cache
+    start = time.time()
+    for _ in range(10):
+        analyzer.analyze_batch(texts)
+    elapsed = time.time() - start
+    print(f"Analyze texts, {name}: {10 * len(texts) / elapsed:,.0f} texts/sec")
+
+# Full-corpus retrieval on a large synthetic corpus, where words are drawn
+# from a Zipfian distribution over a vocabulary of letter strings
+rng = np.random.default_rng(0)
+
+
+def to_word(i: int):
+    word = ""
+    while True:
+        i, r = divmod(i, 26)
+        word += chr(ord("a") + r)
+        if i == 0:
+            return word
+        i -= 1
+
+
+vocab = np.array([to_word(i) for i in range(50000)])
+p = 1.0 / np.arange(1, len(vocab) + 1)
+p /= p.sum()
+lengths = rng.integers(5, 30, NUM_SYNTHETIC_DOCS)
+words = vocab[rng.choice(len(vocab), lengths.sum(), p=p)]
+synthetic_documents = (
+    (i, {"text": " ".join(doc_words)})
+    for i, doc_words in enumerate(np.split(words, np.cumsum(lengths)[:-1]))
+)
+start = time.time()
+scorer = BM25Scorer(
+    "query", "docs", synthetic_documents, fields=["text"], num_train_processes=8
+)
+scorer.build_term_matrices()
+scorer.build_impact_index()
+print(f"Train and index {NUM_SYNTHETIC_DOCS:,} documents: {time.time() - start:.1f}s")
+
+queries = [
+    " ".join(vocab[rng.choice(len(vocab), rng.integers(2, 6), p=p)]) for _ in range(100)
+]
+index = scorer.impact_index
+all_rows = np.arange(len(scorer.doc_index))
+start = time.time()
+expected = []
+for q in queries[:10]:
+    terms = scorer.find_terms(list(scorer.tokenize(q)))
+    scores = index.score_docs(terms[terms >= 0], all_rows)
+    expected.append(np.sort(scores[scores > 0])[::-1][:10])
+exhaustive_elapsed = (time.time() - start) / 10
+print(f"Exhaustive top-10: {1000 * exhaustive_elapsed:.2f} ms/query")
+
+start = time.time()
+retrieved = [scorer.retrieve(q, k=10, return_scores=True)[1] for q in queries]
+retrieve_elapsed = (time.time() - start) / len(queries)
+print(f"retrieve top-10: {1000 * retrieve_elapsed:.2f} ms/query")
+assert all(np.allclose(a, b) for a, b in zip(retrieved, expected))
@@ -0,0 +1,45 @@
+"""
+Compare the disk size and read throughput of an ItemDataset with and without
+value compression, on the msmarco sample data.
+"""
+from mini_rec_sys.sample_data import get_msmarco_sample_data
+from mini_rec_sys.data import ItemDataset
+from pathlib import Path
+import tempfile
+import time
+
+items, _ = get_msmarco_sample_data()
+ids = list(items)
+
+
+def directory_size(directory: str):
+    return sum(f.stat().st_size for f in Path(directory).rglob("*") if f.is_file())
+
+
+settings = [
+    ("none", None, 0),
+    ("zlib", "zlib", 0),
+    ("zstd", "zstd", 0),
+    ("zstd + dict", "zstd", 64 * 1024),
+]
+for name, compression, dict_size in settings:
+    location = tempfile.mkdtemp()
+    item_dataset = ItemDataset(
+        db_location=location,
+        id_name="item_id",
+        data=items,
+        load_fn=lambda x: {"text": x},
+        compression=compression,
+        compression_dict_size=dict_size,
+    )
+    size = directory_size(location)
+
+    start = time.time()
+    for _ in range(5):
+        for id in ids:
+            item_dataset.load(id)
+    elapsed = time.time() - start
+    print(
+        f"{name}: {size / 1e6:.1f} MB on disk, "
+        f"{5 * len(ids) / elapsed:,.0f} loads/sec"
+    )
@@ -27,7 +27,7 @@ collection = SessionDataset(
 bm25_scorer = BM25Scorer(
     query_key="query",
     test_documents_key="item_attributes",
-    train_documents={qid: v for qid, v in iter(item_dataset)},
+    train_documents=item_dataset,
     fields=["text"],
 )
 
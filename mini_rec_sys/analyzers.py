@@ -0,0 +1,144 @@
+"""
+Text analysis for lexical models such as BM25Scorer, which turns texts into
+terms and their counts. Patterns are compiled once per Analyzer, and the
+term counts of recently analyzed texts may be cached, so that texts seen
+again (e.g. the same catalog across evaluations) are not re-analyzed.
+"""
+from __future__ import annotations
+from collections import Counter, OrderedDict
+import re
+
+STOP_WORDS = [
+    "i",
+    "am",
+    "stop",
+    "the",
+    "to",
+    "and",
+    "a",
+    "in",
+    "it",
+    "is",
+    "I",
+    "that",
+    "had",
+    "on",
+    "for",
+    "were",
+    "was",
+]
+
+# Characters replaced with spaces
+SEPARATORS = ["/", "\n", "-"]
+
+# Separates texts that are analyzed together in analyze_batch. It is
+# whitespace, so it is kept by the patterns below and never part of a term.
+TEXT_SEPARATOR = "\r"
+
+
+class Analyzer:
+    """
+    Analyzes a text by:
+    1. Applying preprocess_fn, if any (e.g. mini_rec_sys.utils.clean)
+    2. Removing all html tags <xxx>
+    3. Replacing "/", "-" and newlines with spaces
+    4. Removing all characters other than alphabets and whitespace
+    5. Lowercasing, splitting on whitespace and removing stop words
+
+    If cache_size > 0, the term counts of up to cache_size of the most
+    recently analyzed texts are cached. Note that cached term counts are
+    shared between callers, so they should not be modified in place.
+    """
+
+    def __init__(
+        self,
+        stop_words: list[str] = None,
+        preprocess_fn: callable = None,
+        cache_size: int = 0,
+    ) -> None:
+        self.stop_words = set(STOP_WORDS if stop_words is None else stop_words)
+        self.preprocess_fn = preprocess_fn
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # text -> term counts, in lru order
+        self.hits = 0
+        self.misses = 0
+
+        # Html tags do not span texts analyzed together
+        self.html_tags = re.compile(f"<[^<{TEXT_SEPARATOR}]+?>")
+        self.non_alphabets = re.compile(r"[^a-zA-Z\s]")
+
+    def get_config(self):
+        """Return the parameters to re-create this analyzer, except functions."""
+        return {"stop_words": sorted(self.stop_words), "cache_size": self.cache_size}
+
+    def clean(self, text: str):
+        """Return text with steps 1 to 4 applied, and lowercased."""
+        if self.preprocess_fn is not None:
+            text = self.preprocess_fn(text)
+        return self.normalize(text.replace(TEXT_SEPARATOR, " "))
+
+    def normalize(self, text: str):
+        """Return text with steps 2 to 4 applied, and lowercased."""
+        if "<" in text:
+            text = self.html_tags.sub("", text)
+        # Faster than a regex or str.translate for a few characters
+        for separator in SEPARATORS:
+            text = text.replace(separator, " ")
+        text = self.non_alphabets.sub("", text)
+        return text.lower()
+
+    def words(self, text: str):
+        """Return the list of terms in text, in order."""
+        if (text is None) or (text == ""):
+            return []
+        return self.split(self.clean(text))
+
+    def split(self, text: str):
+        return [w for w in text.split() if not w in self.stop_words]
+
+    def term_counts(self, text: str):
+        """Return a dict of term to its count in text."""
+        return self.analyze_batch([text])[0]
+
+    def analyze_batch(self, texts: list[str]):
+        """
+        Return the term counts of each text. Texts that are not cached are
+        cleaned together as a single string, to avoid the overhead of
+        applying each pattern to each text separately.
+        """
+        results = [None] * len(texts)
+        missing = {}  # text -> positions in texts
+        for i, text in enumerate(texts):
+            if (text is None) or (text == ""):
+                results[i] = Counter()
+            elif text in self.cache:
+                self.hits += 1
+                self.cache.move_to_end(text)
+                results[i] = self.cache[text]
+            else:
+                missing.setdefault(text, []).append(i)
+        if len(missing) == 0:
+            return results
+
+        self.misses += len(missing)
+        texts_to_clean = list(missing)
+        if self.preprocess_fn is not None:
+            texts_to_clean = [self.preprocess_fn(text) for text in texts_to_clean]
+        joined = TEXT_SEPARATOR.join(
+            text.replace(TEXT_SEPARATOR, " ") for text in texts_to_clean
+        )
+        cleaned = self.normalize(joined).split(TEXT_SEPARATOR)
+        for text, cleaned_text in zip(missing, cleaned):
+            counts = Counter(self.split(cleaned_text))
+            for i in missing[text]:
+                results[i] = counts
+            if self.cache_size > 0:
+                self.cache[text] = counts
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return results
+
+    def clear_cache(self):
+        self.cache.clear()
+        self.hits = 0
+        self.misses = 0
@@ -1,4 +1,10 @@
 from __future__ import annotations
-from .session import Session
+from .session import Session, CompactSession
 from .datasets import UserDataset, ItemDataset, SessionDataset
-from .samplers import Sampler, BatchedSequentialSampler, BatchedWeightedSampler
+from .samplers import (
+    Sampler,
+    BatchedSequentialSampler,
+    BatchedWeightedSampler,
+    BatchedLengthSampler,
+    get_passage_lengths,
+)
@@ -0,0 +1,153 @@
+"""
+Per-value compression of the objects stored in a Dataset. Each object is
+pickled and then compressed, so that large text attributes take up less disk
+space at the cost of some CPU time when loading.
+"""
+from __future__ import annotations
+import pickle
+import json
+import zlib
+import os
+
+COMPRESSION_TYPES = ["zlib", "zstd", "lz4"]
+
+
+class ValueCodec:
+    """
+    Encodes objects into compressed bytes and back, using one of:
+        "zlib": from the standard library, always available.
+        "zstd": requires `pip install zstandard`. Supports a dictionary
+            trained on sample values, which greatly improves the compression
+            of short values such as titles or short texts.
+        "lz4": requires `pip install lz4`. Fastest to decompress, but with
+            the lowest compression ratio.
+    """
+
+    CONFIG_FILE = "compression.json"
+    DICT_FILE = "compression.dict"
+
+    def __init__(
+        self, method: str = "zstd", level: int = None, dictionary: bytes = None
+    ) -> None:
+        """
+        method: the compression algorithm, one of COMPRESSION_TYPES
+        level: the compression level, uses the default of method if None
+        dictionary: a zstd dictionary, see ValueCodec.train
+        """
+        assert (
+            method in COMPRESSION_TYPES
+        ), f"compression must be one of {COMPRESSION_TYPES}."
+        assert (
+            dictionary is None or method == "zstd"
+        ), "A compression dictionary is only supported for zstd."
+        self.method = method
+        self.level = level
+        self.dictionary = dictionary
+        self.reset_stats()
+        self.init_compressor()
+
+    @classmethod
+    def train(
+        cls, values: list, dict_size: int, method: str = "zstd", level: int = None
+    ):
+        """
+        Return a ValueCodec with a zstd dictionary of up to dict_size bytes
+        trained on the sample values. If training fails, e.g. because there
+        are too few samples, the codec does not use a dictionary.
+        """
+        zstandard = import_zstandard()
+        assert method == "zstd", "A compression dictionary is only supported for zstd."
+        samples = [pickle.dumps(v, protocol=pickle.HIGHEST_PROTOCOL) for v in values]
+        try:
+            dictionary = zstandard.train_dictionary(dict_size, samples).as_bytes()
+        except zstandard.ZstdError as e:
+            print(f"Skipping compression dictionary: {e}")
+            dictionary = None
+        return cls(method, level, dictionary)
+
+    def init_compressor(self):
+        if self.method == "zlib":
+            level = -1 if self.level is None else self.level
+            self.compress = lambda data: zlib.compress(data, level)
+            self.decompress = zlib.decompress
+        elif self.method == "zstd":
+            zstandard = import_zstandard()
+            dict_data = None
+            if self.dictionary is not None:
+                dict_data = zstandard.ZstdCompressionDict(self.dictionary)
+            compressor = zstandard.ZstdCompressor(
+                level=3 if self.level is None else self.level, dict_data=dict_data
+            )
+            decompressor = zstandard.ZstdDecompressor(dict_data=dict_data)
+            self.compress = compressor.compress
+            self.decompress = decompressor.decompress
+        else:
+            try:
+                import lz4.frame
+            except ImportError:
+                raise ImportError("lz4 compression requires `pip install lz4`.")
+            level = 0 if self.level is None else self.level
+            self.compress = lambda data: lz4.frame.compress(
+                data, compression_level=level
+            )
+            self.decompress = lz4.frame.decompress
+
+    def encode(self, object: object):
+        data = pickle.dumps(object, protocol=pickle.HIGHEST_PROTOCOL)
+        compressed = self.compress(data)
+        self.raw_bytes += len(data)
+        self.compressed_bytes += len(compressed)
+        return compressed
+
+    def decode(self, data: bytes):
+        return pickle.loads(self.decompress(data))
+
+    def reset_stats(self):
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+
+    @property
+    def compression_ratio(self):
+        """Ratio of pickled to compressed bytes of values encoded so far."""
+        return self.raw_bytes / max(self.compressed_bytes, 1)
+
+    def save(self, directory: str):
+        with open(os.path.join(directory, self.CONFIG_FILE), "w") as f:
+            json.dump({"method": self.method, "level": self.level}, f)
+        if self.dictionary is not None:
+            with open(os.path.join(directory, self.DICT_FILE), "wb") as f:
+                f.write(self.dictionary)
+
+    @classmethod
+    def load(cls, directory: str):
+        """Load the codec saved in directory, or return None if there is none."""
+        config_path = os.path.join(directory, cls.CONFIG_FILE)
+        if not os.path.exists(config_path):
+            return None
+        with open(config_path) as f:
+            config = json.load(f)
+        dictionary = None
+        dict_path = os.path.join(directory, cls.DICT_FILE)
+        if os.path.exists(dict_path):
+            with open(dict_path, "rb") as f:
+                dictionary = f.read()
+        return cls(config["method"], config["level"], dictionary)
+
+    def __getstate__(self):
+        # Compressor objects cannot be pickled, they are recreated on unpickling
+        state = self.__dict__.copy()
+        del state["compress"]
+        del state["decompress"]
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self.init_compressor()
+
+
+def import_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("zstd compression requires `pip install zstandard`.")
+    return zstandard
@@ -1,22 +1,47 @@
 from __future__ import annotations
-from diskcache import Cache
 from pathlib import Path
 from tqdm import tqdm
-import pandas as pd
+import fastparquet
 import json
-from shutil import copytree
+import gzip
+from shutil import copytree, rmtree
+from collections import deque
+import numpy as np
+import copy
+import os
+import multiprocessing as mp
 from typing import Union
+import time
 import torch
 
-from mini_rec_sys.data.session import Session
+from mini_rec_sys.data.session import Session, CompactSession
+from mini_rec_sys.data.storage import (
+    open_storage,
+    open_base_storage,
+    ColumnarStorage,
+    LayeredStorage,
+)
+from mini_rec_sys.data.memory_cache import MemoryCache
+from mini_rec_sys.data.key_index import KeyIndex
+from mini_rec_sys.data.compression import ValueCodec
+from mini_rec_sys.data.side_columns import SideColumns
+from mini_rec_sys.utils import chunker
 from mini_rec_sys.constants import (
     ITEM_ATTRIBUTES_NAME,
     USER_ATTRIBUTES_NAME,
     SESSION_NAME,
+    SESSION_WEIGHT_NAME,
 )
 from pdb import set_trace
 
-MAX_DISK_SIZE = int(1e10)
+JSON_SUFFIXES = [
+    "json",
+    "jsonl",
+    "json.gz",
+    "jsonl.gz",
+    "json.zst",
+    "jsonl.zst",
+]
 
 
 class Dataset(torch.utils.data.Dataset):
@@ -24,8 +49,14 @@ class Dataset(torch.utils.data.Dataset):
     A class used to load attributes associated with each user or item.
     At initialization, the attributes are stored in a simple database and retrieved
     during training or evaluation time.
+
+    Subclasses may define side_column_fns, a dict of name to a function that
+    returns a scalar (e.g. a weight) for each stored object. These values are
+    collected at ingestion into SideColumns, see load_side_column.
     """
 
+    side_column_fns: dict[str, callable] = {}
+
     def __init__(
         self,
         db_location: str = None,
@@ -35,6 +66,15 @@ class Dataset(torch.utils.data.Dataset):
         data: dict | str = None,
         subset_ids: list[Union[int, str]] = None,
         write_to_temp: bool = False,
+        write_batch_size: int = 10000,
+        storage: str = "diskcache",
+        columns: list[str] = None,
+        cache_bytes: int = None,
+        cache_policy: str = "lru",
+        num_ingest_workers: int = 1,
+        compression: str = None,
+        compression_level: int = None,
+        compression_dict_size: int = 0,
     ) -> None:
         """Initialize the Loader.
 
@@ -51,6 +91,10 @@ class Dataset(torch.utils.data.Dataset):
             loading later on
         data: how to access the data
             if str, assumes that it is a file location containing .parquet or .json files.
+                .json files contain a dict of id to attributes, while .jsonl
+                files contain one row per line, with the id under id_name.
+                .json / .jsonl files may be compressed with gzip (.gz) or
+                zstandard (.zst).
             if dict, assumes that the key is the id and values are the attributes.
         subset_ids: Whether to limit this dataset to only a subset of keys as
             specified in the list of subset_ids.
@@ -58,6 +102,35 @@ class Dataset(torch.utils.data.Dataset):
             the cache over to the specified db_location. This is useful for e.g.
             when trying to write to dbfs on databricks, since random writes
             to dbfs is not allowed.
+        write_batch_size: number of rows to write to the db in each transaction
+            when populating the db. Larger batches are much faster for bulk
+            loads, as each transaction incurs a commit to disk.
+        storage: the storage backend for the db, one of:
+            "diskcache": a sqlite backed key-value store (default).
+            "columnar": an immutable set of memory-mapped column files, which
+                is faster to read and shares memory across DataLoader workers,
+                but cannot be modified after the db is populated.
+        columns: if data is a location of .parquet files, only read these
+            columns from the files. The id_name column is always read.
+        cache_bytes: if provided, keep up to cache_bytes of loaded objects in
+            an in-process cache, so that hot ids are not fetched from the db
+            each time they are loaded.
+        cache_policy: eviction policy of the in-process cache, "lru" or "lfu".
+        num_ingest_workers: number of processes used to apply store_fn when
+            populating the db. Useful when store_fn is expensive, e.g. when
+            it constructs and validates Session objects.
+        compression: if provided, compress each stored object with this
+            algorithm, one of "zlib", "zstd" or "lz4" (see ValueCodec). This
+            reduces the size of the db when objects contain long texts, at
+            the cost of decompressing each object when it is loaded. The
+            compression used is saved with the db, so a db loaded from
+            db_location is decompressed automatically, and loading it with
+            a different compression raises a ValueError.
+        compression_level: the compression level, uses the default of the
+            algorithm if None.
+        compression_dict_size: if > 0, train a zstd dictionary of this many
+            bytes on the first batch of objects written, which improves the
+            compression of short objects.
         """
         assert not (
             data is None and db_location is None
@@ -65,29 +138,113 @@ class Dataset(torch.utils.data.Dataset):
         self.db_location = db_location
         self.id_name = id_name
         self.write_to_temp = write_to_temp
+        self.write_batch_size = write_batch_size
+        self.storage = storage
+        self.columns = columns
+        self.num_ingest_workers = num_ingest_workers
+        self.compression = compression
+        self.compression_level = compression_level
+        self.compression_dict_size = compression_dict_size
+        self.codec = None
+        assert (
+            compression is None or storage == "diskcache"
+        ), "compression is only supported for diskcache storage."
+        self.memory_cache = (
+            None if cache_bytes is None else MemoryCache(cache_bytes, cache_policy)
+        )
 
         if load_fn is None:
-            load_fn = lambda x: x
+            load_fn = identity
         self.load_fn = load_fn
 
         if store_fn is None:
-            store_fn = lambda id, row: row
+            store_fn = return_row
         self.store_fn = store_fn
 
         if subset_ids is not None:
             self.subset_ids = set(subset_ids)
         else:
             self.subset_ids = subset_ids
+        self.subset_index = None  # Set on children created by split_dataset
+        self.key_index = None
+        self.key_index_version = None  # The db version of key_index
+        self.side_columns = None
+        self.side_values = None  # Side column values collected by write_rows
 
         if data is not None:
             print(f"Populating database..")
             self.cache = self.populate_db(data)
+            try:
+                # The db may have been populated before with other ids
+                index = self.load_key_index(rebuild=True)
+                if self.side_column_fns:
+                    self.side_columns = SideColumns.from_values(
+                        index, *self.side_values
+                    )
+                    self.side_columns.save(self.index_directory)
+            except ValueError as e:
+                print(f"Skipping key index: {e}")
+            self.side_values = None
         else:
-            self.cache = Cache(db_location, size_limit=MAX_DISK_SIZE, cull_limit=0)
+            self.cache = open_storage(self.storage, db_location)
+            base = (
+                self.cache.base
+                if isinstance(self.cache, LayeredStorage)
+                else self.cache
+            )
+            if isinstance(base, ColumnarStorage):
+                # Columnar dbs are detected, even if storage was not given
+                self.storage = "columnar"
+            self.codec = ValueCodec.load(self.cache.directory)
+            saved_compression = None if self.codec is None else self.codec.method
+            if compression is not None and compression != saved_compression:
+                # Changes would be written with a codec that readers do not use
+                raise ValueError(
+                    f"The db at {db_location} was saved with compression "
+                    f"{saved_compression}, got compression={compression}."
+                )
+            self.compression = saved_compression
             print(
                 f"Loading / initializing database with {len(self):,} entries at {db_location}.."
             )
 
+    @property
+    def cache(self):
+        """
+        The storage of the db. Storage handles (e.g. sqlite connections) must
+        not be shared across processes, so if we are in a different process
+        from the one that opened the storage (e.g. a forked DataLoader
+        worker), the storage is lazily reopened in this process.
+        """
+        if self.storage_pid != os.getpid():
+            self.reopen()
+        return self.storage_handle
+
+    @cache.setter
+    def cache(self, storage):
+        self.storage_handle = storage
+        self.storage_pid = os.getpid()
+
+    def reopen(self):
+        """Open a new handle to the storage of the db in this process."""
+        version = getattr(self.storage_handle, "version", 0)
+        self.cache = open_storage(self.storage, self.db_location)
+        if self.version != version:
+            # Ids and objects may have changed in the latest version, so reload
+            # the index and drop objects cached from the old version
+            self.key_index = None
+            self.side_columns = None
+            if self.memory_cache is not None:
+                self.memory_cache.clear()
+
+    def __getstate__(self):
+        # Storage handles cannot be pickled, they are reopened after unpickling
+        state = self.__dict__.copy()
+        state["storage_handle"] = None
+        state["storage_pid"] = None
+        state.pop("keys", None)
+        return state
+
     def get_files_from_path(self, path: str, suffix="parquet"):
         """Get a list of .suffix files in path."""
         if path.endswith(suffix):
@@ -96,11 +253,51 @@ class Dataset(torch.utils.data.Dataset):
         return list(files)
 
     def populate_db(self, data: str | dict):
+        """
+        Write the rows from data into the db, returning the populated storage.
+        """
         # TODO: clean up temporary cache files.
+        generator = self.row_generator(data)
+        if self.db_location is not None:
+            assert not LayeredStorage.has_manifest(self.db_location), (
+                f"{self.db_location} has incremental changes applied, use "
+                "apply_changes to update it instead."
+            )
+        if self.db_location is None:
+            print("Initializing cache in temp location..")
+            cache = open_storage(self.storage)
+            self.db_location = cache.directory
+        elif self.write_to_temp:
+            print("Writing to temp location..")
+            cache = open_storage(self.storage)
+        else:
+            cache = open_storage(self.storage, self.db_location)
+
+        self.write_rows(cache, generator)
+        if self.codec is not None:
+            self.codec.save(cache.directory)
+        if isinstance(cache, ColumnarStorage):
+            cache.finalize()
+
+        if self.db_location and self.write_to_temp:
+            print(
+                f"Copying from temp location {cache.directory} to {self.db_location}.."
+            )
+            directory = cache.directory
+            copytree(directory, self.db_location)
+            cache = open_storage(self.storage, self.db_location)
+        return cache
+
+    def row_generator(self, data: str | dict):
+        """Return a generator of (id, row) over the raw data, see __init__."""
         if isinstance(data, str):
             parquet_files = self.get_files_from_path(data, "parquet")
             num_parquet_files = len(parquet_files)
-            json_files = self.get_files_from_path(data, "json")
+            json_files = [
+                f
+                for suffix in JSON_SUFFIXES
+                for f in self.get_files_from_path(data, suffix)
+            ]
             num_json_files = len(json_files)
             assert not (
                 num_parquet_files > 0 and num_json_files > 0
@@ -118,18 +315,102 @@ class Dataset(torch.utils.data.Dataset):
 
         else:
             raise ValueError(f"{data} is neither str nor dict.")
+        return generator
 
-        if self.db_location is None:
-            print("Initializing cache in temp location..")
-            cache = Cache(size_limit=MAX_DISK_SIZE, cull_limit=0)
-            self.db_location = cache.directory
-        elif self.write_to_temp:
-            print("Writing to temp location..")
-            cache = Cache(size_limit=MAX_DISK_SIZE, cull_limit=0)
+    def write_rows(self, cache, generator):
+        """
+        Apply store_fn to each (id, row) from generator and write the results
+        into cache, self.write_batch_size rows per transaction.
+
+        Each batch is committed atomically, so a crash during ingestion loses
+        at most the batch in flight and never leaves a partially written
+        batch in the db.
+
+        If self.num_ingest_workers > 1, store_fn is applied to batches in a
+        pool of forked worker processes, while this process remains the single
+        writer to the db. At most 2 batches per worker are in flight at any
+        time to keep memory bounded.
+
+        If compression is enabled, each result is compressed before writing.
+        The side column values of each result are collected in
+        self.side_values.
+        """
+        start = time.time()
+        num_rows = 0
+        batches = chunker(tqdm(generator), self.write_batch_size)
+        if self.codec is not None:
+            self.codec.reset_stats()
+        self.side_values = ([], {name: [] for name in self.side_column_fns})
+
+        def write(results: list[tuple]):
+            nonlocal num_rows
+            if self.compression is not None and self.codec is None:
+                self.codec = self.init_codec([res for _, res in results])
+            self.collect_side_values(results)
+            with cache.transact():
+                for id, res in results:
+                    cache[id] = res if self.codec is None else self.codec.encode(res)
+            num_rows += len(results)
+
+        if self.num_ingest_workers > 1:
+            assert (
+                "fork" in mp.get_all_start_methods()
+            ), "num_ingest_workers > 1 requires the fork start method."
+            with mp.get_context("fork").Pool(
+                self.num_ingest_workers,
+                initializer=init_ingest_worker,
+                initargs=(self,),
+            ) as pool:
+                in_flight = deque()
+                for batch in batches:
+                    in_flight.append(pool.apply_async(store_batch_in_worker, (batch,)))
+                    if len(in_flight) >= 2 * self.num_ingest_workers:
+                        write(in_flight.popleft().get())
+                while in_flight:
+                    write(in_flight.popleft().get())
         else:
-            cache = Cache(self.db_location, size_limit=MAX_DISK_SIZE, cull_limit=0)
+            for batch in batches:
+                write(self.store_batch(batch))
+
+        elapsed = time.time() - start
+        print(
+            f"Stored {num_rows:,} rows in {elapsed:.1f}s "
+            f"({num_rows / max(elapsed, 1e-6):,.0f} rows/sec)."
+        )
+        if self.codec is not None and self.codec.raw_bytes > 0:
+            print(
+                f"Compressed {self.codec.raw_bytes:,} bytes to "
+                f"{self.codec.compressed_bytes:,} bytes "
+                f"(ratio {self.codec.compression_ratio:.2f}x)."
+            )
+        return num_rows
 
-        for id, row in tqdm(generator):
+    def collect_side_values(self, results: list[tuple]):
+        if not self.side_column_fns:
+            return
+        ids, values = self.side_values
+        ids.extend(id for id, _ in results)
+        for name, fn in self.side_column_fns.items():
+            values[name].extend(fn(res) for _, res in results)
+
+    def init_codec(self, samples: list):
+        """Initialize the codec for compression, training it on samples if needed."""
+        if self.compression_dict_size > 0:
+            return ValueCodec.train(
+                samples,
+                self.compression_dict_size,
+                self.compression,
+                self.compression_level,
+            )
+        return ValueCodec(self.compression, self.compression_level)
+
+    def store_batch(self, batch: list[tuple]):
+        """
+        Apply store_fn to a batch of (id, row), returning the (id, result)
+        tuples to be stored.
+        """
+        results = []
+        for id, row in batch:
             try:
                 res = self.store_fn(id, row)
             except Exception as e:
@@ -137,35 +418,50 @@ class Dataset(torch.utils.data.Dataset):
                     f"Failed to store id: {id} with data: {self.summarize_row(row)}."
                 )
             if res:
-                cache[id] = res
-
-        if self.db_location and self.write_to_temp:
-            print(
-                f"Copying from temp location {cache.directory} to {self.db_location}.."
-            )
-            directory = cache.directory
-            copytree(directory, self.db_location)
-            cache = Cache(self.db_location, size_limit=MAX_DISK_SIZE, cull_limit=0)
-        return cache
+                results.append((id, res))
+        return results
 
     def json_row_generator(self, files):
+        """
+        Stream rows from json files without loading each file into memory.
+        """
         for path in files:
-            with open(path) as f:
-                d = json.load(f)
-            for id, values in d.items():
-                yield id, values
+            with open_text_file(path) as f:
+                if ".jsonl" in Path(path).name:
+                    for line in f:
+                        if len(line.strip()) == 0:
+                            continue
+                        row_dict = json.loads(line)
+                        try:
+                            id = row_dict[self.id_name]
+                        except Exception as e:
+                            raise ValueError(
+                                f"Failed to parse correctly, the row of data loaded was {self.summarize_row(row_dict)}."
+                            )
+                        yield id, row_dict
+                else:
+                    for id, values in iter_json_items(f):
+                        yield id, values
 
     def parquet_row_generator(self, files):
+        """
+        Stream rows from parquet files one row group at a time, so that memory
+        usage is bounded by the row group size rather than the file size.
+        """
+        columns = self.columns
+        if columns is not None and self.id_name not in columns:
+            columns = [self.id_name] + list(columns)
         for path in files:
-            df = pd.read_parquet(path)
-            for row_dict in df.to_dict(orient="records"):
-                try:
-                    id = row_dict[self.id_name]
-                except Exception as e:
-                    raise ValueError(
-                        f"Failed to parse correctly, the row of data loaded was {self.summarize_row(row_dict)}."
-                    )
-                yield id, row_dict
+            pf = fastparquet.ParquetFile(str(path))
+            for df in pf.iter_row_groups(columns=columns):
+                for row_dict in df.to_dict(orient="records"):
+                    try:
+                        id = row_dict[self.id_name]
+                    except Exception as e:
+                        raise ValueError(
+                            f"Failed to parse correctly, the row of data loaded was {self.summarize_row(row_dict)}."
+                        )
+                    yield id, row_dict
 
     def summarize_row(self, row_dict: dict):
         res = {}
@@ -177,14 +473,29 @@ class Dataset(torch.utils.data.Dataset):
             res[k] = v
         return res
 
+    def in_subset(self, id: int | str):
+        """Whether id belongs to this dataset, if it is limited to a subset."""
+        if self.subset_index is not None:
+            return id in self.subset_index
+        if self.subset_ids is not None:
+            return id in self.subset_ids
+        return True
+
     def load_object(self, id: int | str):
         """
         Load the raw object for id.
         """
-        if self.subset_ids:
-            if id not in self.subset_ids:
-                return None
-        return self.cache.get(id, None)
+        id = to_builtin(id)
+        if not self.in_subset(id):
+            return None
+        if self.memory_cache is None:
+            return self.fetch_object(id)
+        object = self.memory_cache.get(id)
+        if object is None:
+            object = self.fetch_object(id)
+            if object is not None:
+                self.memory_cache.put(id, object)
+        return object
 
     def load(self, id: int | str):
         """
@@ -195,8 +506,65 @@ class Dataset(torch.utils.data.Dataset):
             return None
         return self.load_fn(object)
 
+    def load_objects(self, ids: list[int | str]):
+        """
+        Load the raw objects for a list of ids with a single storage call.
+        """
+        ids = [to_builtin(id) for id in ids]
+        if self.subset_index is not None:
+            positions = self.subset_index.find(ids)
+            ids = [id if pos >= 0 else None for id, pos in zip(ids, positions)]
+        elif self.subset_ids is not None:
+            ids = [id if id in self.subset_ids else None for id in ids]
+        if self.memory_cache is None:
+            return self.fetch_objects(ids)
+
+        objects = [None if id is None else self.memory_cache.get(id) for id in ids]
+        missing = [
+            i for i, id in enumerate(ids) if id is not None and objects[i] is None
+        ]
+        fetched = self.fetch_objects([ids[i] for i in missing])
+        for i, object in zip(missing, fetched):
+            objects[i] = object
+            if object is not None:
+                self.memory_cache.put(ids[i], object)
+        return objects
+
+    def fetch_object(self, id: int | str):
+        """Fetch the object for id from storage, decompressing it if needed."""
+        object = self.cache.get(id, None)
+        if object is None or self.codec is None:
+            return object
+        return self.codec.decode(object)
+
+    def fetch_objects(self, ids: list[int | str]):
+        """Fetch objects from storage, skipping ids that are None."""
+        objects = self.cache.get_many([id for id in ids if id is not None])
+        if self.codec is not None:
+            objects = [None if o is None else self.codec.decode(o) for o in objects]
+        objects = iter(objects)
+        return [None if id is None else next(objects) for id in ids]
+
+    def cache_stats(self):
+        """Return the hit / miss / eviction counts of the in-process cache."""
+        if self.memory_cache is None:
+            return None
+        return self.memory_cache.stats()
+
+    def load_many(self, ids: list[int | str]):
+        """
+        Load the objects for a list of ids, using load_fn to process each of
+        them before returning. Missing ids are returned as None.
+        """
+        return [
+            None if object is None else self.load_fn(object)
+            for object in self.load_objects(ids)
+        ]
+
     def __len__(self):
-        if self.subset_ids:
+        if self.subset_index is not None:
+            return len(self.subset_index)
+        if self.subset_ids is not None:
             return len(self.subset_ids)
         return len(self.cache)
 
@@ -204,7 +572,13 @@ class Dataset(torch.utils.data.Dataset):
         return self.load(id)
 
     def __iter__(self):
-        self.keys = self.iterkeys()
+        # When iterated within a DataLoader worker, only iterate over the
+        # shard of keys belonging to this worker
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is None:
+            self.keys = self.iterkeys()
+        else:
+            self.keys = self.iterkeys(worker_info.id, worker_info.num_workers)
         return self
 
     # For iterator style usage, we return both the key and result
@@ -213,16 +587,404 @@ class Dataset(torch.utils.data.Dataset):
         result = self.load(k)
         return k, result
 
-    def iterkeys(self):
-        if self.subset_ids:
+    def iterkeys(self, shard: int = 0, num_shards: int = 1):
+        """
+        Iterate over the keys of the dataset. If num_shards > 1, only iterate
+        over the keys in shard, which is one of num_shards disjoint and
+        contiguous ranges of the sorted key index.
+        """
+        if num_shards > 1:
+            assert 0 <= shard < num_shards, "Require 0 <= shard < num_shards."
+            index = self.get_index()
+            n = len(index)
+            start, end = shard * n // num_shards, (shard + 1) * n // num_shards
+            return index[start:end].iterkeys()
+        if self.subset_index is not None:
+            return self.subset_index.iterkeys()
+        if self.subset_ids is not None:
             return iter(self.subset_ids)
         else:
             return self.cache.iterkeys()
 
+    def as_iterable(self):
+        """
+        Return an iterable-style view of this dataset for a DataLoader, where
+        each worker loads a disjoint shard of the keys.
+        """
+        return IterableDatasetView(self)
+
     def peek(self):
         key, res = next(iter(self))
         return {key: res}
 
+    def load_key_index(self, rebuild: bool = False):
+        """
+        Return the sorted KeyIndex over all ids in the db. The index is saved
+        in the folder of the db version whenever it is built, whatever the
+        size of the db, and only rebuilt if the number of ids has changed or
+        if rebuild. Side columns saved for a rebuilt index are removed, as
+        they are no longer aligned with it.
+        """
+        if (
+            not rebuild
+            and self.key_index is not None
+            and self.key_index_version == self.version
+            and len(self.key_index) == len(self.cache)
+        ):
+            return self.key_index
+        directory = self.index_directory
+        index = None if rebuild else KeyIndex.load(directory)
+        if index is None or len(index) != len(self.cache):
+            print("Building key index..")
+            SideColumns.remove(directory)
+            self.side_columns = None
+            if isinstance(self.cache, ColumnarStorage):
+                index = KeyIndex(np.asarray(self.cache.keys))
+            else:
+                index = KeyIndex.from_keys(self.cache.iterkeys())
+            index.save(directory)
+        self.key_index = index
+        self.key_index_version = self.version
+        return index
+
+    @property
+    def index_directory(self):
+        """The folder where the key index of the current version is saved."""
+        if isinstance(self.cache, LayeredStorage):
+            return self.cache.version_directory
+        return self.cache.directory
+
+    @property
+    def version(self):
+        """The version of the db, incremented each time changes are applied."""
+        return getattr(self.cache, "version", 0)
+
+    def apply_changes(self, upserts: str | dict = None, deletes: list = None):
+        """
+        Apply incremental changes to the db and publish them as a new version.
+
+        upserts: rows to insert or replace, in any of the formats accepted by
+            data in __init__. The rows are processed with store_fn.
+        deletes: ids to delete. Deletes are applied after upserts, so an id
+            found in both is deleted.
+
+        The changes are written into a new delta layer under
+        db_location/deltas, and only become visible once the manifest of the
+        db is atomically replaced to point to the new version. Readers of the
+        db therefore never see a partially applied change, and keep reading
+        the version they opened until they are reopened. The cost is
+        proportional to the number of changes rather than the size of the db.
+        Use compact to merge the delta layers once many have accumulated.
+        """
+        assert (
+            self.subset_index is None and self.subset_ids is None
+        ), "apply_changes must be called on the full dataset, not a subset."
+        assert not (
+            upserts is None and deletes is None
+        ), "Provide upserts and/or deletes."
+        current = self.cache
+        if not isinstance(current, LayeredStorage):
+            current = LayeredStorage(self.db_location, self.storage)
+        path = os.path.join("deltas", f"v{current.version + 1}")
+        directory = os.path.join(self.db_location, path)
+        if os.path.exists(directory):
+            # Left behind by a failed attempt that was never published
+            rmtree(directory)
+
+        delta = open_base_storage("diskcache", directory)
+        # Set by write_rows if there are upserts
+        self.side_values = ([], {name: [] for name in self.side_column_fns})
+        if upserts is not None:
+            self.write_rows(delta, self.row_generator(upserts))
+        upserted = list(delta.iterkeys())
+        deleted = [] if deletes is None else [to_builtin(id) for id in deletes]
+        with open(os.path.join(directory, LayeredStorage.TOMBSTONES_FILE), "w") as f:
+            json.dump(deleted, f)
+        delta.close()
+
+        index, side_columns = None, None
+        try:
+            index = self.load_key_index()
+        except ValueError as e:
+            print(f"Skipping key index: {e}")
+        if index is not None:
+            new_index = index.update(upserted, deleted)
+            new_index.save(directory)
+            if self.side_column_fns:
+                ids, values = self.side_values
+                side_columns = self.load_side_columns().update(
+                    index, new_index, ids, values
+                )
+                side_columns.save(directory)
+            index = new_index
+        self.side_values = None
+
+        self.cache = current.publish(delta_paths=current.delta_paths + [path])
+        self.key_index = index
+        self.key_index_version = self.version
+        self.side_columns = side_columns
+        if self.memory_cache is not None:
+            for id in upserted + deleted:
+                if id in self.memory_cache:
+                    self.memory_cache.remove(id)
+        print(
+            f"Published version {self.version} with {len(upserted):,} upserts "
+            f"and {len(deleted):,} deletes."
+        )
+
+    def compact(self):
+        """
+        Merge the base and delta layers of the db into a new base snapshot
+        under db_location/snapshots, and publish it as a new version. Files of
+        previous versions are left in place for readers that still use them.
+        """
+        current = self.cache
+        assert isinstance(
+            current, LayeredStorage
+        ), "There are no changes to compact, see apply_changes."
+        path = os.path.join("snapshots", f"v{current.version + 1}")
+        directory = os.path.join(self.db_location, path)
+        if os.path.exists(directory):
+            rmtree(directory)
+        snapshot = open_base_storage(self.storage, directory)
+        num_rows = 0
+        for ids in tqdm(chunker(current.iterkeys(), self.write_batch_size)):
+            with snapshot.transact():
+                for id, value in zip(ids, current.get_many(ids)):
+                    snapshot[id] = value
+            num_rows += len(ids)
+        if isinstance(snapshot, ColumnarStorage):
+            snapshot.finalize()
+        if self.key_index is not None:
+            self.key_index.save(directory)
+        if self.side_columns is not None:
+            self.side_columns.save(directory)
+        snapshot.close()
+        self.cache = current.publish(base_path=path, delta_paths=[])
+        print(f"Compacted {num_rows:,} rows into version {self.version}.")
+
+    def load_side_columns(self):
+        """
+        Return the SideColumns aligned with the key index of the db. If they
+        were not saved at ingestion (e.g. for a db populated by an older
+        version), they are computed with one pass over the db and saved.
+        """
+        index = self.load_key_index()
+        if self.side_columns is not None and len(self.side_columns) == len(index):
+            return self.side_columns
+        names = list(self.side_column_fns)
+        side_columns = SideColumns.load(self.index_directory, names)
+        if side_columns is None or len(side_columns) != len(index):
+            print("Building side columns..")
+            values = {name: [] for name in names}
+            for ids in chunker(tqdm(index.iterkeys()), self.write_batch_size):
+                objects = self.fetch_objects(ids)
+                for name, fn in self.side_column_fns.items():
+                    values[name].extend(fn(o) for o in objects)
+            side_columns = SideColumns(
+                {name: np.asarray(v, dtype=np.float64) for name, v in values.items()}
+            )
+            side_columns.save(self.index_directory)
+        self.side_columns = side_columns
+        return side_columns
+
+    def load_side_column(self, name: str, ids: list[int | str] | np.ndarray):
+        """
+        Return the values of side column name for ids as a float64 array,
+        reading the column in one vectorized pass. Missing ids are NaN.
+        """
+        column = self.load_side_columns()[name]
+        positions = self.load_key_index().find(ids)
+        values = np.full(len(positions), np.nan)
+        is_found = positions >= 0
+        values[is_found] = column[positions[is_found]]
+        return values
+
+    def get_index(self):
+        """Return the KeyIndex over the ids of this dataset."""
+        if self.subset_index is not None:
+            return self.subset_index
+        if self.subset_ids is not None:
+            return KeyIndex.from_keys(self.subset_ids)
+        return self.load_key_index()
+
+    def subset(self, subset_ids: list = None, subset_index: KeyIndex = None):
+        """
+        Return a shallow copy of this dataset restricted to either subset_ids
+        or the ids in subset_index. The copy shares the db and in-process
+        cache of this dataset, so creating it does not touch the db.
+        """
+        child = copy.copy(self)
+        child.subset_ids = None if subset_ids is None else set(subset_ids)
+        child.subset_index = subset_index
+        return child
+
+
+class IterableDatasetView(torch.utils.data.IterableDataset):
+    """
+    Iterable-style view over a Dataset, yielding dataset[key] for each key.
+    Within DataLoader workers, each worker only iterates over its own shard
+    of the keys, so no key is read by more than one worker.
+    """
+
+    def __init__(self, dataset: Dataset) -> None:
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is None:
+            keys = self.dataset.iterkeys()
+        else:
+            keys = self.dataset.iterkeys(worker_info.id, worker_info.num_workers)
+        for k in keys:
+            yield self.dataset[k]
+
+
+def worker_init_fn(worker_id: int):
+    """
+    DataLoader worker_init_fn that opens new storage handles for the dataset
+    in each worker process, instead of using the handles inherited from the
+    parent process.
+    """
+    dataset = torch.utils.data.get_worker_info().dataset
+    if isinstance(dataset, IterableDatasetView):
+        dataset = dataset.dataset
+    if isinstance(dataset, Dataset):
+        dataset.reopen()
+
+
+def identity(x):
+    return x
+
+
+def return_row(id, row):
+    return row
+
+
+# The Dataset being populated, inherited by forked ingestion workers so that
+# its store_fn (often a lambda) does not need to be pickled.
+INGEST_DATASET = None
+
+
+def init_ingest_worker(dataset: Dataset):
+    global INGEST_DATASET
+    INGEST_DATASET = dataset
+
+
+def store_batch_in_worker(batch: list[tuple]):
+    return INGEST_DATASET.store_batch(batch)
+
+
+def to_builtin(id):
+    """Convert numpy scalar ids to the equivalent python int / str."""
+    return id.item() if isinstance(id, np.generic) else id
+
+
+def open_text_file(path: str):
+    """
+    Open a text file for reading, decompressing .gz or .zst files on the fly.
+    """
+    path = str(path)
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    if path.endswith(".zst"):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("Reading .zst files requires `pip install zstandard`.")
+        return zstandard.open(path, "rt", encoding="utf-8")
+    return open(path, encoding="utf-8")
+
+
+def iter_json_items(f, chunk_size: int = 1 << 20):
+    """
+    Incrementally parse a json file containing a single dict, yielding its
+    (key, value) pairs one at a time. Only one value (plus a chunk of text)
+    is held in memory at any time.
+    """
+    decoder = json.JSONDecoder()
+    buffer, pos, eof = "", 0, False
+
+    def next_token():
+        # Return the next non-whitespace character, reading more if required
+        nonlocal buffer, pos, eof
+        while True:
+            while pos < len(buffer) and buffer[pos].isspace():
+                pos += 1
+            if pos < len(buffer) or eof:
+                return buffer[pos] if pos < len(buffer) else ""
+            read_more()
+
+    def read_more():
+        nonlocal buffer, pos, eof
+        chunk = f.read(chunk_size)
+        eof = len(chunk) == 0
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+    def decode():
+        # Decode the next json value. A value is only complete once the next
+        # non-whitespace character is a delimiter, otherwise e.g. 12 may be
+        # part of 123, or 1 part of 1.5 or 1e5.
+        nonlocal pos
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer, pos)
+                after = end
+                while after < len(buffer) and buffer[after].isspace():
+                    after += 1
+                if eof or (after < len(buffer) and buffer[after] in ",:}"):
+                    pos = end
+                    return value
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            read_more()
+
+    if next_token() != "{":
+        raise ValueError("Expected the json file to contain a dict.")
+    pos += 1
+    if next_token() == "}":
+        return
+    while True:
+        next_token()
+        key = decode()
+        if next_token() != ":":
+            raise ValueError(f"Expected ':' after key {key}.")
+        pos += 1
+        next_token()
+        yield key, decode()
+        token = next_token()
+        pos += 1
+        if token == "}":
+            return
+        if token != ",":
+            raise ValueError(f"Expected ',' or '}}' after value of key {key}.")
+
+
+def get_session_weight(session: Session):
+    weight = getattr(session, "session_weight", None)
+    return 1.0 if weight is None else weight
+
+
+def get_num_items(session: Session):
+    items = getattr(session, "items", None)
+    return 0 if items is None else len(items)
+
+
+def get_query_length(session: Session):
+    query = getattr(session, "query", None)
+    return 0 if query is None else len(query.split())
+
+
+def to_compact_session(session: Session):
+    if isinstance(session, Session):
+        return CompactSession.from_session(session)
+    return session
+
 
 # For UserDataset and ItemDataset, we just enforce that the load_fn must load
 # a dict object
@@ -234,8 +996,12 @@ class UserItemDataset(Dataset):
         load_fn: callable = None,
         store_fn: callable = None,
         data: dict | str = None,
+        **kwargs,
     ) -> None:
-        super().__init__(db_location, id_name, load_fn, store_fn, data)
+        """
+        Additional keyword arguments are passed into Dataset.
+        """
+        super().__init__(db_location, id_name, load_fn, store_fn, data, **kwargs)
         self.check_returns_dict()
 
     def check_returns_dict(self, n=50):
@@ -258,8 +1024,20 @@ class SessionDataset(Dataset):
     applicable.
 
     Note that store_fn cannot be None, as it has to return a Session object.
+    If compact is True, each Session is validated by store_fn at ingestion and
+    then stored as a CompactSession, which is smaller and faster to load.
+
+    The session_weight, number of items and number of query words of each
+    session are stored as side columns, so that samplers can read them without
+    loading the sessions.
     """
 
+    side_column_fns = {
+        SESSION_WEIGHT_NAME: get_session_weight,
+        "num_items": get_num_items,
+        "query_length": get_query_length,
+    }
+
     def __init__(
         self,
         db_location: str = None,
@@ -270,10 +1048,19 @@ class SessionDataset(Dataset):
         subset_ids: list = None,
         user_dataset: Dataset = None,
         item_dataset: Dataset = None,
+        compact: bool = False,
+        **kwargs,
     ) -> None:
+        """
+        Additional keyword arguments are passed into Dataset.
+        """
         assert (
             store_fn is not None
         ), "SessionDataset must specify a store_fn that returns a Session."
+        self.compact = compact
+        if compact:
+            session_fn = store_fn
+            store_fn = lambda id, row: to_compact_session(session_fn(id, row))
         super().__init__(
             db_location=db_location,
             id_name=id_name,
@@ -281,17 +1068,26 @@ class SessionDataset(Dataset):
             store_fn=store_fn,
             data=data,
             subset_ids=subset_ids,
+            **kwargs,
         )
         self.user_dataset = user_dataset
         self.item_dataset = item_dataset
         self.check_returns_session()
         self.has_negative_items = self.check_negative_items()
 
+    def reopen(self):
+        super().reopen()
+        for dataset in [self.item_dataset, self.user_dataset]:
+            if dataset is not None:
+                dataset.reopen()
+
     def check_returns_session(self, n=50):
         for i, v in enumerate(iter(self)):
             session_id, _ = v
             item = self.load(session_id)
-            assert isinstance(item, Session), "SessionDataset must load Sessions."
+            assert isinstance(
+                item, (Session, CompactSession)
+            ), "SessionDataset must load Sessions."
             if i >= n:
                 break
 
@@ -317,59 +1113,136 @@ class SessionDataset(Dataset):
         user_attributes = (
             session.user if self.user_dataset is None else self.load_users(session.user)
         )
+        session_dict = (
+            session.as_dict()
+            if isinstance(session, CompactSession)
+            else session.__dict__
+        )
         return {
-            **session.__dict__,
+            **session_dict,
             SESSION_NAME: session,
             USER_ATTRIBUTES_NAME: user_attributes,
             ITEM_ATTRIBUTES_NAME: item_attributes,
         }
 
+    def load_session_weights(self, ids: list[int | str], batch_size: int = 10000):
+        """
+        Return the session_weight of each id as a float64 array, read from
+        the side columns of the db. Sessions without a session_weight have a
+        weight of 1.0.
+        """
+        try:
+            return self.load_side_column(SESSION_WEIGHT_NAME, ids)
+        except ValueError:
+            pass  # ids cannot be indexed, load each session instead
+        weights = np.ones(len(ids), dtype=np.float64)
+        for start in range(0, len(ids), batch_size):
+            sessions = self.load_many(ids[start : start + batch_size])
+            for i, session in enumerate(sessions, start):
+                weights[i] = get_session_weight(session)
+        return weights
+
     def load_item(self, item_id: int | str):
-        res = {"item_id": item_id}
-        if (
-            self.item_dataset is None
-            or (attrs := self.item_dataset.load(item_id)) is None
-        ):
-            return res
-        res.update(attrs)
-        return res
+        return self.load_items(item_id)
 
     def load_items(self, items: list[int | str] | int | str):
-        if isinstance(items, list):
-            return [self.load_item(item) for item in items]
-        return self.load_item(items)
+        return self.load_attributes(self.item_dataset, "item_id", items)
 
     def load_user(self, user_id: int | str):
-        res = {"user_id": user_id}
-        if (
-            self.user_dataset is None
-            or (attrs := self.user_dataset.load(user_id)) is None
-        ):
-            return res
-        res.update(attrs)
-        return res
+        return self.load_users(user_id)
 
     def load_users(self, users: list[int | str] | int | str):
-        if isinstance(users, list):
-            return [self.load_user(user) for user in users]
-        return self.load_user(users)
+        return self.load_attributes(self.user_dataset, "user_id", users)
 
-    def split_dataset(self, split_fn: callable):
+    def load_attributes(
+        self, dataset: Dataset, id_name: str, ids: list[int | str] | int | str
+    ):
+        """
+        Load the attributes for ids from dataset in a single storage call,
+        returning a dict of {id_name: id, **attributes} for each id.
+        """
+        if isinstance(ids, np.ndarray):
+            ids = ids.tolist()
+        is_list = isinstance(ids, list)
+        ids = ids if is_list else [ids]
+        if dataset is None:
+            attributes = [None] * len(ids)
+        else:
+            attributes = dataset.load_many(ids)
+
+        res = []
+        for id, attrs in zip(ids, attributes):
+            row = {id_name: id}
+            if attrs is not None:
+                row.update(attrs)
+            res.append(row)
+        return res if is_list else res[0]
+
+    def split_dataset(
+        self,
+        split_fn: callable = None,
+        fraction: tuple[float, float] = None,
+        method: str = "hash",
+        name: str = None,
+    ):
         """
         Generates a new SessionDataset object that only contains a subset of
-        keys from the parent, based on whether `split_fn(key)` is True.
+        keys from the parent, either:
+            - based on whether `split_fn(key)` is True, which requires a scan
+              over all keys, or
+            - based on the fraction (start, end) of keys to keep, e.g. (0.0, 0.8)
+              for an 80% split. See KeyIndex.split for the hash and range
+              methods. This uses the sorted key index of the db and does not
+              scan the db.
+
+        If name is provided for a fraction split, the positions of the split
+        are saved under db_location/splits/{name}.npz and reused thereafter,
+        as long as the db, the fraction and method of the split and the keys of
+        the dataset it is split from are unchanged. Otherwise, the split is
+        recomputed and saved again.
 
         Note that it reuses the same cache as the parent, just that we
-        restrict the keys for the child SessionDataset instance.
-        """
-        subset_ids = [k for k in self.iterkeys() if split_fn(k)]
-        child = SessionDataset(
-            db_location=self.db_location,
-            id_name=self.id_name,
-            load_fn=self.load_fn,
-            store_fn=self.store_fn,
-            item_dataset=self.item_dataset,
-            user_dataset=self.user_dataset,
-            subset_ids=subset_ids,
-        )
-        return child
+        restrict the keys for the child SessionDataset instance. The child
+        is not revalidated, as the parent has already been validated.
+        """
+        assert (split_fn is None) != (
+            fraction is None
+        ), "Provide exactly one of split_fn or fraction."
+        if split_fn is not None:
+            return self.subset(subset_ids=[k for k in self.iterkeys() if split_fn(k)])
+
+        full_index = self.load_key_index()
+        index = self.get_index()
+        path = None
+        if name is not None:
+            path = os.path.join(self.db_location, "splits", f"{name}.npz")
+            if os.path.exists(path):
+                saved = np.load(path)
+                version = int(saved["version"]) if "version" in saved else 0
+                if (
+                    version == self.version
+                    and int(saved["num_keys"]) == len(full_index)
+                    and "fraction" in saved
+                    and np.array_equal(saved["fraction"], fraction)
+                    and str(saved["method"]) == method
+                    and "parent_num_keys" in saved
+                    and int(saved["parent_num_keys"]) == len(index)
+                    and int(saved["parent_fingerprint"]) == index.fingerprint()
+                ):
+                    return self.subset(subset_index=full_index[saved["positions"]])
+
+        subset_index = index[index.split(*fraction, method=method)]
+        if path is not None:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            positions = full_index.find(subset_index.keys)
+            np.savez(
+                path,
+                positions=positions,
+                num_keys=len(full_index),
+                version=self.version,
+                fraction=np.array(fraction, dtype=np.float64),
+                method=method,
+                parent_num_keys=len(index),
+                parent_fingerprint=index.fingerprint(),
+            )
+        return self.subset(subset_index=subset_index)
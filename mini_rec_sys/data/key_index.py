@@ -0,0 +1,168 @@
+"""
+A persisted, sorted index over the ids of a Dataset. It allows us to look up,
+hash and split the ids of large datasets using vectorized numpy operations
+rather than iterating over the underlying storage.
+"""
+from __future__ import annotations
+import numpy as np
+import zlib
+import os
+
+
+class KeyIndex:
+    """
+    A sorted array of unique ids, which must be either all int or all str,
+    together with a stable 32-bit hash of each id.
+    """
+
+    KEYS_FILE = "key_index.npy"
+    HASHES_FILE = "key_hashes.npy"
+
+    def __init__(self, keys: np.ndarray, hashes: np.ndarray = None) -> None:
+        """
+        keys: sorted array of unique ids
+        hashes: the hash of each id, computed lazily if not provided
+        """
+        self.keys = keys
+        self.hashes_array = hashes
+        self.is_int = keys.dtype.kind in "iu"
+
+    @classmethod
+    def from_keys(cls, keys: list[int | str]):
+        """Build the index from an unsorted list of ids."""
+        keys = list(keys)
+        if all(isinstance(k, (int, np.integer)) for k in keys):
+            keys = np.array(keys, dtype=np.int64)
+        elif all(isinstance(k, str) for k in keys):
+            keys = np.array(keys, dtype=str)
+        else:
+            raise ValueError("KeyIndex requires ids to be either all int or all str.")
+        return cls(np.unique(keys))
+
+    @classmethod
+    def load(cls, directory: str):
+        """Load a saved index from directory, or return None if there is none."""
+        keys_path = os.path.join(directory, cls.KEYS_FILE)
+        hashes_path = os.path.join(directory, cls.HASHES_FILE)
+        if not (os.path.exists(keys_path) and os.path.exists(hashes_path)):
+            return None
+        return cls(
+            np.load(keys_path, mmap_mode="r"), np.load(hashes_path, mmap_mode="r")
+        )
+
+    def save(self, directory: str):
+        # Write to a temp file first, so that readers never see a partial file
+        for filename, array in [
+            (self.KEYS_FILE, self.keys),
+            (self.HASHES_FILE, self.hashes),
+        ]:
+            path = os.path.join(directory, filename)
+            with open(path + ".tmp", "wb") as f:
+                np.save(f, array)
+            os.replace(path + ".tmp", path)
+
+    def update(self, added: list[int | str], deleted: list[int | str]):
+        """
+        Return a new KeyIndex with the ids in added inserted and the ids in
+        deleted removed. The hashes of existing ids are not recomputed.
+        """
+        keys, hashes = self.keys, self.hashes
+        if len(deleted) > 0:
+            positions = self.find(list(deleted))
+            keep = np.ones(len(keys), dtype=bool)
+            keep[positions[positions >= 0]] = False
+            keys, hashes = keys[keep], hashes[keep]
+        added = KeyIndex.from_keys(added)
+        if len(added) == 0:
+            return KeyIndex(keys, hashes)
+        if len(keys) == 0:
+            return added
+        if added.is_int != self.is_int:
+            raise ValueError("KeyIndex requires ids to be either all int or all str.")
+        # Promote the dtype so that longer str ids are not truncated
+        keys = keys.astype(np.result_type(keys.dtype, added.keys.dtype))
+        positions = np.minimum(np.searchsorted(keys, added.keys), len(keys) - 1)
+        added = added[keys[positions] != added.keys]
+        positions = np.searchsorted(keys, added.keys)
+        return KeyIndex(
+            np.insert(keys, positions, added.keys),
+            np.insert(hashes, positions, added.hashes),
+        )
+
+    @property
+    def hashes(self):
+        """
+        Stable hash of each id. Unlike the builtin hash, it does not vary
+        across python processes, so splits based on it are reproducible.
+        """
+        if self.hashes_array is None:
+            self.hashes_array = np.array(
+                [zlib.crc32(str(k).encode("utf-8")) for k in self.keys],
+                dtype=np.uint32,
+            )
+        return self.hashes_array
+
+    def fingerprint(self):
+        """Stable hash of the whole set of ids, to tell two indices apart."""
+        return zlib.crc32(np.ascontiguousarray(self.hashes).tobytes())
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, id: int | str):
+        return self.find([id])[0] >= 0
+
+    def __getitem__(self, positions: slice | np.ndarray):
+        """Return a new KeyIndex over a sorted subset of positions."""
+        hashes = None if self.hashes_array is None else self.hashes_array[positions]
+        return KeyIndex(self.keys[positions], hashes)
+
+    def iterkeys(self):
+        for key in self.keys:
+            yield key.item() if self.is_int else str(key)
+
+    def find(self, ids: list[int | str] | np.ndarray):
+        """Return the position of each id in the index, or -1 if not found."""
+        positions = np.full(len(ids), -1, dtype=np.int64)
+        if isinstance(ids, np.ndarray) and ids.dtype.kind == self.keys.dtype.kind:
+            valid, query = np.arange(len(ids)), ids
+        elif set(map(type, ids)) <= ({int} if self.is_int else {str}):
+            # All ids are valid, so skip checking them one by one
+            valid = np.arange(len(ids))
+            query = np.array(ids, dtype=np.int64 if self.is_int else str)
+        else:
+            valid = [i for i, id in enumerate(ids) if self.is_valid(id)]
+            query = np.array(
+                [ids[i] for i in valid], dtype=np.int64 if self.is_int else str
+            )
+        if len(valid) == 0 or len(self.keys) == 0:
+            return positions
+        idx = np.minimum(np.searchsorted(self.keys, query), len(self.keys) - 1)
+        is_found = self.keys[idx] == query
+        positions[np.asarray(valid)[is_found]] = idx[is_found]
+        return positions
+
+    def is_valid(self, id: int | str):
+        if self.is_int:
+            return isinstance(id, (int, np.integer)) and not isinstance(id, bool)
+        return isinstance(id, str)
+
+    def split(self, start: float, end: float, method: str = "hash"):
+        """
+        Return the sorted positions of the ids that fall into [start, end),
+        where start and end are fractions between 0 and 1.
+
+        method:
+            "hash": ids whose stable hash falls within [start, end) of the
+                hash range. Ids keep their split as the dataset grows.
+            "range": ids whose position in sorted order falls within
+                [start, end) of the index. This is a slice and costs O(1).
+        """
+        assert 0.0 <= start <= end <= 1.0, "Require 0 <= start <= end <= 1."
+        if method == "range":
+            n = len(self)
+            return slice(int(round(start * n)), int(round(end * n)))
+        elif method == "hash":
+            fractions = self.hashes / float(2**32)
+            return np.flatnonzero((fractions >= start) & (fractions < end))
+        raise ValueError(f"method must be hash or range, got {method}.")
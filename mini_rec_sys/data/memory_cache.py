@@ -0,0 +1,140 @@
+"""
+A bounded, in-process cache placed in front of Dataset storage, so that
+frequently loaded (hot) objects do not need to be fetched and unpickled from
+disk every time.
+"""
+from __future__ import annotations
+from collections import OrderedDict, defaultdict
+import sys
+
+CACHE_POLICIES = ["lru", "lfu"]
+
+
+def estimate_size(obj: object, seen: set = None):
+    """
+    Estimate the memory footprint of obj in bytes, recursing into containers
+    and object attributes.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(
+            estimate_size(k, seen) + estimate_size(v, seen) for k, v in obj.items()
+        )
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(estimate_size(v, seen) for v in obj)
+    elif hasattr(obj, "__dict__"):
+        size += estimate_size(obj.__dict__, seen)
+    elif hasattr(obj, "__slots__"):
+        size += sum(estimate_size(getattr(obj, k, None), seen) for k in obj.__slots__)
+    return size
+
+
+class MemoryCache:
+    """
+    Caches objects up to a total of max_bytes (as estimated by estimate_size),
+    evicting objects based on policy:
+        "lru": evict the least recently used object.
+        "lfu": evict the least frequently used object, breaking ties by
+            least recently used.
+
+    Note that cached objects are shared between callers, so they should not
+    be modified in place.
+    """
+
+    def __init__(self, max_bytes: int, policy: str = "lru") -> None:
+        assert policy in CACHE_POLICIES, f"policy must be one of {CACHE_POLICIES}."
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.values = {}  # key -> (value, size)
+        self.recency = OrderedDict()  # for lru
+        self.counts = {}  # for lfu: key -> count
+        self.buckets = defaultdict(OrderedDict)  # for lfu: count -> keys
+        self.min_count = 0
+
+    def __len__(self):
+        return len(self.values)
+
+    def __contains__(self, key: object):
+        return key in self.values
+
+    def get(self, key: object, default=None):
+        if key not in self.values:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.touch(key)
+        return self.values[key][0]
+
+    def put(self, key: object, value: object):
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+        if key in self.values:
+            self.remove(key)
+        while self.num_bytes + size > self.max_bytes:
+            self.evict()
+        self.values[key] = (value, size)
+        self.num_bytes += size
+        if self.policy == "lru":
+            self.recency[key] = None
+        else:
+            self.counts[key] = 1
+            self.buckets[1][key] = None
+            self.min_count = 1
+
+    def touch(self, key: object):
+        if self.policy == "lru":
+            self.recency.move_to_end(key)
+            return
+        count = self.counts[key]
+        del self.buckets[count][key]
+        if len(self.buckets[count]) == 0:
+            del self.buckets[count]
+            if self.min_count == count:
+                self.min_count = count + 1
+        self.counts[key] = count + 1
+        self.buckets[count + 1][key] = None
+
+    def evict(self):
+        if self.policy == "lru":
+            key = next(iter(self.recency))
+        else:
+            key = next(iter(self.buckets[self.min_count]))
+        self.remove(key)
+        self.evictions += 1
+
+    def remove(self, key: object):
+        _, size = self.values.pop(key)
+        self.num_bytes -= size
+        if self.policy == "lru":
+            del self.recency[key]
+            return
+        count = self.counts.pop(key)
+        del self.buckets[count][key]
+        if len(self.buckets[count]) == 0:
+            del self.buckets[count]
+            if self.min_count == count and len(self.counts) > 0:
+                self.min_count = min(self.buckets)
+
+    def clear(self):
+        for key in list(self.values):
+            self.remove(key)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "num_objects": len(self),
+            "num_bytes": self.num_bytes,
+        }
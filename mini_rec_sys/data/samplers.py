@@ -3,16 +3,16 @@ Besides the default samplers, one can also subclass Sampler and define custom sa
 """
 from __future__ import annotations
 from typing import Optional, Sized
+import numpy as np
 import torch
-import random
 import math
 from mini_rec_sys.data.datasets import Dataset, SessionDataset
-from mini_rec_sys.utils import flatten_list
-from mini_rec_sys.constants import SESSION_WEIGHT_NAME
 from torch import utils
 from torch.utils.data import BatchSampler, Sampler
 from pdb import set_trace
 
+MAX_HYPERGEOMETRIC_TOTAL = 10**9
+
 
 class SequentialSampler(Sampler):
     def __init__(self, data_source: SessionDataset) -> None:
@@ -22,26 +22,119 @@ class SequentialSampler(Sampler):
     def __iter__(self):
         return self.data_source.iterkeys()
 
+    def __len__(self):
+        return len(self.data_source)
+
+
+class DistributedBatchSampler(Sampler):
+    """
+    Base class for batch samplers that support distributed (DDP) training.
+    Every rank iterates over the same stream of batches from
+    self.batch_sampler, and keeps every world_size-th batch starting from its
+    rank, so that ranks train on disjoint batches. The stream only holds keys,
+    so iterating over the batches of other ranks does not load any data.
+
+    All ranks return the same number of batches, as required by DDP. If
+    drop_last is True, the last incomplete round of batches is dropped,
+    otherwise ranks that are short of a batch repeat one of the first batches.
 
-class BatchedSequentialSampler(Sampler):
+    rank and world_size default to those of the initialized torch.distributed
+    process group (if any) when the sampler is iterated over, so samplers may
+    be created before the process group is initialized.
+    """
+
+    def __init__(
+        self,
+        sampler: Sampler,
+        batch_size: int,
+        drop_last: bool = True,
+        rank: int = None,
+        world_size: int = None,
+    ) -> None:
+        self.sampler = sampler
+        self.batch_sampler = BatchSampler(
+            sampler, batch_size=batch_size, drop_last=drop_last
+        )
+        self.drop_last = drop_last
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+
+    def get_rank_and_world_size(self):
+        rank, world_size = get_rank_and_world_size()
+        rank = rank if self.rank is None else self.rank
+        world_size = world_size if self.world_size is None else self.world_size
+        assert 0 <= rank < world_size, "Require 0 <= rank < world_size."
+        return rank, world_size
+
+    def set_epoch(self, epoch: int):
+        """Set the epoch, which seeds the sampling of the epoch if applicable."""
+        self.epoch = epoch
+        if hasattr(self.sampler, "set_epoch"):
+            self.sampler.set_epoch(epoch)
+
+    def __len__(self):
+        _, world_size = self.get_rank_and_world_size()
+        num_batches = len(self.batch_sampler)
+        if self.drop_last:
+            return num_batches // world_size
+        return math.ceil(num_batches / world_size)
+
+    def num_unpadded_batches(self):
+        """
+        The number of batches of this rank that are not repeated to pad it,
+        which are always the first ones it returns.
+        """
+        rank, world_size = self.get_rank_and_world_size()
+        num_batches = len(range(rank, len(self.batch_sampler), world_size))
+        return min(len(self), num_batches)
+
+    def __iter__(self):
+        rank, world_size = self.get_rank_and_world_size()
+        if world_size == 1:
+            yield from self.batch_sampler
+            return
+        num_batches = len(self)
+        first_batches = []
+        count = 0
+        for i, batch in enumerate(self.batch_sampler):
+            if i < world_size:
+                first_batches.append(batch)
+            if count == num_batches:
+                break
+            if i % world_size == rank:
+                yield batch
+                count += 1
+        while count < num_batches:
+            yield first_batches[count % len(first_batches)]
+            count += 1
+
+
+class BatchedSequentialSampler(DistributedBatchSampler):
     """
     Returns batches of keys of the data_source based on iteration order.
+    In distributed training, each rank returns its own subset of batches, see
+    DistributedBatchSampler.
     """
 
     def __init__(
-        self, data_source: SessionDataset, batch_size: int, drop_last: bool = True
+        self,
+        data_source: SessionDataset,
+        batch_size: int,
+        drop_last: bool = True,
+        rank: int = None,
+        world_size: int = None,
     ):
-        self.sampler = BatchSampler(
+        super().__init__(
             SequentialSampler(data_source),
             batch_size=batch_size,
             drop_last=drop_last,
+            rank=rank,
+            world_size=world_size,
         )
 
-    def __iter__(self):
-        return self.sampler.__iter__()
-
 
-class BatchedWeightedSampler(Sampler):
+class BatchedWeightedSampler(DistributedBatchSampler):
     """
     Returns batches of keys of the data_source based on random sampling from
     the data_source keys based on the specified weights for each session.
@@ -49,6 +142,10 @@ class BatchedWeightedSampler(Sampler):
     This can be useful for e.g. when our training dataset stores relevance
     judgments for each query as a Session, and we want to sample queries according
     to their occurrence frequency.
+
+    In distributed training, every rank draws the same epoch (seeded by seed
+    and the epoch set by set_epoch) and returns its own subset of batches, see
+    DistributedBatchSampler.
     """
 
     def __init__(
@@ -57,18 +154,153 @@ class BatchedWeightedSampler(Sampler):
         batch_size: int,
         drop_last: bool = True,
         num_instances: int = None,
+        replacement: bool = False,
+        seed: int = None,
+        rank: int = None,
+        world_size: int = None,
     ):
-        self.sampler = BatchSampler(
+        """
+        See WeightedSampler for num_instances, replacement and seed.
+        """
+        super().__init__(
             WeightedSampler(
                 data_source=data_source,
                 num_instances=num_instances,
+                replacement=replacement,
+                seed=seed,
+            ),
+            batch_size=batch_size,
+            drop_last=drop_last,
+            rank=rank,
+            world_size=world_size,
+        )
+
+    def __iter__(self):
+        _, world_size = self.get_rank_and_world_size()
+        assert (
+            world_size == 1 or self.sampler.seed is not None
+        ), "Distributed training requires a seed, so that all ranks draw the same epoch."
+        return super().__iter__()
+
+
+class LengthBucketSampler(Sampler):
+    def __init__(
+        self,
+        data_source: SessionDataset,
+        batch_size: int,
+        lengths: np.ndarray | str,
+        bucket_size: int = 100,
+        seed: int = None,
+    ):
+        """
+        Samples each key of data_source once per epoch, in an order where each
+        consecutive batch_size keys have similar lengths. Keys are shuffled,
+        split into buckets of bucket_size batches, and sorted by length
+        within each bucket. The full batches are then shuffled, followed by
+        the incomplete batch if any. Batches thus have less padding when
+        encoded, while remaining random.
+
+        lengths: the length of each key, in the order of data_source.get_index(),
+            or the name of a side column of data_source, e.g. "query_length".
+            Use the length of the texts that dominate the padding. For
+            DPRModel, that is usually the passages rather than the query, see
+            get_passage_lengths.
+        bucket_size: number of batches per bucket. Larger buckets give less
+            padding but less random batches.
+        seed: see WeightedSampler.
+        """
+        self.keys = get_keys_array(data_source)
+        if isinstance(lengths, str):
+            lengths = data_source.load_side_column(lengths, self.keys)
+        assert len(lengths) == len(
+            self.keys
+        ), "Require one length for each key of data_source."
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.seed = seed
+        self.epoch = 0
+        self.rng = np.random.default_rng(seed)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def get_positions(self):
+        """Return the positions of the keys in sampling order for this epoch."""
+        if self.seed is not None:
+            self.rng = np.random.default_rng((self.seed, self.epoch))
+        positions = self.rng.permutation(len(self.keys))
+        chunk = self.batch_size * self.bucket_size
+        buckets = [positions[i : i + chunk] for i in range(0, len(positions), chunk)]
+        buckets = [b[np.argsort(self.lengths[b], kind="stable")] for b in buckets]
+        positions = np.concatenate(buckets)
+        num_full = len(positions) // self.batch_size * self.batch_size
+        batches = positions[:num_full].reshape(-1, self.batch_size)
+        batches = batches[self.rng.permutation(len(batches))]
+        return np.concatenate([batches.ravel(), positions[num_full:]])
+
+    def padding_ratio(self):
+        """
+        Return the fraction of padding if the batches of an epoch were padded
+        to their longest length, e.g. to compare with a random order.
+        """
+        lengths = self.lengths[self.get_positions()]
+        num_full = len(lengths) // self.batch_size * self.batch_size
+        batches = lengths[:num_full].reshape(-1, self.batch_size)
+        num_padded = batches.max(axis=1).sum() * self.batch_size
+        if num_full < len(lengths):
+            num_padded += lengths[num_full:].max() * (len(lengths) - num_full)
+        return 1.0 - lengths.sum() / max(num_padded, 1)
+
+    def __iter__(self):
+        for key in self.keys[self.get_positions()]:
+            yield key.item() if isinstance(key, np.generic) else key
+
+
+class BatchedLengthSampler(DistributedBatchSampler):
+    """
+    Returns batches of keys of the data_source with similar lengths, to reduce
+    the padding (and thus the compute) spent on encoding texts of different
+    lengths, e.g. for DPRModel training. See LengthBucketSampler.
+
+    In distributed training, set a seed so that every rank draws the same
+    epoch, see DistributedBatchSampler.
+    """
+
+    def __init__(
+        self,
+        data_source: SessionDataset,
+        batch_size: int,
+        lengths: np.ndarray | str,
+        drop_last: bool = True,
+        bucket_size: int = 100,
+        seed: int = None,
+        rank: int = None,
+        world_size: int = None,
+    ):
+        super().__init__(
+            LengthBucketSampler(
+                data_source,
+                batch_size=batch_size,
+                lengths=lengths,
+                bucket_size=bucket_size,
+                seed=seed,
             ),
             batch_size=batch_size,
             drop_last=drop_last,
+            rank=rank,
+            world_size=world_size,
         )
 
     def __iter__(self):
-        return self.sampler.__iter__()
+        _, world_size = self.get_rank_and_world_size()
+        assert (
+            world_size == 1 or self.sampler.seed is not None
+        ), "Distributed training requires a seed, so that all ranks draw the same epoch."
+        return super().__iter__()
 
 
 class WeightedSampler(Sampler):
@@ -76,34 +308,175 @@ class WeightedSampler(Sampler):
         self,
         data_source: SessionDataset,
         num_instances: int = None,
+        replacement: bool = False,
+        seed: int = None,
+        chunk_size: int = 100000,
     ):
         """
+        Samples the keys of data_source according to the session_weight of
+        each session. Keys and weights are held in numpy arrays, and each
+        epoch is drawn lazily in chunks, so memory is O(number of sessions)
+        regardless of the weights.
+
         num_instances: if provided, will try to adjust the weights such that the
             sum of weights across all items is equal to num_instances. This is
             useful for e.g. when the weights stored are sample probabilities,
             and we want to sample without replacement from them.
+        replacement: the semantics of each epoch, which has as many instances
+            as the (adjusted) total weight:
+            False: each key appears exactly round(weight) times in the epoch,
+                in a random order. Keys with a rounded weight of 0 are dropped.
+            True: each instance is drawn independently, with probability
+                proportional to the weight of each key.
+        seed: seed for the random number generator. If provided, each epoch
+            is seeded by (seed, epoch), where the epoch is set by set_epoch,
+            so that every epoch is reproducible. Otherwise, every epoch is
+            drawn from the same unseeded generator.
+        chunk_size: number of instances drawn at a time.
         """
         print("Initializing WeightedSampler..")
+        keys = get_keys_array(data_source)
+        weights = data_source.load_session_weights(keys)
         multiplier = 1.0
         if num_instances is not None:
-            total_weight = sum(
-                [data_source[k][SESSION_WEIGHT_NAME] for k in data_source.iterkeys()]
-            )
-            multiplier = num_instances / total_weight
-
-        keys = []
-        weights = []
-        for k in data_source.iterkeys():
-            weight = round(data_source[k][SESSION_WEIGHT_NAME] * multiplier)
-            if weight > 0.0:
-                keys.append(k)
-                weights.append(int(weight))
+            multiplier = num_instances / weights.sum()
+        weights = weights * multiplier
+
+        if replacement:
+            is_valid = weights > 0.0
+            self.num_instances = int(round(weights.sum()))
+        else:
+            weights = np.round(weights).astype(np.int64)
+            is_valid = weights > 0
+            self.num_instances = int(weights.sum())
         assert (
-            len(keys) > 0
+            is_valid.any()
         ), "No keys with non-zero weight found, try increasing num_instances."
-        self.keys = flatten_list([[k] * w for k, w in zip(keys, weights)])
-        random.shuffle(self.keys)
-        print(f"WeightedSampler initialized with {len(self.keys):,} instances.")
+        self.keys = keys[is_valid]
+        self.weights = weights[is_valid]
+        self.replacement = replacement
+        self.chunk_size = chunk_size
+        self.seed = seed
+        self.epoch = 0
+        self.rng = np.random.default_rng(seed)
+        print(f"WeightedSampler initialized with {self.num_instances:,} instances.")
+
+    def __len__(self):
+        return self.num_instances
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
 
     def __iter__(self):
-        return iter(self.keys)
+        if self.seed is not None:
+            self.rng = np.random.default_rng((self.seed, self.epoch))
+        if self.replacement:
+            positions = self.iter_with_replacement()
+        else:
+            positions = self.iter_without_replacement()
+        for chunk in positions:
+            for key in self.keys[chunk]:
+                yield key.item() if isinstance(key, np.generic) else key
+
+    def iter_with_replacement(self):
+        """
+        Draw positions by binary search of uniform draws over the cumulative
+        weights, which costs O(log n) per draw.
+        """
+        cumulative = np.cumsum(self.weights)
+        remaining = self.num_instances
+        while remaining > 0:
+            size = min(self.chunk_size, remaining)
+            draws = self.rng.random(size) * cumulative[-1]
+            positions = np.searchsorted(cumulative, draws, side="right")
+            yield np.minimum(positions, len(cumulative) - 1)
+            remaining -= size
+
+    def iter_without_replacement(self):
+        """
+        Draw a random permutation of the multiset where each position appears
+        weight times, one chunk at a time. The number of times each position
+        appears in the next chunk follows a multivariate hypergeometric
+        distribution over the remaining counts, and the order within a chunk
+        is shuffled, which yields a uniformly random permutation overall.
+        """
+        remaining = self.weights.copy()
+        num_remaining = self.num_instances
+        # Each chunk costs O(number of keys), so use chunks at least that large
+        chunk_size = max(self.chunk_size, len(remaining))
+        while num_remaining > 0:
+            size = min(chunk_size, num_remaining)
+            counts = self.draw_counts(remaining, num_remaining, size)
+            remaining -= counts
+            num_remaining -= size
+            positions = np.repeat(np.arange(len(counts)), counts)
+            self.rng.shuffle(positions)
+            yield positions
+
+    def draw_counts(self, remaining: np.ndarray, num_remaining: int, size: int):
+        """
+        Draw how many times each position appears among size instances drawn
+        without replacement from the remaining counts.
+        """
+        if num_remaining < MAX_HYPERGEOMETRIC_TOTAL:
+            return self.rng.multivariate_hypergeometric(
+                remaining, size, method="marginals"
+            )
+        # numpy does not support larger totals. As size is then tiny relative
+        # to the total, drawing with replacement is a close approximation.
+        counts = np.zeros_like(remaining)
+        while size > 0:
+            left = remaining - counts
+            draws = self.rng.multinomial(size, left / left.sum())
+            draws = np.minimum(draws, left)
+            counts += draws
+            size -= int(draws.sum())
+        return counts
+
+
+def get_rank_and_world_size():
+    """Return the rank and world size of the distributed process group if any."""
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_rank(), torch.distributed.get_world_size()
+    return 0, 1
+
+
+def get_keys_array(data_source: Dataset):
+    """Return the keys of data_source as a numpy array."""
+    try:
+        return np.asarray(data_source.get_index().keys)
+    except ValueError:
+        return np.array(list(data_source.iterkeys()), dtype=object)
+
+
+def get_passage_lengths(
+    data_source: SessionDataset, text_key: str, batch_size: int = 10000
+):
+    """
+    Return the mean number of words of the text_key attribute of the positive
+    and negative items of each session, in the order of data_source.get_index().
+    These can be used as the lengths of a LengthBucketSampler for DPRModel,
+    whose padding is driven by the passages it encodes. Items without text
+    count as 0 words.
+    """
+    assert data_source.item_dataset is not None, "data_source needs an item_dataset."
+    keys = get_keys_array(data_source).tolist()
+    lengths = np.zeros(len(keys))
+    for start in range(0, len(keys), batch_size):
+        sessions = data_source.load_many(keys[start : start + batch_size])
+        session_items = [
+            [] if session is None else session.items for session in sessions
+        ]
+        session_items = [
+            items.tolist() if isinstance(items, np.ndarray) else list(items)
+            for items in session_items
+        ]
+        items = list({item for items in session_items for item in items})
+        num_words = {}
+        for item, attributes in zip(items, data_source.item_dataset.load_many(items)):
+            text = None if attributes is None else attributes.get(text_key)
+            num_words[item] = 0 if text is None else len(text.split())
+        for i, items in enumerate(session_items):
+            if len(items) > 0:
+                lengths[start + i] = np.mean([num_words[item] for item in items])
+    return lengths
@@ -2,6 +2,7 @@ from __future__ import annotations
 from pydantic import Field, validator
 from pydantic.dataclasses import dataclass
 from typing import Optional, Union
+import numpy as np
 
 
 @dataclass
@@ -74,3 +75,136 @@ class Session:
             for item, rel in zip(self.positive_items, self.positive_relevances)
         }
         self.relevances = [relevance_dict.get(item, 0) for item in self.items]
+
+
+def to_array(values: list | None, dtype=None):
+    """
+    Convert a list of item ids or numbers into a typed numpy array. Item ids
+    that are neither all int nor all str are kept in an object array.
+    """
+    if values is None:
+        return None
+    if dtype is None:
+        if all(isinstance(v, int) and not isinstance(v, bool) for v in values):
+            dtype = np.int64
+        elif all(isinstance(v, str) for v in values):
+            dtype = str
+        else:
+            dtype = object
+    return np.array(values, dtype=dtype)
+
+
+class CompactSession:
+    """
+    A compact, array-backed encoding of a Session for storage.
+
+    A Session is validated once (e.g. in store_fn at ingestion) and then
+    converted into a CompactSession, which stores item ids, relevances and
+    weights as typed numpy arrays in __slots__. Loading a CompactSession does
+    not re-run any validators or rebuild python lists and dicts, and `items`
+    and `relevances` are derived on access.
+    """
+
+    __slots__ = [
+        "session_id",
+        "positive_items",
+        "positive_relevances",
+        "positive_weights",
+        "user",
+        "query",
+        "negative_items",
+        "negative_weights",
+        "session_weight",
+    ]
+
+    def __init__(
+        self,
+        session_id: Union[int, str],
+        positive_items: np.ndarray,
+        positive_relevances: np.ndarray,
+        positive_weights: np.ndarray = None,
+        user: Optional[Union[int, str]] = None,
+        query: Optional[str] = None,
+        negative_items: np.ndarray = None,
+        negative_weights: np.ndarray = None,
+        session_weight: Optional[Union[int, float]] = None,
+    ) -> None:
+        self.session_id = session_id
+        self.positive_items = positive_items
+        self.positive_relevances = positive_relevances
+        self.positive_weights = positive_weights
+        self.user = user
+        self.query = query
+        self.negative_items = negative_items
+        self.negative_weights = negative_weights
+        self.session_weight = session_weight
+
+    @classmethod
+    def from_session(cls, session: Session):
+        return cls(
+            session_id=session.session_id,
+            positive_items=to_array(session.positive_items),
+            positive_relevances=to_array(session.positive_relevances, np.float32),
+            positive_weights=to_array(session.positive_weights, np.float32),
+            user=session.user,
+            query=session.query,
+            negative_items=to_array(session.negative_items),
+            negative_weights=to_array(session.negative_weights, np.float32),
+            session_weight=session.session_weight,
+        )
+
+    def to_session(self):
+        """Convert back into a (validated) Session."""
+        return Session(
+            **{
+                k: v.tolist() if isinstance(v, np.ndarray) else v
+                for k, v in self.as_fields().items()
+            }
+        )
+
+    @property
+    def items(self):
+        """All items in the session, negative items followed by positive items."""
+        if self.negative_items is None:
+            return self.positive_items
+        arrays = [self.negative_items, self.positive_items]
+        # Keep mixed int and str ids as they are, rather than casting to str
+        dtype = object if arrays[0].dtype.kind != arrays[1].dtype.kind else None
+        return np.concatenate(arrays, dtype=dtype)
+
+    @property
+    def relevances(self):
+        """The relevance of each item in `items`, which is 0 for negative items."""
+        num_negative = 0 if self.negative_items is None else len(self.negative_items)
+        return np.concatenate(
+            [np.zeros(num_negative, dtype=np.float32), self.positive_relevances]
+        )
+
+    def as_fields(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    def as_dict(self):
+        """Equivalent of Session.__dict__, including items and relevances."""
+        return {**self.as_fields(), "items": self.items, "relevances": self.relevances}
+
+    def __getstate__(self):
+        # Store arrays as raw bytes, which is smaller and faster to unpickle
+        # than the default pickling of numpy arrays.
+        state = []
+        for k in self.__slots__:
+            v = getattr(self, k)
+            if isinstance(v, np.ndarray) and v.dtype != object:
+                v = (v.dtype.str, v.tobytes())
+            elif isinstance(v, np.ndarray):
+                v = v.tolist()
+            state.append(v)
+        return tuple(state)
+
+    def __setstate__(self, state: tuple):
+        for k, v in zip(self.__slots__, state):
+            if isinstance(v, tuple):
+                # Copy, as arrays backed by the bytes would be read-only
+                v = np.frombuffer(v[1], dtype=v[0]).copy()
+            elif isinstance(v, list):
+                v = np.array(v, dtype=object)
+            setattr(self, k, v)
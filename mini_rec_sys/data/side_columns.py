@@ -0,0 +1,95 @@
+"""
+Scalar metadata of each id in a Dataset (e.g. the weight of each session),
+stored as numpy arrays aligned with the KeyIndex of the Dataset. This allows
+the metadata of all ids to be read in one vectorized pass, without loading
+and unpickling the stored objects.
+"""
+from __future__ import annotations
+import numpy as np
+import os
+
+from mini_rec_sys.data.key_index import KeyIndex
+
+
+class SideColumns:
+    """
+    A float64 array per column name, where the i-th value belongs to the i-th
+    id of the KeyIndex. Ids without a value are NaN.
+    """
+
+    FILE_PREFIX = "side_column_"
+
+    def __init__(self, columns: dict[str, np.ndarray]) -> None:
+        self.columns = columns
+
+    @classmethod
+    def from_values(
+        cls, index: KeyIndex, ids: list[int | str], values: dict[str, list]
+    ):
+        """Build the columns from the values of each id in ids."""
+        columns = {name: np.full(len(index), np.nan) for name in values}
+        return cls(columns).set_values(index, ids, values)
+
+    def set_values(
+        self, index: KeyIndex, ids: list[int | str], values: dict[str, list]
+    ):
+        positions = index.find(ids)
+        is_found = positions >= 0
+        for name, column in self.columns.items():
+            column[positions[is_found]] = np.asarray(values[name])[is_found]
+        return self
+
+    def update(
+        self,
+        index: KeyIndex,
+        new_index: KeyIndex,
+        ids: list[int | str],
+        values: dict[str, list],
+    ):
+        """
+        Return the columns aligned with new_index, an updated version of
+        index, with the values of ids replaced.
+        """
+        positions = new_index.find(index.keys)
+        is_found = positions >= 0
+        columns = {}
+        for name, column in self.columns.items():
+            columns[name] = np.full(len(new_index), np.nan)
+            columns[name][positions[is_found]] = column[is_found]
+        return SideColumns(columns).set_values(new_index, ids, values)
+
+    def __getitem__(self, name: str):
+        return self.columns[name]
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()), []))
+
+    def save(self, directory: str):
+        for name, column in self.columns.items():
+            path = os.path.join(directory, f"{self.FILE_PREFIX}{name}.npy")
+            with open(path + ".tmp", "wb") as f:
+                np.save(f, column)
+            os.replace(path + ".tmp", path)
+
+    @classmethod
+    def remove(cls, directory: str):
+        """Remove all columns saved in directory."""
+        if not os.path.isdir(directory):
+            return
+        for filename in os.listdir(directory):
+            if filename.startswith(cls.FILE_PREFIX):
+                os.remove(os.path.join(directory, filename))
+
+    @classmethod
+    def load(cls, directory: str, names: list[str]):
+        """
+        Load the saved columns from directory, or return None if any of them
+        are missing.
+        """
+        paths = {
+            name: os.path.join(directory, f"{cls.FILE_PREFIX}{name}.npy")
+            for name in names
+        }
+        if not all(os.path.exists(path) for path in paths.values()):
+            return None
+        return cls({name: np.load(path, mmap_mode="r") for name, path in paths.items()})
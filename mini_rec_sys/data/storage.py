@@ -0,0 +1,637 @@
+"""
+Storage backends for Dataset. Each backend exposes the small subset of the
+diskcache.Cache interface that Dataset relies on:
+    - get(id, default), get_many(ids, default), __len__, __contains__,
+      iterkeys() for reading
+    - __setitem__ and transact() for writing
+    - directory, the folder where the storage lives
+
+A db that has received incremental changes (see Dataset.apply_changes) is
+opened as a LayeredStorage, which overlays the delta layers on the base storage.
+"""
+from __future__ import annotations
+from contextlib import contextmanager
+from diskcache import Cache
+from diskcache.core import EVICTION_POLICY
+from pathlib import Path
+import numpy as np
+import tempfile
+import pickle
+import json
+import time
+import os
+
+from mini_rec_sys.data.key_index import KeyIndex
+
+MAX_DISK_SIZE = int(1e10)
+STORAGE_TYPES = ["diskcache", "columnar"]
+MISSING = object()  # Marks a field that is absent from a stored dict
+SQLITE_MAX_VARIABLES = 900
+INT64_MIN, INT64_MAX = -(2**63), 2**63 - 1
+
+
+def open_storage(storage: str = "diskcache", directory: str = None):
+    """
+    Open (or initialize) the storage of type `storage` at directory. If
+    directory is None, the storage is created in a temporary location.
+    If the directory contains a manifest of published versions, the latest
+    version is opened as a LayeredStorage.
+    """
+    if directory is not None and LayeredStorage.has_manifest(directory):
+        return LayeredStorage(directory, storage)
+    return open_base_storage(storage, directory)
+
+
+def open_base_storage(storage: str = "diskcache", directory: str = None):
+    """
+    Open the storage at directory. A finalized columnar db is always opened
+    as ColumnarStorage, as opening it as a diskcache would silently create an
+    empty cache in the same folder.
+    """
+    if directory is not None and os.path.exists(
+        os.path.join(directory, ColumnarStorage.META_FILE)
+    ):
+        return ColumnarStorage(directory)
+    if storage == "diskcache":
+        return DiskCache(directory, size_limit=MAX_DISK_SIZE, cull_limit=0)
+    elif storage == "columnar":
+        return ColumnarStorage(directory)
+    raise ValueError(f"storage must be one of {STORAGE_TYPES}, got {storage}.")
+
+
+class DiskCache(Cache):
+    """
+    diskcache.Cache with a batched get_many lookup.
+    """
+
+    def get_many(self, ids: list[int | str], default=None):
+        """
+        Return the list of values for ids, with default for missing ids.
+        Rather than one sqlite query per id, we query up to SQLITE_MAX_VARIABLES
+        ids at a time with a single `key IN (...)` query.
+        """
+        if self.statistics or EVICTION_POLICY[self.eviction_policy]["get"]:
+            # These settings require bookkeeping on every get
+            return [self.get(id, default) for id in ids]
+
+        # Blob keys are returned by sqlite as bytes, so we key on bytes
+        as_key = lambda k, raw: (bytes(k) if isinstance(k, memoryview) else k, raw)
+        db_keys = [as_key(*self._disk.put(id)) for id in ids]
+        unique_keys = list(set(db_keys))
+        select = (
+            "SELECT key, raw, mode, filename, value FROM Cache"
+            " WHERE key IN ({}) AND (expire_time IS NULL OR expire_time > ?)"
+        )
+        found = {}
+        for start in range(0, len(unique_keys), SQLITE_MAX_VARIABLES):
+            batch = unique_keys[start : start + SQLITE_MAX_VARIABLES]
+            query = select.format(",".join(["?"] * len(batch)))
+            rows = self._sql(query, [k for k, _ in batch] + [time.time()])
+            for key, raw, mode, filename, value in rows.fetchall():
+                try:
+                    found[as_key(key, bool(raw))] = self._disk.fetch(
+                        mode, filename, value, False
+                    )
+                except IOError:
+                    # Key was deleted before we could retrieve result.
+                    continue
+        return [found.get(k, default) for k in db_keys]
+
+
+class ColumnarStorage:
+    """
+    An immutable, memory-mapped columnar storage.
+
+    Rows are written once (via __setitem__ within transact() blocks) and then
+    finalized into a set of flat files:
+        - meta.json: the schema of the columns
+        - keys.npy / rows.npy: sorted ids and the row index of each id
+        - <col>.state, <col>.data, <col>.offsets: one set of files per column
+
+    If each stored object is a dict, every key of the dict becomes a column.
+    Otherwise the whole object is stored in a single column. Columns are one of
+    the following kinds:
+        - int64 / float64: fixed width numpy columns
+        - str: utf-8 encoded bytes with offsets
+        - object: pickled bytes with offsets
+    The kind of each column is inferred from the first batch with values for
+    it. If a later batch has values that do not fit, the column is rewritten
+    as a more general kind (int64 to float64, otherwise to object), and
+    fields first seen in a later batch are added as absent in earlier rows.
+
+    At read time all files are memory-mapped, so lookups do not go through a
+    database and the pages are shared across processes (e.g. DataLoader
+    workers) through the OS page cache.
+    """
+
+    META_FILE = "meta.json"
+    VALUE_COLUMN = "__value__"
+    ABSENT, NONE, PRESENT = 0, 1, 2
+
+    def __init__(self, directory: str = None) -> None:
+        if directory is None:
+            directory = tempfile.mkdtemp()
+        self.directory = str(directory)
+        self.meta = None
+        self.pending = []
+        self.written_keys = []
+        self.num_written = 0
+        self.handles = None
+
+        if os.path.exists(self.meta_path):
+            self.open()
+        else:
+            Path(self.directory).mkdir(parents=True, exist_ok=True)
+
+    @property
+    def meta_path(self):
+        return os.path.join(self.directory, self.META_FILE)
+
+    @property
+    def is_finalized(self):
+        return self.meta is not None
+
+    def column_path(self, column_idx: int, suffix: str):
+        return os.path.join(self.directory, f"{column_idx}.{suffix}")
+
+    # ---- Writing ---------------------------------------------------------
+
+    def __setitem__(self, id: int | str, value: object):
+        if self.is_finalized:
+            raise ValueError(f"ColumnarStorage at {self.directory} is immutable.")
+        self.pending.append((id, value))
+
+    @contextmanager
+    def transact(self):
+        """Rows set within the block are flushed to disk together on exit."""
+        yield self
+        self.flush()
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        values = [value for _, value in self.pending]
+        if self.handles is None:
+            self.init_schema(values)
+        if self.row_type == "dict":
+            # Fields that first appear in this batch are absent in earlier rows
+            names = []
+            for v in values:
+                names.extend(
+                    [k for k in v if k not in self.column_names and k not in names]
+                )
+            for name in names:
+                kind = self.infer_kind([v[name] for v in values if name in v])
+                self.add_column(name, kind or "object")
+
+        for column_idx, (name, kind) in enumerate(self.columns):
+            if self.row_type == "dict":
+                column = [v.get(name, MISSING) for v in values]
+            else:
+                column = values
+            new_kind = self.merge_kinds(
+                kind, self.infer_kind([v for v in column if v is not MISSING])
+            )
+            if new_kind != kind:
+                self.convert_column(column_idx, new_kind)
+            self.write_column(column_idx, new_kind, column)
+
+        self.written_keys.extend([id for id, _ in self.pending])
+        self.num_written += len(self.pending)
+        self.pending = []
+
+    def init_schema(self, values: list):
+        """Infer the row type and column kinds from the first batch of values."""
+        self.columns = []
+        self.column_names = set()
+        self.handles = {}
+        self.offsets = {}
+        if all(isinstance(v, dict) for v in values):
+            self.row_type = "dict"
+            names = []
+            for v in values:
+                names.extend([k for k in v if k not in names])
+            for name in names:
+                kind = self.infer_kind([v.get(name) for v in values if name in v])
+                self.add_column(name, kind or "object")
+        else:
+            self.row_type = "object"
+            self.add_column(self.VALUE_COLUMN, self.infer_kind(values) or "object")
+
+    def add_column(self, name: str, kind: str):
+        """Add a column, which is absent in the rows written so far."""
+        self.columns.append((name, kind))
+        self.column_names.add(name)
+        column_idx = len(self.columns) - 1
+        self.open_column(column_idx, kind)
+        if self.num_written > 0:
+            self.write_column(column_idx, kind, [MISSING] * self.num_written)
+
+    def open_column(self, column_idx: int, kind: str):
+        """Create the (empty) files of a column for writing."""
+        suffixes = ["state", "data"]
+        if kind in ["str", "object"]:
+            suffixes.append("offsets")
+        for suffix in suffixes:
+            self.handles[(column_idx, suffix)] = open(
+                self.column_path(column_idx, suffix), "wb"
+            )
+        if kind in ["str", "object"]:
+            self.handles[(column_idx, "offsets")].write(
+                np.zeros(1, dtype=np.int64).tobytes()
+            )
+        self.offsets[column_idx] = 0
+
+    def convert_column(self, column_idx: int, kind: str):
+        """
+        Rewrite the rows written so far to a column of a more general kind,
+        when a batch has values that do not fit its current kind.
+        """
+        name, old_kind = self.columns[column_idx]
+        for suffix in ["state", "data", "offsets"]:
+            handle = self.handles.pop((column_idx, suffix), None)
+            if handle is not None:
+                handle.close()
+        # Every kind has one entry per row, whatever the state of the row
+        state = np.fromfile(self.column_path(column_idx, "state"), dtype=np.int8)
+        if old_kind in ["int64", "float64"]:
+            entries = np.fromfile(self.column_path(column_idx, "data"), old_kind)
+            entries = entries.tolist()
+        else:
+            with open(self.column_path(column_idx, "data"), "rb") as f:
+                data = f.read()
+            offsets = np.fromfile(self.column_path(column_idx, "offsets"), np.int64)
+            entries = [data[start:end] for start, end in zip(offsets, offsets[1:])]
+        column = []
+        for s, entry in zip(state, entries):
+            if s == self.ABSENT:
+                column.append(MISSING)
+            elif s == self.NONE:
+                column.append(None)
+            elif old_kind == "str":
+                column.append(entry.decode("utf-8"))
+            elif old_kind == "object":
+                column.append(pickle.loads(entry))
+            else:
+                column.append(entry)
+        if os.path.exists(self.column_path(column_idx, "offsets")):
+            os.remove(self.column_path(column_idx, "offsets"))
+
+        self.columns[column_idx] = (name, kind)
+        self.open_column(column_idx, kind)
+        if len(column) > 0:
+            self.write_column(column_idx, kind, column)
+
+    @staticmethod
+    def merge_kinds(kind: str, other: str):
+        """Return the kind of a column holding values of both kinds."""
+        if other is None or kind == other:
+            return kind
+        if {kind, other} == {"int64", "float64"}:
+            return "float64"
+        return "object"
+
+    def infer_kind(self, values: list):
+        """Return the kind of column for values, or None if all are None."""
+        values = [v for v in values if v is not None]
+        if len(values) == 0:
+            return None
+        if all(isinstance(v, int) and not isinstance(v, bool) for v in values):
+            if all(INT64_MIN <= v <= INT64_MAX for v in values):
+                return "int64"
+            return "object"
+        if all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in values):
+            return "float64"
+        if all(isinstance(v, str) for v in values):
+            return "str"
+        return "object"
+
+    def write_column(self, column_idx: int, kind: str, column: list):
+        """Append a batch of values to the files of one column."""
+        state = np.full(len(column), self.PRESENT, dtype=np.int8)
+        for i, v in enumerate(column):
+            if v is MISSING:
+                state[i] = self.ABSENT
+            elif v is None:
+                state[i] = self.NONE
+        self.handles[(column_idx, "state")].write(state.tobytes())
+
+        if kind in ["int64", "float64"]:
+            allowed = int if kind == "int64" else (int, float)
+            present = [v for v, s in zip(column, state) if s == self.PRESENT]
+            if not all(
+                isinstance(v, allowed) and not isinstance(v, bool) for v in present
+            ):
+                raise ValueError(
+                    f"Column {self.columns[column_idx][0]} expects {kind} values."
+                )
+            data = np.array(
+                [v if s == self.PRESENT else 0 for v, s in zip(column, state)],
+                dtype=kind,
+            )
+            self.handles[(column_idx, "data")].write(data.tobytes())
+            return
+
+        chunks = []
+        for v, s in zip(column, state):
+            if s != self.PRESENT:
+                chunks.append(b"")
+            elif kind == "str":
+                if not isinstance(v, str):
+                    raise ValueError(
+                        f"Column {self.columns[column_idx][0]} expects str values."
+                    )
+                chunks.append(v.encode("utf-8"))
+            else:
+                chunks.append(pickle.dumps(v, protocol=pickle.HIGHEST_PROTOCOL))
+        ends = self.offsets[column_idx] + np.cumsum(
+            [len(c) for c in chunks], dtype=np.int64
+        )
+        self.offsets[column_idx] = int(ends[-1])
+        self.handles[(column_idx, "data")].write(b"".join(chunks))
+        self.handles[(column_idx, "offsets")].write(ends.tobytes())
+
+    def finalize(self):
+        """
+        Flush all pending rows, write the sorted id index and schema, then
+        reopen the storage in read-only, memory-mapped mode.
+        """
+        if self.is_finalized:
+            return
+        self.flush()
+        if self.handles is None:
+            self.row_type = "object"
+            self.columns = []
+        for handle in (self.handles or {}).values():
+            handle.close()
+        self.handles = None
+
+        keys = self.written_keys
+        if all(isinstance(k, (int, np.integer)) for k in keys):
+            key_dtype = "int64"
+            keys = np.array(keys, dtype=np.int64)
+        elif all(isinstance(k, str) for k in keys):
+            key_dtype = "str"
+            keys = np.array(keys, dtype=str)
+        else:
+            raise ValueError("ColumnarStorage ids must be either all int or all str.")
+
+        # Sort the ids, keeping only the last row written for duplicate ids
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        is_last = np.append(sorted_keys[1:] != sorted_keys[:-1], True)
+        np.save(os.path.join(self.directory, "keys.npy"), sorted_keys[is_last])
+        np.save(os.path.join(self.directory, "rows.npy"), order[is_last])
+
+        with open(self.meta_path, "w") as f:
+            json.dump(
+                {
+                    "num_rows": self.num_written,
+                    "row_type": self.row_type,
+                    "key_dtype": key_dtype,
+                    "columns": self.columns,
+                },
+                f,
+            )
+        self.written_keys = []
+        self.open()
+
+    # ---- Reading ---------------------------------------------------------
+
+    def open(self):
+        with open(self.meta_path) as f:
+            self.meta = json.load(f)
+        self.row_type = self.meta["row_type"]
+        self.columns = [tuple(c) for c in self.meta["columns"]]
+        num_rows = self.meta["num_rows"]
+        self.keys = np.load(os.path.join(self.directory, "keys.npy"), mmap_mode="r")
+        self.rows = np.load(os.path.join(self.directory, "rows.npy"), mmap_mode="r")
+        self.key_index = KeyIndex(self.keys)
+        self.states, self.data, self.column_offsets = [], [], []
+        for column_idx, (_, kind) in enumerate(self.columns):
+            self.states.append(
+                self.memmap(self.column_path(column_idx, "state"), np.int8)
+            )
+            if kind in ["int64", "float64"]:
+                self.data.append(
+                    self.memmap(self.column_path(column_idx, "data"), kind)
+                )
+                self.column_offsets.append(None)
+            else:
+                self.data.append(
+                    self.memmap(self.column_path(column_idx, "data"), np.uint8)
+                )
+                self.column_offsets.append(
+                    self.memmap(self.column_path(column_idx, "offsets"), np.int64)
+                )
+            assert len(self.states[-1]) == num_rows, "Corrupted ColumnarStorage."
+
+    def memmap(self, path: str, dtype):
+        if os.path.getsize(path) == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode="r")
+
+    def find_row(self, id: int | str):
+        """Return the row index of id, or None if id is not stored."""
+        row = self.find_rows([id])[0]
+        return None if row < 0 else int(row)
+
+    def find_rows(self, ids: list[int | str]):
+        """Return the row index of each id, or -1 where the id is not stored."""
+        positions = self.key_index.find(ids)
+        is_found = positions >= 0
+        rows = np.full(len(ids), -1, dtype=np.int64)
+        rows[is_found] = self.rows[positions[is_found]]
+        return rows
+
+    def load_column(self, column_idx: int, row: int):
+        kind = self.columns[column_idx][1]
+        state = self.states[column_idx][row]
+        if state == self.NONE:
+            return None
+        if kind in ["int64", "float64"]:
+            return self.data[column_idx][row].item()
+        offsets = self.column_offsets[column_idx]
+        buffer = self.data[column_idx][offsets[row] : offsets[row + 1]]
+        if kind == "str":
+            return buffer.tobytes().decode("utf-8")
+        return pickle.loads(buffer)
+
+    def get(self, id: int | str, default=None):
+        if not self.is_finalized:
+            raise ValueError("ColumnarStorage must be finalized before reading.")
+        row = self.find_row(id)
+        if row is None:
+            return default
+        return self.load_row(row)
+
+    def load_row(self, row: int):
+        if self.row_type == "object":
+            return self.load_column(0, row)
+        return {
+            name: self.load_column(column_idx, row)
+            for column_idx, (name, _) in enumerate(self.columns)
+            if self.states[column_idx][row] != self.ABSENT
+        }
+
+    def get_many(self, ids: list[int | str], default=None):
+        """
+        Return the list of values for ids, with default for missing ids. The
+        rows of all ids are looked up with a single vectorized searchsorted.
+        """
+        if not self.is_finalized:
+            raise ValueError("ColumnarStorage must be finalized before reading.")
+        rows = self.find_rows(ids)
+        return [default if row < 0 else self.load_row(row) for row in rows]
+
+    def __getitem__(self, id: int | str):
+        value = self.get(id, MISSING)
+        if value is MISSING:
+            raise KeyError(id)
+        return value
+
+    def __contains__(self, id: int | str):
+        return self.find_row(id) is not None
+
+    def __len__(self):
+        if not self.is_finalized:
+            return self.num_written + len(self.pending)
+        return len(self.keys)
+
+    def iterkeys(self):
+        return self.key_index.iterkeys()
+
+    def close(self):
+        for handle in (self.handles or {}).values():
+            handle.close()
+        self.handles = None
+
+
+class LayeredStorage:
+    """
+    A read-only, versioned view over a base storage and a list of delta
+    layers, from oldest to newest. Each delta layer is a DiskCache holding the
+    upserted values, plus a tombstones.json file listing the deleted ids.
+
+    The layers making up each version are listed in the MANIFEST.json file of
+    the db folder. A new version is published by writing its delta layer in
+    full and then atomically replacing the manifest, so readers either see
+    the previous version or the new one, never a partially written delta.
+    Readers keep the version that they opened until they are reopened.
+    """
+
+    MANIFEST_FILE = "MANIFEST.json"
+    TOMBSTONES_FILE = "tombstones.json"
+
+    def __init__(self, directory: str, storage: str = "diskcache") -> None:
+        self.directory = str(directory)
+        self.storage = storage
+        manifest = {"version": 0, "base": ".", "deltas": []}
+        if self.has_manifest(self.directory):
+            with open(os.path.join(self.directory, self.MANIFEST_FILE)) as f:
+                manifest = json.load(f)
+        self.version = manifest["version"]
+        self.base_path = manifest["base"]
+        self.delta_paths = manifest["deltas"]
+        self.base = open_base_storage(
+            storage, os.path.join(self.directory, self.base_path)
+        )
+        self.layers = []
+        for path in self.delta_paths:
+            layer = open_base_storage("diskcache", os.path.join(self.directory, path))
+            with open(os.path.join(layer.directory, self.TOMBSTONES_FILE)) as f:
+                tombstones = set(json.load(f))
+            self.layers.append((layer, tombstones))
+
+        # The latest state of each changed id: True if upserted, False if deleted
+        self.changes = {}
+        for layer, tombstones in self.layers:
+            for k in layer.iterkeys():
+                self.changes[k] = True
+            for k in tombstones:
+                self.changes[k] = False
+        self.num_base = len(self.base)
+        self.num_new, self.num_deleted = 0, 0
+        self.new_keys = []
+        for k, is_upserted in self.changes.items():
+            in_base = k in self.base
+            if is_upserted and not in_base:
+                self.new_keys.append(k)
+            elif not is_upserted and in_base:
+                self.num_deleted += 1
+
+    @classmethod
+    def has_manifest(cls, directory: str):
+        return os.path.exists(os.path.join(str(directory), cls.MANIFEST_FILE))
+
+    @property
+    def version_directory(self):
+        """The folder of the newest layer, where version specific files live."""
+        path = self.delta_paths[-1] if self.delta_paths else self.base_path
+        return os.path.join(self.directory, path)
+
+    def publish(self, base_path: str = None, delta_paths: list[str] = None):
+        """
+        Atomically publish a new version made up of base_path and delta_paths
+        (relative to the db folder), returning the storage for that version.
+        """
+        manifest = {
+            "version": self.version + 1,
+            "base": self.base_path if base_path is None else base_path,
+            "deltas": self.delta_paths if delta_paths is None else delta_paths,
+        }
+        path = os.path.join(self.directory, self.MANIFEST_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        return LayeredStorage(self.directory, self.storage)
+
+    def get(self, id: int | str, default=None):
+        return self.get_many([id], default)[0]
+
+    def get_many(self, ids: list[int | str], default=None):
+        values = [default] * len(ids)
+        unchanged = [i for i, id in enumerate(ids) if id not in self.changes]
+        for i, value in zip(
+            unchanged, self.base.get_many([ids[i] for i in unchanged], default)
+        ):
+            values[i] = value
+        upserted = [i for i, id in enumerate(ids) if self.changes.get(id) is True]
+        for layer, _ in reversed(self.layers):
+            if len(upserted) == 0:
+                break
+            found = layer.get_many([ids[i] for i in upserted], MISSING)
+            for i, value in zip(upserted, found):
+                if value is not MISSING:
+                    values[i] = value
+            upserted = [i for i, value in zip(upserted, found) if value is MISSING]
+        return values
+
+    def __getitem__(self, id: int | str):
+        value = self.get(id, MISSING)
+        if value is MISSING:
+            raise KeyError(id)
+        return value
+
+    def __contains__(self, id: int | str):
+        state = self.changes.get(id)
+        if state is None:
+            return id in self.base
+        return state
+
+    def __len__(self):
+        return self.num_base + len(self.new_keys) - self.num_deleted
+
+    def iterkeys(self):
+        for k in self.base.iterkeys():
+            if self.changes.get(k, True):
+                yield k
+        for k in self.new_keys:
+            yield k
+
+    def close(self):
+        self.base.close()
+        for layer, _ in self.layers:
+            layer.close()
@@ -8,3 +8,4 @@ from .encoders import (
     save_model,
     load_model,
 )
+from .embedding_cache import EmbeddingCache, encoder_fingerprint
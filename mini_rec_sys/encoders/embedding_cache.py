@@ -0,0 +1,253 @@
+"""
+A persistent cache of the embeddings of texts, so that texts that were
+already encoded by the same encoder (e.g. the passages of a catalog across
+evaluation runs) are looked up from disk instead of being encoded again.
+"""
+from __future__ import annotations
+import hashlib
+import json
+import os
+import numpy as np
+from torch import nn
+
+
+def text_hashes(texts: list[str]):
+    """Return a stable 64-bit hash of each text."""
+    return np.array(
+        [
+            int.from_bytes(
+                hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little"
+            )
+            for text in texts
+        ],
+        dtype=np.uint64,
+    )
+
+
+def encoder_fingerprint(encoder: nn.Module):
+    """
+    Return a hash of the config and weights of encoder, which changes
+    whenever the embeddings it produces may change.
+
+    Hashing the weights is expensive, so the fingerprint is stored on the
+    encoder and only recomputed when any of its tensors were modified since,
+    as tracked by their version counters.
+    """
+    tensors = list(encoder.state_dict(keep_vars=True).values())
+    versions = [(id(t), t._version) for t in tensors]
+    if getattr(encoder, "fingerprint_versions", None) == versions:
+        return encoder.fingerprint
+
+    digest = hashlib.blake2b(digest_size=16)
+    config = [
+        type(encoder).__name__,
+        getattr(encoder, "model_name", None),
+        getattr(encoder, "dim_embed", None),
+        getattr(encoder, "max_length", None),
+        getattr(encoder, "normalize", None),
+    ]
+    digest.update(json.dumps(config).encode("utf-8"))
+    for name, tensor in encoder.state_dict().items():
+        digest.update(name.encode("utf-8"))
+        digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    encoder.fingerprint = digest.hexdigest()
+    encoder.fingerprint_versions = versions
+    return encoder.fingerprint
+
+
+class EmbeddingCache:
+    """
+    Caches the embeddings of texts under directory, in a separate
+    EmbeddingStore for each encoder fingerprint, keyed by text_hashes.
+    Caches may be shared by processes, but only one process may write to the
+    cache of an encoder at a time.
+    """
+
+    def __init__(self, directory: str, max_unindexed: int = 100000) -> None:
+        """
+        max_unindexed: see EmbeddingStore.
+        """
+        self.directory = directory
+        self.max_unindexed = max_unindexed
+        self.stores = {}  # fingerprint -> EmbeddingStore
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def open_store(self, fingerprint: str):
+        if fingerprint not in self.stores:
+            self.stores[fingerprint] = EmbeddingStore(
+                os.path.join(self.directory, fingerprint), self.max_unindexed
+            )
+        return self.stores[fingerprint]
+
+    def get_or_encode(self, fingerprint: str, texts: list[str], encode_fn: callable):
+        """
+        Return the embeddings of texts by the encoder with fingerprint. Texts
+        that are not cached are encoded with encode_fn, which returns a
+        (len(texts), dim) array, and added to the cache.
+        """
+        store = self.open_store(fingerprint)
+        hashes = text_hashes(texts)
+        rows = store.find(hashes)
+        missing = np.flatnonzero(rows < 0)
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        if len(missing) == len(texts):
+            embed = encode_fn(texts)
+            store.append(hashes, embed)
+            return embed
+
+        embed = np.empty((len(texts), store.dim), dtype=np.float32)
+        is_found = rows >= 0
+        embed[is_found] = store.get(rows[is_found])
+        if len(missing) > 0:
+            missing_embed = encode_fn([texts[i] for i in missing])
+            store.append(hashes[missing], missing_embed)
+            embed[missing] = missing_embed
+        return embed
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+
+class EmbeddingStore:
+    """
+    Append-only float32 embeddings in directory, where row i belongs to the
+    i-th hash in the hash log. Both files are only appended to, embeddings
+    first, so that a crash never leaves a hash without its embedding. The
+    embeddings are memory mapped for reading.
+
+    Hashes are looked up in a sorted index of the first rows, saved as numpy
+    arrays, while the rows appended after the index was built are kept in a
+    dict. The index is rebuilt when more than max_unindexed rows are not in
+    the index.
+    """
+
+    CONFIG_FILE = "store.json"
+    EMBEDDINGS_FILE = "embeddings.f32"
+    HASHES_FILE = "hashes.u64"
+    INDEX_HASHES_FILE = "index_hashes.npy"
+    INDEX_ROWS_FILE = "index_rows.npy"
+
+    def __init__(self, directory: str, max_unindexed: int = 100000) -> None:
+        self.directory = directory
+        self.max_unindexed = max_unindexed
+        os.makedirs(directory, exist_ok=True)
+        self.dim = None
+        config_path = self.path(self.CONFIG_FILE)
+        if os.path.exists(config_path):
+            with open(config_path) as f:
+                self.dim = json.load(f)["dim"]
+
+        # Only count rows whose embedding and hash were both fully written
+        self.num_rows = 0
+        if self.dim is not None:
+            self.num_rows = min(
+                os.path.getsize(self.path(self.EMBEDDINGS_FILE)) // (4 * self.dim),
+                os.path.getsize(self.path(self.HASHES_FILE)) // 8,
+            )
+        self.embeddings = None  # Memory map of the first num_rows rows
+
+        self.index_hashes = np.zeros(0, dtype=np.uint64)
+        self.index_rows = np.zeros(0, dtype=np.int64)
+        if os.path.exists(self.path(self.INDEX_HASHES_FILE)):
+            self.index_hashes = np.load(
+                self.path(self.INDEX_HASHES_FILE), mmap_mode="r"
+            )
+            self.index_rows = np.load(self.path(self.INDEX_ROWS_FILE), mmap_mode="r")
+        if len(self.index_hashes) != len(self.index_rows):
+            # The index is being rebuilt by the writer, so do not use it
+            self.index_hashes = np.zeros(0, dtype=np.uint64)
+            self.index_rows = np.zeros(0, dtype=np.int64)
+        num_indexed = int(self.index_rows.max()) + 1 if len(self.index_rows) else 0
+        self.unindexed = {}  # hash -> row of rows after the index
+        hashes = self.read_hashes()
+        for row in range(num_indexed, self.num_rows):
+            self.unindexed[int(hashes[row])] = row
+
+    def path(self, filename: str):
+        return os.path.join(self.directory, filename)
+
+    def __len__(self):
+        return self.num_rows
+
+    def read_hashes(self):
+        if self.num_rows == 0:
+            return np.zeros(0, dtype=np.uint64)
+        return np.memmap(
+            self.path(self.HASHES_FILE),
+            dtype=np.uint64,
+            mode="r",
+            shape=(self.num_rows,),
+        )
+
+    def find(self, hashes: np.ndarray):
+        """Return the row of each hash, or -1 if not found."""
+        rows = np.full(len(hashes), -1, dtype=np.int64)
+        if len(self.index_hashes) > 0:
+            positions = np.minimum(
+                np.searchsorted(self.index_hashes, hashes), len(self.index_hashes) - 1
+            )
+            is_found = self.index_hashes[positions] == hashes
+            rows[is_found] = self.index_rows[positions[is_found]]
+        if self.unindexed:
+            for i in np.flatnonzero(rows < 0):
+                rows[i] = self.unindexed.get(int(hashes[i]), -1)
+        return rows
+
+    def get(self, rows: np.ndarray):
+        """Return the embeddings of rows."""
+        if self.embeddings is None or len(self.embeddings) != self.num_rows:
+            self.embeddings = np.memmap(
+                self.path(self.EMBEDDINGS_FILE),
+                dtype=np.float32,
+                mode="r",
+                shape=(self.num_rows, self.dim),
+            )
+        return np.asarray(self.embeddings[rows])
+
+    def append(self, hashes: np.ndarray, embeddings: np.ndarray):
+        """Append the embeddings of hashes, which are not in the store."""
+        if len(hashes) == 0:
+            return
+        if self.dim is None:
+            self.dim = embeddings.shape[1]
+            with open(self.path(self.CONFIG_FILE), "w") as f:
+                json.dump({"dim": self.dim}, f)
+        assert embeddings.shape[1] == self.dim, "Embedding dimension has changed."
+
+        # Truncate any partially written rows from an earlier crash
+        for filename, row_size in [
+            (self.EMBEDDINGS_FILE, 4 * self.dim),
+            (self.HASHES_FILE, 8),
+        ]:
+            with open(self.path(filename), "ab") as f:
+                f.truncate(self.num_rows * row_size)
+        with open(self.path(self.EMBEDDINGS_FILE), "ab") as f:
+            f.write(np.ascontiguousarray(embeddings, dtype=np.float32).tobytes())
+        with open(self.path(self.HASHES_FILE), "ab") as f:
+            f.write(np.ascontiguousarray(hashes, dtype=np.uint64).tobytes())
+        for row, hash in enumerate(hashes.tolist(), start=self.num_rows):
+            self.unindexed[hash] = row
+        self.num_rows += len(hashes)
+        if len(self.unindexed) > self.max_unindexed:
+            self.build_index()
+
+    def build_index(self):
+        """Rebuild the sorted index over all rows."""
+        hashes = self.read_hashes()
+        order = np.argsort(hashes, kind="stable")
+        self.index_hashes = np.asarray(hashes[order])
+        self.index_rows = order.astype(np.int64)
+        # Write to a temp file first, so that readers never see a partial file
+        for filename, array in [
+            (self.INDEX_ROWS_FILE, self.index_rows),
+            (self.INDEX_HASHES_FILE, self.index_hashes),
+        ]:
+            path = self.path(filename)
+            with open(path + ".tmp", "wb") as f:
+                np.save(f, array)
+            os.replace(path + ".tmp", path)
+        self.unindexed = {}
@@ -73,6 +73,7 @@ class BaseBertEncoder(nn.Module):
         self.max_length = max_length
         self.normalize = normalize
         self.device = device
+        self.reset_padding_stats()
 
         self.tokenizer = AutoTokenizer.from_pretrained(model_name)
         configuration = AutoConfig.from_pretrained(model_name)
@@ -104,8 +105,25 @@ class BaseBertEncoder(nn.Module):
             return_tensors="pt",
             max_length=self.max_length,
         )
+        mask = tokens["attention_mask"]
+        self.num_tokens += int(mask.sum())
+        self.num_padded_tokens += mask.numel()
         return tokens
 
+    @property
+    def padding_ratio(self):
+        """
+        Fraction of the token positions encoded so far that were padding.
+        Batches of texts with similar lengths have lower padding ratios.
+        """
+        if self.num_padded_tokens == 0:
+            return 0.0
+        return 1.0 - self.num_tokens / self.num_padded_tokens
+
+    def reset_padding_stats(self):
+        self.num_tokens = 0
+        self.num_padded_tokens = 0
+
 
 class BertEncoder(BaseBertEncoder):
     def __init__(self, *args, **kwargs) -> None:
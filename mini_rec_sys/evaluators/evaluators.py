@@ -66,8 +66,13 @@ class Evaluator:
         """
         assert self.dataset is not None, "Dataset must be provided to evaluate"
         metrics = []
+        # Evaluate on the full dataset even within a distributed process group
         sampler = BatchedSequentialSampler(
-            self.dataset, batch_size=self.batch_size, drop_last=False
+            self.dataset,
+            batch_size=self.batch_size,
+            drop_last=False,
+            rank=0,
+            world_size=1,
         )
         for batch in DataLoader(
             self.dataset, batch_sampler=sampler, collate_fn=lambda x: x
@@ -0,0 +1,234 @@
+from __future__ import annotations
+import json
+import math
+import os
+import faiss
+import numpy as np
+from tqdm import tqdm
+
+from mini_rec_sys.data.datasets import Dataset
+from mini_rec_sys.data.key_index import KeyIndex
+from mini_rec_sys.encoders import encoder_fingerprint
+from mini_rec_sys.scorers import DenseScorer
+from mini_rec_sys.utils import chunker
+from pdb import set_trace
+
+# faiss index_factory descriptions of the supported index types
+INDEX_TYPES = {
+    "flat": lambda nlist, hnsw_m: "Flat",
+    "ivf": lambda nlist, hnsw_m: f"IVF{nlist},Flat",
+    "hnsw": lambda nlist, hnsw_m: f"HNSW{hnsw_m},Flat",
+}
+
+
+class DenseRetriever:
+    """
+    Retrieves the top k items of a whole item catalog for a query, using the
+    encoders of a DenseScorer. The passage texts of the items are embedded
+    with the passage encoder into a faiss index, and queries embedded with the
+    query encoder are searched against it by inner product, which is the
+    score of DenseScorer.
+
+    The index may be:
+    - flat: exact search over all items
+    - ivf: items are clustered into nlist clusters, and only the items in the
+        nprobe clusters nearest to the query are searched
+    - hnsw: approximate search over a graph of the items with hnsw_m
+        neighbours each, exploring ef_search candidates per query
+    """
+
+    CONFIG_FILE = "dense.json"
+    INDEX_FILE = "index.faiss"
+    ITEM_IDS_FILE = "item_ids.npy"
+
+    def __init__(
+        self,
+        scorer: DenseScorer,
+        index_type: str = "flat",
+        nlist: int = None,
+        nprobe: int = 16,
+        hnsw_m: int = 32,
+        ef_search: int = 64,
+        build_batch_size: int = 10000,
+        train_size: int = 100000,
+    ) -> None:
+        """
+        scorer: its passage_text_key, encoders, batch_size and embedding cache
+            are used to embed the items and queries.
+        nlist: number of ivf clusters, 4 * sqrt(number of items) if None.
+        build_batch_size: number of items loaded and added at a time.
+        train_size: number of items the ivf clusters are trained on.
+        """
+        assert index_type in INDEX_TYPES, f"index_type must be in {list(INDEX_TYPES)}."
+        self.scorer = scorer
+        self.index_type = index_type
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.hnsw_m = hnsw_m
+        self.ef_search = ef_search
+        self.build_batch_size = build_batch_size
+        self.train_size = train_size
+        self.index = None
+        self.item_ids = None  # KeyIndex, the row of each item in the index
+        self.fingerprint = None  # Of the passage encoder of the index
+
+    def build(self, items: dict[str, dict] | Dataset):
+        """
+        Embed the passage texts of items, a dict of item id to item or an
+        ItemDataset, into a new index. Item ids must be either all int or all
+        str. Items are loaded and embedded build_batch_size at a time, so the
+        catalog need not fit in memory.
+        """
+        if isinstance(items, Dataset):
+            ids = list(items.iterkeys())
+            load_many = items.load_many
+        else:
+            ids = list(items)
+            load_many = lambda batch: [items[id] for id in batch]
+        assert len(ids) > 0, "No items to index."
+        if self.index_type == "ivf" and self.nlist is None:
+            self.nlist = max(1, min(int(4 * math.sqrt(len(ids))), len(ids) // 39))
+
+        self.index = None
+        # Items are indexed in the order of the KeyIndex, so that ids keep
+        # their int or str type through retrieve, save and load
+        self.item_ids = KeyIndex.from_keys(ids)
+        ids = list(self.item_ids.iterkeys())
+        self.fingerprint = encoder_fingerprint(self.scorer.p_encoder)
+        self.scorer.p_encoder.eval()
+        untrained = []  # Embeddings waiting for the ivf clusters to be trained
+        num_untrained = 0
+        for batch in tqdm(
+            chunker(ids, self.build_batch_size),
+            total=math.ceil(len(ids) / self.build_batch_size),
+            desc="Building index",
+        ):
+            texts = [self.get_text(item) for item in load_many(batch)]
+            embed = np.ascontiguousarray(
+                self.scorer.encode_passages(texts), dtype=np.float32
+            )
+            if self.index is None:
+                self.index = faiss.index_factory(
+                    embed.shape[1],
+                    INDEX_TYPES[self.index_type](self.nlist, self.hnsw_m),
+                    faiss.METRIC_INNER_PRODUCT,
+                )
+            if self.index.is_trained:
+                self.index.add(embed)
+                continue
+            untrained.append(embed)
+            num_untrained += len(embed)
+            if num_untrained >= self.train_size:
+                self.train(untrained)
+                untrained = []
+        if untrained:
+            self.train(untrained)
+        self.set_search_params()
+        print(f"Indexed {self.index.ntotal} items.")
+
+    def train(self, embeds: list[np.ndarray]):
+        embed = np.vstack(embeds)
+        print(f"Training {self.nlist} clusters on {len(embed)} items..")
+        self.index.train(embed[: self.train_size])
+        self.index.add(embed)
+
+    def get_text(self, item: dict):
+        if item is None:
+            return ""
+        text = item.get(self.scorer.passage_text_key, None)
+        return "" if text is None else text
+
+    def set_search_params(self):
+        """Apply nprobe or ef_search, which may be changed after building."""
+        if self.index_type == "ivf":
+            faiss.extract_index_ivf(self.index).nprobe = self.nprobe
+        elif self.index_type == "hnsw":
+            self.index.hnsw.efSearch = self.ef_search
+
+    def retrieve(
+        self, queries: str | list[str], k: int = 10, return_scores: bool = False
+    ):
+        """
+        Retrieve the ids of the k items with the highest scores for each
+        query, in descending order of score. If return_scores, also return
+        the scores. Queries are embedded and searched together in batches, so
+        pass a list of queries for throughput.
+
+        Returns a list of ids if queries is a single string, or a list of
+        lists of ids for a list of queries.
+        """
+        assert self.index is not None, "Call build or load first."
+        is_single = isinstance(queries, str)
+        if is_single:
+            queries = [queries]
+        ids, scores = [], []
+        if k > 0 and len(queries) > 0:
+            self.scorer.q_encoder.eval()
+            q_embed = np.ascontiguousarray(
+                self.scorer.encode(queries, self.scorer.q_encode), dtype=np.float32
+            )
+            D, I = self.index.search(q_embed, min(k, self.index.ntotal))
+            for row_scores, rows in zip(D, I):
+                is_found = rows >= 0  # faiss pads missing results with -1
+                ids.append(self.item_ids.keys[rows[is_found]].tolist())
+                scores.append(row_scores[is_found].tolist())
+        else:
+            ids, scores = [[] for _ in queries], [[] for _ in queries]
+
+        if is_single:
+            ids, scores = ids[0], scores[0]
+        if return_scores:
+            return ids, scores
+        return ids
+
+    def save(self, directory: str):
+        """Save the index, item ids and search parameters into directory."""
+        assert self.index is not None, "Call build first."
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, self.INDEX_FILE)
+        faiss.write_index(self.index, path + ".tmp")
+        os.replace(path + ".tmp", path)
+        path = os.path.join(directory, self.ITEM_IDS_FILE)
+        with open(path + ".tmp", "wb") as f:
+            np.save(f, self.item_ids.keys)
+        os.replace(path + ".tmp", path)
+
+        # Written last, so that a directory with a config holds a full index
+        config = {
+            "index_type": self.index_type,
+            "nlist": self.nlist,
+            "nprobe": self.nprobe,
+            "hnsw_m": self.hnsw_m,
+            "ef_search": self.ef_search,
+            "fingerprint": self.fingerprint,
+        }
+        path = os.path.join(directory, self.CONFIG_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump(config, f)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, directory: str, scorer: DenseScorer, mmap: bool = False):
+        """
+        Load a retriever saved in directory, using the encoders of scorer. If
+        mmap, the index is memory mapped instead of read into memory.
+        """
+        with open(os.path.join(directory, cls.CONFIG_FILE)) as f:
+            config = json.load(f)
+        fingerprint = config.pop("fingerprint")
+        retriever = cls(scorer, **config)
+        retriever.fingerprint = fingerprint
+        if encoder_fingerprint(scorer.p_encoder) != fingerprint:
+            print(
+                "Warning: the passage encoder has changed since the index was "
+                "built, rebuild the index to use the current encoder."
+            )
+        flags = faiss.IO_FLAG_MMAP if mmap else 0
+        retriever.index = faiss.read_index(
+            os.path.join(directory, cls.INDEX_FILE), flags
+        )
+        retriever.item_ids = KeyIndex(
+            np.load(os.path.join(directory, cls.ITEM_IDS_FILE))
+        )
+        retriever.set_search_params()
+        return retriever
@@ -0,0 +1 @@
+from .DenseRetriever import DenseRetriever
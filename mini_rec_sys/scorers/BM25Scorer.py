@@ -1,85 +1,112 @@
 from __future__ import annotations
 import math
-import re
+import json
+import os
 import numpy as np
-from collections import Counter
+import multiprocessing as mp
+from collections import deque
+from tqdm import tqdm
 from mini_rec_sys.scorers import BaseScorer
-from typing import Union
+from mini_rec_sys.analyzers import Analyzer, STOP_WORDS
+from mini_rec_sys.data.datasets import Dataset
+from mini_rec_sys.data.key_index import KeyIndex
+from mini_rec_sys.utils import chunker
+from typing import Iterable, Union
 from pdb import set_trace
 
-STOP_WORDS = [
-    "i",
-    "am",
-    "stop",
-    "the",
-    "to",
-    "and",
-    "a",
-    "in",
-    "it",
-    "is",
-    "I",
-    "that",
-    "had",
-    "on",
-    "for",
-    "were",
-    "was",
-]
 MIN_SCORE = -99999.0
 
 
 class BM25Scorer(BaseScorer):
     """
     A scorer model that trains a BM25F model on a set of item texts.
-    At test time, it scores documents on the fly by vectorizing them and
-    scoring similarity between query and item based on the BM25 text
-    similarity score.
+    At test time, it scores documents by scoring similarity between query and
+    item based on the BM25 text similarity score.
+
+    During training, an inverted index of the term frequencies and doclens of
+    each training document is built. Test documents that carry the id of a
+    training document under id_key are scored from the index, while other
+    documents are vectorized on the fly.
+
+    Training streams over the documents in batches, which may be tokenized in
+    parallel. Each batch produces BM25Stats that merge exactly into the
+    corpus statistics. Documents may later be added or removed, see
+    add_documents, remove_documents and compact.
     """
 
+    CONFIG_FILE = "bm25.json"
+
     def __init__(
         self,
         query_key: str,
         test_documents_key: str,
-        train_documents: dict[str, dict],
+        train_documents: dict[str, dict] | Iterable[tuple] | Dataset,
         fields: list[str],
         params: dict[str, object] = None,
         field_weights: dict[str, int] = None,
+        id_key: str = "item_id",
+        num_train_processes: int = 1,
+        train_batch_size: int = 10000,
+        index_documents: bool = True,
+        analyzer: Analyzer = None,
     ):
         """
         query_key: at test time, key containing the query
         test_documents_key: at test time, key containing the test documents
-        train_documents: training documents to train the model
+        train_documents: training documents to train the model, as a dict of
+            id to document, an iterable of (id, document) tuples or a Dataset.
+            If None, the model is not trained, e.g. to load a saved index.
         fields: fields in each document that will be used
         params: BM25 params
         field_weights: weight to place on each field for the BM25 score
+        id_key: at test time, key in each test document containing its id,
+            i.e. its key in train_documents. Test documents may also be given
+            as ids directly. Known documents are scored from the index, so
+            their fields at test time are ignored.
+        num_train_processes: if > 1, tokenize batches of training documents
+            in a pool of forked processes. Documents of a Dataset are then
+            also loaded in the worker processes.
+        train_batch_size: number of training documents per batch
+        index_documents: if False, only keep the corpus statistics (N, df,
+            field_doclens) and not the index of each training document, so
+            that memory does not grow with the number of documents. All test
+            documents are then vectorized on the fly.
+        analyzer: turns texts into terms, an Analyzer() by default. To skip
+            re-analyzing texts that are scored repeatedly, e.g. across
+            evaluations on the same catalog, pass Analyzer(cache_size=n).
         """
         super().__init__(cols=[query_key, test_documents_key])
         self.query_key = query_key
         self.test_documents_key = test_documents_key
+        self.id_key = id_key
+        self.num_train_processes = num_train_processes
+        self.train_batch_size = train_batch_size
+        self.index_documents = index_documents
         self.fields = fields if isinstance(fields, list) else [fields]
         self.set_field_weights(field_weights)
         self.set_params(params)
-        self.non_alphabets = re.compile(r"[^a-zA-Z\s]")
-        self.stop_words = set(STOP_WORDS)
+        self.analyzer = Analyzer() if analyzer is None else analyzer
 
-        # Initialize empty dicts for training
-        self.df = {}  # Document frequency of a term
-        self.field_doclens = {field: 0.0 for field in fields}
-        self.train(train_documents)
+        if train_documents is not None:
+            self.train(train_documents)
 
     def score(self, input_data: Union[dict, list[dict]]):
         if input_data is None:
             return None
         if isinstance(input_data, dict):
-            return self.score_single(input_data)
-        return [self.score_single(row) for row in input_data]
+            return self.score_batch([input_data])[0]
+        return self.score_batch(input_data)
 
     def score_single(self, row: dict):
-        """Generate score for one row of input_data."""
+        """
+        Generate score for one row of input_data, one document at a time from
+        the in-memory index. This is the reference implementation of the
+        BM25F score, which is not available for a loaded scorer.
+        """
+        assert self.postings is not None, "score_single requires a trained scorer."
         query = row[self.query_key]
         test_docs = row[self.test_documents_key]
-        qterms = list(set(self.doc_to_words(query)))
+        qterms = list(self.tokenize(query))
         matched_terms = [qterm for qterm in qterms if qterm in self.df.keys()]
         k1 = self.params["k1"]
 
@@ -90,10 +117,17 @@ class BM25Scorer(BaseScorer):
                 continue
 
             score = 0.0
-            doc_terms = {field: self.tokenize(doc[field]) for field in self.fields}
-            doc_lens = {
-                field: self.tf_to_doclen(doc_terms[field]) for field in self.fields
-            }
+            doc_id = self.get_doc_id(doc)
+            if doc_id is not None:
+                doc_terms, doc_lens = self.lookup_doc(doc_id, matched_terms)
+            elif not isinstance(doc, dict):  # Unknown id, nothing to score
+                scores.append(MIN_SCORE)
+                continue
+            else:
+                doc_terms = {field: self.tokenize(doc[field]) for field in self.fields}
+                doc_lens = {
+                    field: self.tf_to_doclen(doc_terms[field]) for field in self.fields
+                }
 
             for qterm in matched_terms:
                 tf_overall = 0.0
@@ -112,6 +146,530 @@ class BM25Scorer(BaseScorer):
             scores.append(score)
         return scores
 
+    def score_batch(self, rows: list[dict]):
+        """
+        Generate scores for a batch of rows with array operations, returning
+        the same scores as score_single (up to float rounding).
+
+        Each (query term, candidate document) pair of the batch becomes one
+        entry, whose term frequency in each field is looked up from sparse
+        term matrices: the precomputed matrices of the training documents, or
+        matrices of the unseen documents in the batch, which are tokenized on
+        the fly. BM25F saturation, field weights and idf are then applied to
+        all entries at once, and summed into the score of each pair.
+        """
+        if len(rows) == 0:
+            return []
+        if self.term_matrices is None:
+            self.build_term_matrices()
+
+        # Number the (row, candidate document) pairs across the batch, and
+        # find the row of each document in the known or new term matrices
+        qterms = [
+            list(terms)
+            for terms in self.analyzer.analyze_batch(
+                [row[self.query_key] for row in rows]
+            )
+        ]
+        qterm_ids = self.find_terms([t for terms in qterms for t in terms])
+        qterm_rows = np.repeat(np.arange(len(rows)), [len(t) for t in qterms])
+        row_terms = qterm_ids[qterm_ids >= 0]
+        num_terms = np.bincount(qterm_rows[qterm_ids >= 0], minlength=len(rows))
+        term_starts = np.cumsum(num_terms) - num_terms
+
+        docs = [doc for row in rows for doc in row[self.test_documents_key]]
+        num_pairs = len(docs)
+        is_dict = np.array([isinstance(doc, dict) for doc in docs], dtype=bool)
+        known_rows = self.find_docs(
+            [
+                doc.get(self.id_key, None) if isinstance(doc, dict) else doc
+                for doc in docs
+            ]
+        )
+        # None or unknown ids are not scored, and get MIN_SCORE below. Added
+        # documents are not in the term matrices, so are scored as new
+        # documents from their term frequencies.
+        num_base = len(self.doc_index)
+        is_new = ((known_rows < 0) & is_dict) | (known_rows >= num_base)
+        scored_pairs = np.flatnonzero((known_rows >= 0) | is_new)
+        new_positions = np.flatnonzero(is_new)
+
+        # Each unique new document, by its row if added or by its texts if
+        # unseen, is tokenized into one row of the new term matrices, however
+        # many pairs of the batch it appears in.
+        unique_rows = {}  # row or texts -> row in the new term matrices
+        unique_docs = []  # (position in docs, row) of each unique new document
+        new_doc_rows = np.empty(len(new_positions), dtype=np.int64)
+        for j, (i, row) in enumerate(
+            zip(new_positions.tolist(), known_rows[new_positions].tolist())
+        ):
+            key = row if row >= 0 else tuple(docs[i][field] for field in self.fields)
+            if key not in unique_rows:
+                unique_rows[key] = len(unique_docs)
+                unique_docs.append((i, row))
+            new_doc_rows[j] = unique_rows[key]
+        unseen_docs = [docs[i] for i, row in unique_docs if row < 0]
+        unseen_terms = {
+            field: iter(self.analyzer.analyze_batch([d[field] for d in unseen_docs]))
+            for field in self.fields
+        }
+        new_docs = [
+            (
+                self.delta_docs[row - num_base]
+                if row >= 0
+                else {field: next(unseen_terms[field]) for field in self.fields}
+            )
+            for _, row in unique_docs
+        ]
+        doc_rows = known_rows.copy()
+        doc_rows[new_positions] = new_doc_rows
+        doc_rows = doc_rows[scored_pairs]
+        is_new = is_new[scored_pairs]
+        pair_rows = np.repeat(
+            np.arange(len(rows)), [len(row[self.test_documents_key]) for row in rows]
+        )[scored_pairs]
+
+        # Expand into one entry per (pair, query term of the row of the pair)
+        term_counts = num_terms[pair_rows]
+        entry_starts = np.cumsum(term_counts) - term_counts
+        offsets = np.arange(term_counts.sum()) - np.repeat(entry_starts, term_counts)
+        term_ids = row_terms[np.repeat(term_starts[pair_rows], term_counts) + offsets]
+        pair_ids = np.repeat(scored_pairs, term_counts)
+        doc_rows = np.repeat(doc_rows, term_counts)
+        is_new = np.repeat(is_new, term_counts)
+
+        new_matrices = {
+            field: TermMatrix.from_tf_dicts(
+                [doc[field] for doc in new_docs],
+                self.find_terms,
+                len(self.df_array),
+                self.tf_to_doclen,
+            )
+            for field in self.fields
+        }
+
+        k1 = self.params["k1"]
+        tf_overall = np.zeros(len(pair_ids))
+        for field in self.fields:
+            tfs = np.zeros(len(pair_ids))
+            doclens = np.zeros(len(pair_ids))
+            for matrix, mask in [
+                (self.term_matrices[field], ~is_new),
+                (new_matrices[field], is_new),
+            ]:
+                tfs[mask] = matrix.lookup(doc_rows[mask], term_ids[mask])
+                doclens[mask] = matrix.doclens[doc_rows[mask]]
+            has_tf = tfs > 0
+            bf = self.params["b"][field]
+            doclen_term = (1 - bf) + bf * doclens[has_tf] / self.field_doclens[field]
+            tf_overall[has_tf] += self.field_weights[field] * tfs[has_tf] / doclen_term
+        contributions = self.idf[term_ids] * tf_overall / (k1 + tf_overall)
+        scores = np.bincount(pair_ids, weights=contributions, minlength=num_pairs)
+        is_scored = np.zeros(num_pairs, dtype=bool)
+        is_scored[scored_pairs] = True
+        scores[~is_scored] = MIN_SCORE
+
+        results = []
+        start = 0
+        for row in rows:
+            n = len(row[self.test_documents_key])
+            results.append(scores[start : start + n].tolist())
+            start += n
+        return results
+
+    def build_term_matrices(self):
+        """
+        Build the sorted vocabulary and training document ids, the idf and
+        the per field term matrices of the training documents from the index,
+        for score_batch. Terms and documents are numbered by their position in
+        the vocabulary and document index (see build_doc_index) respectively.
+        """
+        self.vocab = KeyIndex.from_keys(self.df)
+        df = np.array([self.df[term] for term in self.vocab.iterkeys()], dtype=np.int64)
+        self.set_idf(df)
+        self.doc_index = build_doc_index(list(self.doc_lens[self.fields[0]]))
+        doc_ids = list(self.doc_index.iterkeys())
+        self.term_matrices = {}
+        for field in self.fields:
+            terms, doc_ids_of_terms, tfs = [], [], []
+            for term, postings in self.postings[field].items():
+                terms.append(term)
+                doc_ids_of_terms.extend(postings)
+                tfs.extend(postings.values())
+            counts = [len(self.postings[field][term]) for term in terms]
+            doclens = np.array([self.doc_lens[field][d] for d in doc_ids])
+            self.term_matrices[field] = TermMatrix(
+                self.doc_index.find(doc_ids_of_terms),
+                np.repeat(self.vocab.find(terms), counts),
+                np.array(tfs, dtype=np.float64),
+                doclens,
+                len(self.vocab),
+            )
+        self.reset_changes()
+
+    def reset_changes(self):
+        """
+        Clear the documents added to or removed from the term matrices since
+        they were built, see add_documents and remove_documents.
+        """
+        self.is_removed = np.zeros(len(self.doc_index), dtype=bool)
+        self.delta_ids = []  # Ids of the added documents
+        self.delta_rows = {}  # id -> position in delta_ids
+        self.delta_docs = []  # field -> {term: tf} of added documents, or None
+        self.new_terms = {}  # term -> id of added terms not in the vocabulary
+
+    @property
+    def has_changes(self):
+        return len(self.delta_docs) > 0 or bool(self.is_removed.any())
+
+    def find_terms(self, terms: list[str], live_only: bool = True):
+        """
+        Return the id of each term, or -1 if not found. If live_only, terms
+        that no longer occur in any document are not found.
+        """
+        ids = self.vocab.find(terms)
+        if self.new_terms:
+            for i in np.flatnonzero(ids < 0):
+                ids[i] = self.new_terms.get(terms[i], -1)
+        if live_only:
+            is_absent = ids >= 0
+            is_absent[is_absent] = self.df_array[ids[is_absent]] == 0
+            ids[is_absent] = -1
+        return ids
+
+    def find_docs(self, ids: list[int | str]):
+        """
+        Return the row of each indexed document id, or -1 if not found. The
+        rows of added documents follow the rows of the term matrices.
+        """
+        rows = self.doc_index.find(ids)
+        is_removed = rows >= 0
+        is_removed[is_removed] = self.is_removed[rows[is_removed]]
+        rows[is_removed] = -1
+        if self.delta_rows:
+            for i in np.flatnonzero(rows < 0):
+                try:
+                    position = self.delta_rows.get(ids[i], None)
+                except TypeError:  # Unhashable id
+                    continue
+                if position is not None:
+                    rows[i] = len(self.doc_index) + position
+        return rows
+
+    def get_doc_ids(self, rows: np.ndarray):
+        """Return the document id of each row, as returned by find_docs."""
+        num_base = len(self.doc_index)
+        base_ids = iter(self.doc_index.keys[rows[rows < num_base]].tolist())
+        return [
+            next(base_ids) if row < num_base else self.delta_ids[row - num_base]
+            for row in rows.tolist()
+        ]
+
+    def get_doc_terms(self, row: int):
+        """Return the {term: tf} of each field of the document in row."""
+        num_base = len(self.doc_index)
+        if row >= num_base:
+            return self.delta_docs[row - num_base]
+        doc_terms = {}
+        for field in self.fields:
+            matrix = self.term_matrices[field]
+            start, end = np.searchsorted(
+                matrix.keys, [row * matrix.num_terms, (row + 1) * matrix.num_terms]
+            )
+            terms = matrix.keys[start:end] % matrix.num_terms
+            doc_terms[field] = dict(
+                zip(
+                    self.vocab.keys[terms].tolist(),
+                    matrix.tfs[start:end].astype(np.int64).tolist(),
+                )
+            )
+        return doc_terms
+
+    def get_entries(self, field: str):
+        """
+        Return the rows, term ids and term frequencies in field of all
+        indexed documents, including added documents.
+        """
+        matrix = self.term_matrices[field]
+        rows, terms = np.divmod(matrix.keys, max(matrix.num_terms, 1))
+        is_kept = ~self.is_removed[rows]
+        rows, terms, tfs = [rows[is_kept]], [terms[is_kept]], [matrix.tfs[is_kept]]
+        positions = [i for i, doc in enumerate(self.delta_docs) if doc is not None]
+        tf_dicts = [self.delta_docs[i][field] for i in positions]
+        rows.append(
+            np.repeat(
+                len(self.doc_index) + np.array(positions, dtype=np.int64),
+                [len(tf_dict) for tf_dict in tf_dicts],
+            )
+        )
+        terms.append(
+            self.find_terms([t for tf_dict in tf_dicts for t in tf_dict], False)
+        )
+        tfs.append(
+            np.array(
+                [tf for tf_dict in tf_dicts for tf in tf_dict.values()],
+                dtype=np.float64,
+            )
+        )
+        return np.concatenate(rows), np.concatenate(terms), np.concatenate(tfs)
+
+    def get_doclens(self, field: str):
+        """Return the doclen in field of each row, including added documents."""
+        delta_doclens = [
+            0.0 if doc is None else self.tf_to_doclen(doc[field])
+            for doc in self.delta_docs
+        ]
+        return np.concatenate(
+            [self.term_matrices[field].doclens, np.array(delta_doclens)]
+        )
+
+    def add_documents(self, documents: dict[str, dict] | Iterable[tuple] | Dataset):
+        """
+        Add documents, given as for train, to the corpus statistics and index.
+        Documents with the id of an indexed document replace it.
+
+        The added documents are kept alongside the term matrices until
+        compact, so that adding documents takes time proportional to their
+        number. Without index_documents, only the corpus statistics are
+        updated.
+        """
+        if self.term_matrices is None:
+            self.build_term_matrices()
+        stats = self.compute_stats(documents)
+        if self.index_documents:
+            ids = list(stats.doc_lens[self.fields[0]])
+            self.remove_documents(ids)
+            doc_terms = {doc_id: {field: {} for field in self.fields} for doc_id in ids}
+            for field in self.fields:
+                for term, postings in stats.postings[field].items():
+                    for doc_id, tf in postings.items():
+                        doc_terms[doc_id][field][term] = tf
+            for doc_id in ids:
+                self.delta_rows[doc_id] = len(self.delta_ids)
+                self.delta_ids.append(doc_id)
+                self.delta_docs.append(doc_terms[doc_id])
+        self.update_stats(stats, sign=1)
+        print(f"Added {stats.N} documents.")
+
+    def remove_documents(self, ids: list[int | str]):
+        """
+        Remove the indexed documents with ids from the corpus statistics and
+        index, ignoring ids that are not indexed. Their statistics are
+        recovered from the index, so this takes time proportional to the
+        number of ids. Removed documents are only marked as removed in the
+        term matrices until compact.
+        """
+        assert self.index_documents, "remove_documents requires index_documents=True."
+        if self.term_matrices is None:
+            self.build_term_matrices()
+        ids = list(dict.fromkeys(ids))
+        num_base = len(self.doc_index)
+        stats = BM25Stats(self.fields)
+        for doc_id, row in zip(ids, self.find_docs(ids).tolist()):
+            if row < 0:
+                continue
+            stats.add_terms(doc_id, self.get_doc_terms(row), self)
+            if row < num_base:
+                self.is_removed[row] = True
+            else:
+                self.delta_docs[row - num_base] = None
+                del self.delta_rows[doc_id]
+        if stats.N > 0:
+            self.update_stats(stats, sign=-1)
+            print(f"Removed {stats.N} documents.")
+
+    def update_stats(self, stats: BM25Stats, sign: int):
+        """
+        Add (sign=1) or subtract (sign=-1) the statistics of a set of
+        documents to the corpus statistics, and to the in-memory index if any.
+        """
+        terms = list(stats.df)
+        term_ids = self.find_terms(terms, live_only=False)
+        for i in np.flatnonzero(term_ids < 0):
+            term_ids[i] = len(self.vocab) + len(self.new_terms)
+            self.new_terms[terms[i]] = term_ids[i]
+        df = np.zeros(len(self.vocab) + len(self.new_terms), dtype=np.int64)
+        df[: len(self.df_array)] = self.df_array
+        df[term_ids] += sign * np.array([stats.df[t] for t in terms], dtype=np.int64)
+        self.N += sign * stats.N
+        for field in self.fields:
+            self.doclen_sums[field] += sign * stats.doclen_sums[field]
+        self.set_field_doclens()
+        self.set_idf(df)
+        if self.stats is not None:
+            if sign > 0:
+                self.stats.merge(stats)
+            else:
+                self.stats.subtract(stats)
+        self.impact_index = None  # Impacts depend on N and the doclens
+
+    def compact(self):
+        """
+        Rebuild the term matrices with the added documents, and without the
+        removed documents and the terms that no longer occur, so that the
+        index stays tight. Takes time proportional to the size of the index.
+        """
+        if self.term_matrices is None or not self.has_changes:
+            return
+        num_base = len(self.doc_index)
+        kept_rows = np.flatnonzero(~self.is_removed)
+        positions = [i for i, doc in enumerate(self.delta_docs) if doc is not None]
+        ids = self.doc_index.keys[kept_rows].tolist()
+        ids += [self.delta_ids[i] for i in positions]
+        doc_index = build_doc_index(ids)
+        old_rows = np.concatenate(
+            [kept_rows, num_base + np.array(positions, dtype=np.int64)]
+        )
+        doc_order = np.argsort(doc_index.find(ids), kind="stable")
+        row_map = np.full(num_base + len(self.delta_docs), -1, dtype=np.int64)
+        row_map[old_rows[doc_order]] = np.arange(len(doc_order))
+
+        all_terms = np.concatenate(
+            [self.vocab.keys.astype(str), np.array(list(self.new_terms), dtype=str)]
+        )
+        live_terms = np.flatnonzero(self.df_array > 0)
+        term_order = np.argsort(all_terms[live_terms], kind="stable")
+        term_map = np.full(len(all_terms), -1, dtype=np.int64)
+        term_map[live_terms[term_order]] = np.arange(len(live_terms))
+
+        term_matrices = {}
+        for field in self.fields:
+            rows, terms, tfs = self.get_entries(field)
+            term_matrices[field] = TermMatrix(
+                row_map[rows],
+                term_map[terms],
+                tfs,
+                self.get_doclens(field)[old_rows[doc_order]],
+                len(live_terms),
+            )
+        self.vocab = KeyIndex(all_terms[live_terms[term_order]])
+        self.doc_index = doc_index
+        self.term_matrices = term_matrices
+        self.set_idf(self.df_array[live_terms[term_order]])
+        self.reset_changes()
+        self.impact_index = None
+
+    def set_idf(self, df: np.ndarray):
+        """Set the document frequency and idf of each term of the vocabulary."""
+        self.df_array = df
+        df = df.astype(np.float64)
+        self.idf = np.log(1 + (self.N - df + 0.5) / (df + 0.5))
+
+    def retrieve(self, query: str, k: int = 10, return_scores: bool = False):
+        """
+        Retrieve the ids of the k training documents with the highest BM25F
+        scores for query, in descending order of score. If return_scores,
+        also return the scores. Scores are the same as score_single.
+
+        As the BM25F score of a document is a sum over query terms of an
+        impact that only depends on the term and the document, impacts are
+        precomputed into postings ordered by impact (see ImpactIndex). To
+        avoid scoring every document that contains a query term, we:
+        1. Score the top k documents of each query term exactly, and take
+            the k-th best score as the threshold theta.
+        2. Order the query terms by descending upper bound. A document can
+            only beat theta if, for the first of these terms that it contains,
+            its impact is at least theta minus the upper bounds of the later
+            terms. These documents are a prefix of the impact ordered
+            postings of the term, so only the prefixes are scored exactly.
+        3. Score the terms in that order, raising theta after each term, so
+            that the prefixes of later terms are shorter. The last terms have
+            the smallest upper bounds and usually the longest postings, and
+            are skipped entirely once their bounds cannot reach theta, as in
+            MaxScore.
+        """
+        assert self.index_documents, "retrieve requires index_documents=True."
+        if self.term_matrices is None:
+            self.build_term_matrices()
+        if self.impact_index is None:
+            self.build_impact_index()
+        index = self.impact_index
+        terms = self.find_terms(list(self.tokenize(query)))
+        terms = terms[terms >= 0]
+        if len(terms) == 0 or k <= 0:
+            return ([], []) if return_scores else []
+
+        candidates = np.unique(np.concatenate([index.top_docs(t, k) for t in terms]))
+        scores = index.score_docs(terms, candidates)
+        if len(scores) >= k:
+            terms = terms[np.argsort(-index.upper_bounds[terms], kind="stable")]
+            upper_bounds = index.upper_bounds[terms]
+            later_bounds = upper_bounds.sum() - np.cumsum(upper_bounds)
+            theta = np.partition(scores, len(scores) - k)[len(scores) - k]
+            for term, bound, later_bound in zip(terms, upper_bounds, later_bounds):
+                min_impact = theta - later_bound - 1e-9
+                if bound < min_impact:
+                    continue
+                docs = np.setdiff1d(
+                    index.docs_above(term, min_impact), candidates, assume_unique=True
+                )
+                if len(docs) == 0:
+                    continue
+                candidates = np.concatenate([candidates, docs])
+                scores = np.concatenate([scores, index.score_docs(terms, docs)])
+                theta = np.partition(scores, len(scores) - k)[len(scores) - k]
+            # Break ties by document, as for exhaustive scoring
+            order = np.argsort(candidates)
+            candidates, scores = candidates[order], scores[order]
+
+        top = np.argpartition(-scores, min(k, len(scores)) - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        ids = self.get_doc_ids(candidates[top])
+        if return_scores:
+            return ids, scores[top].tolist()
+        return ids
+
+    def build_impact_index(self):
+        """
+        Precompute the impact of each term on the score of each training
+        document, idf * tf_overall / (k1 + tf_overall), from the term matrices
+        and the added documents.
+        """
+        num_terms = len(self.df_array)
+        num_docs = len(self.doc_index) + len(self.delta_docs)
+        keys, contributions = [], []
+        for field in self.fields:
+            rows, terms, tfs = self.get_entries(field)
+            doclens = self.get_doclens(field)[rows]
+            bf = self.params["b"][field]
+            doclen_term = (1 - bf) + bf * doclens / self.field_doclens[field]
+            keys.append(terms * num_docs + rows)
+            contributions.append(self.field_weights[field] * tfs / doclen_term)
+        keys, inverse = np.unique(np.concatenate(keys), return_inverse=True)
+        tf_overall = np.bincount(inverse, weights=np.concatenate(contributions))
+        terms = keys // num_docs
+        impacts = self.idf[terms] * tf_overall / (self.params["k1"] + tf_overall)
+        self.impact_index = ImpactIndex(terms, keys % num_docs, impacts, num_terms)
+
+    def get_doc_id(self, doc: dict | int | str):
+        """Return the id of doc if it is a training document, else None."""
+        if isinstance(doc, dict):
+            doc_id = doc.get(self.id_key, None)
+        else:
+            doc_id = doc
+        try:
+            if doc_id in self.doc_lens[self.fields[0]]:
+                return doc_id
+        except TypeError:  # Unhashable id
+            pass
+        return None
+
+    def lookup_doc(self, doc_id: int | str, terms: list[str]):
+        """
+        Return the term frequencies of terms and the doclens of training
+        document doc_id from the index, in the same form as for tokenized
+        documents.
+        """
+        doc_terms = {field: {} for field in self.fields}
+        for field in self.fields:
+            postings = self.postings[field]
+            for term in terms:
+                tf = postings.get(term, {}).get(doc_id, None)
+                if tf is not None:
+                    doc_terms[field][term] = tf
+        doc_lens = {field: self.doc_lens[field][doc_id] for field in self.fields}
+        return doc_terms, doc_lens
+
     def tf_to_doclen(self, tf_dict: dict[str, int]):
         """
         Transform a dict of {term: term_frequency} into bm25 doclen.
@@ -123,60 +681,201 @@ class BM25Scorer(BaseScorer):
 
     def tokenize(self, text):
         """
-        Use fitted values to transform a text into a dict of term to tf.
+        Use the analyzer to transform a text into a dict of term to tf.
         """
-        text = self.doc_to_words(text)
-        terms = {}
-        for word, tf in Counter(text).items():
-            terms[word] = tf
-        return terms
+        return self.analyzer.term_counts(text)
 
     def doc_to_words(self, text):
         """
-        Tokenizes a text into term tokens. Removes all html tags <xxx>, and keeps only alphabets.
+        Use the analyzer to tokenize a text into term tokens.
         """
-        if (text is None) or (text == ""):
-            return []
+        return self.analyzer.words(text)
 
-        text = re.sub("<[^<]+?>", "", text)  # Remove all html tags like <xx>
-        text = text.replace("/", " ")  # Replace / with space
-        text = text.replace("\n", " ")  # Replace \n with space
-        text = text.replace("-", " ")  # Replace - with space
-        text = re.sub(self.non_alphabets, "", text)
-        text = text.lower()
-        return [w for w in text.split() if not w in self.stop_words]
-
-    def train(self, documents):
+    def train(self, documents: dict[str, dict] | Iterable[tuple] | Dataset):
         """
         Compute and store term/document data, then build the inverted_list.
         """
-        self.N = len(documents)
-
-        for _, d in documents.items():
-            word_set = set()
+        self.set_stats(self.compute_stats(documents))
+        print(f"Processed {self.N} documents.")
 
-            for field in self.fields:
-                doclen_score = 0.0
-                text = d[field]
-                words = self.doc_to_words(text)
-                for word, tf in Counter(words).items():
-                    doclen_score += math.pow(math.log(tf) + 1, 2)
-                    word_set.add(word)
+    def compute_stats(self, documents: dict[str, dict] | Iterable[tuple] | Dataset):
+        """
+        Stream over documents in batches of self.train_batch_size and return
+        the merged BM25Stats of all batches. If self.num_train_processes > 1,
+        batches are tokenized in a pool of forked worker processes, with at
+        most 2 batches per worker in flight at any time to keep memory bounded.
+        """
+        stats = BM25Stats(self.fields)
+        if isinstance(documents, Dataset):
+            # Only the keys are batched, the documents are loaded by workers
+            batches = chunker(tqdm(documents.iterkeys()), self.train_batch_size)
+        else:
+            if isinstance(documents, dict):
+                documents = documents.items()
+            batches = chunker(tqdm(documents), self.train_batch_size)
 
-                doclen_score = math.sqrt(doclen_score)
-                self.field_doclens[field] += doclen_score
+        if self.num_train_processes > 1:
+            assert (
+                "fork" in mp.get_all_start_methods()
+            ), "num_train_processes > 1 requires the fork start method."
+            with mp.get_context("fork").Pool(
+                self.num_train_processes,
+                initializer=init_train_worker,
+                initargs=(self, documents),
+            ) as pool:
+                in_flight = deque()
+                for batch in batches:
+                    in_flight.append(
+                        pool.apply_async(compute_stats_in_worker, (batch,))
+                    )
+                    if len(in_flight) >= 2 * self.num_train_processes:
+                        stats.merge(in_flight.popleft().get())
+                while in_flight:
+                    stats.merge(in_flight.popleft().get())
+        else:
+            for batch in batches:
+                stats.merge(self.compute_batch_stats(batch, documents))
+        return stats
 
-            if len(word_set) == 0:
-                continue
+    def compute_batch_stats(
+        self, batch: list, documents: dict[str, dict] | Iterable[tuple] | Dataset
+    ):
+        """
+        Return the BM25Stats of a batch of (id, document) tuples, or of a
+        batch of ids if documents is a Dataset.
+        """
+        if isinstance(documents, Dataset):
+            batch = zip(batch, documents.load_many(batch))
+        batch = list(batch)
+        field_terms = {
+            field: self.analyzer.analyze_batch([d[field] for _, d in batch])
+            for field in self.fields
+        }
+        stats = BM25Stats(self.fields)
+        for i, (doc_id, _) in enumerate(batch):
+            doc_terms = {field: field_terms[field][i] for field in self.fields}
+            stats.add_terms(doc_id, doc_terms, self)
+        return stats
 
-            # Add to document frequency
-            for w in word_set:
-                self.df[w] = self.df.get(w, 0) + 1
+    def set_stats(self, stats: BM25Stats):
+        """
+        Set the corpus statistics and index used for scoring from stats, e.g.
+        the merged BM25Stats of shards of the corpus computed separately.
+        """
+        self.stats = stats
+        self.N = stats.N
+        self.df = stats.df  # Document frequency of a term
+        self.doclen_sums = dict(stats.doclen_sums)
+        self.set_field_doclens()
+        self.postings = stats.postings  # field -> term -> {id: tf}
+        self.doc_lens = stats.doc_lens  # field -> id -> doclen
+        self.term_matrices = None  # Built on first use by score_batch
+        self.impact_index = None  # Built on first use by retrieve
 
+    def set_field_doclens(self):
         # Average the field doclens
-        for field in self.fields:
-            self.field_doclens[field] /= self.N
-        print(f"Processed {self.N} documents.")
+        self.field_doclens = {
+            field: total / max(self.N, 1) for field, total in self.doclen_sums.items()
+        }
+
+    def save(self, directory: str):
+        """
+        Save the vocabulary, df, field doclens, params and, if the training
+        documents are indexed, the term matrices and impact index into
+        directory as numpy arrays, which load memory maps. Added and removed
+        documents are compacted into the term matrices first.
+        """
+        if self.term_matrices is None:
+            self.build_term_matrices()
+        self.compact()
+        if self.index_documents and self.impact_index is None:
+            self.build_impact_index()
+        os.makedirs(directory, exist_ok=True)
+        save_array(directory, "vocab.npy", self.vocab.keys)
+        save_array(directory, "df.npy", self.df_array)
+        save_array(directory, "doc_ids.npy", self.doc_index.keys)
+        for i, field in enumerate(self.fields):
+            self.term_matrices[field].save(directory, f"field_{i}_")
+        if self.impact_index is not None:
+            self.impact_index.save(directory, "impact_")
+
+        # Written last, so that a directory with a config holds a full index
+        config = {
+            "query_key": self.query_key,
+            "test_documents_key": self.test_documents_key,
+            "fields": self.fields,
+            "params": self.params,
+            "field_weights": self.field_weights,
+            "id_key": self.id_key,
+            "index_documents": self.index_documents,
+            "N": self.N,
+            "field_doclens": self.field_doclens,
+            "analyzer": self.analyzer.get_config(),
+            "has_preprocess_fn": self.analyzer.preprocess_fn is not None,
+            "pickled_doc_ids": isinstance(self.doc_index, DocIdIndex),
+        }
+        path = os.path.join(directory, self.CONFIG_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump(config, f)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, directory: str, mmap: bool = True, analyzer: Analyzer = None):
+        """
+        Load a scorer saved in directory. If mmap, the arrays are memory
+        mapped, so that processes loading the same index share its memory
+        and startup does not depend on the size of the index. If analyzer is
+        None, an Analyzer with the saved config is used. As functions are not
+        saved, the analyzer must be passed if it had a preprocess_fn.
+
+        A loaded scorer has no in-memory index, so it scores with score_batch.
+        """
+        with open(os.path.join(directory, cls.CONFIG_FILE)) as f:
+            config = json.load(f)
+        if analyzer is None and config.get("has_preprocess_fn", False):
+            raise ValueError(
+                "The index was built with an analyzer with a preprocess_fn, "
+                "pass the same analyzer to load."
+            )
+        scorer = cls(
+            query_key=config["query_key"],
+            test_documents_key=config["test_documents_key"],
+            train_documents=None,
+            fields=config["fields"],
+            params=config["params"],
+            field_weights=config["field_weights"],
+            id_key=config["id_key"],
+            index_documents=config["index_documents"],
+            analyzer=Analyzer(**config["analyzer"]) if analyzer is None else analyzer,
+        )
+        mmap_mode = "r" if mmap else None
+        scorer.N = config["N"]
+        scorer.field_doclens = config["field_doclens"]
+        scorer.doclen_sums = {
+            field: doclen * scorer.N for field, doclen in scorer.field_doclens.items()
+        }
+        # There is no in-memory index, only the arrays
+        scorer.stats, scorer.df = None, None
+        scorer.postings, scorer.doc_lens = None, None
+        scorer.vocab = KeyIndex(load_array(directory, "vocab.npy", mmap_mode))
+        scorer.set_idf(load_array(directory, "df.npy", mmap_mode))
+        if config.get("pickled_doc_ids", False):
+            doc_ids = np.load(os.path.join(directory, "doc_ids.npy"), allow_pickle=True)
+            scorer.doc_index = DocIdIndex(doc_ids)
+        else:
+            doc_ids = load_array(directory, "doc_ids.npy", mmap_mode)
+            scorer.doc_index = KeyIndex(doc_ids)
+        scorer.term_matrices = {
+            field: TermMatrix.load(
+                directory, f"field_{i}_", len(scorer.vocab), mmap_mode
+            )
+            for i, field in enumerate(scorer.fields)
+        }
+        scorer.impact_index = None
+        if scorer.index_documents:
+            scorer.impact_index = ImpactIndex.load(directory, "impact_", mmap_mode)
+        scorer.reset_changes()
+        return scorer
 
     def set_params(self, d: dict = None):
         """Params for BM25F search"""
@@ -199,3 +898,293 @@ class BM25Scorer(BaseScorer):
             for field in self.fields:
                 assert field in d
         self.field_weights = d
+
+
+class BM25Stats:
+    """
+    Statistics of a set of training documents for BM25Scorer: the number of
+    documents N, the document frequency of each term, the sum of the doclen
+    scores of each field and, if indexed, the term frequencies and doclens of
+    each document.
+
+    Statistics of disjoint sets of documents merge exactly, so they may be
+    computed for shards of a corpus in parallel.
+    """
+
+    def __init__(self, fields: list[str]) -> None:
+        self.N = 0
+        self.df = {}
+        self.doclen_sums = {field: 0.0 for field in fields}
+        self.postings = {field: {} for field in fields}  # term -> {id: tf}
+        self.doc_lens = {field: {} for field in fields}  # id -> doclen
+
+    def add_terms(
+        self, doc_id: int | str, doc_terms: dict[str, dict], scorer: BM25Scorer
+    ):
+        """Add a document, given the {term: tf} of each of scorer.fields."""
+        self.N += 1
+        word_set = set()
+        for field in scorer.fields:
+            doclen_score = 0.0
+            terms = doc_terms[field]
+            for word, tf in terms.items():
+                doclen_score += math.pow(math.log(tf) + 1, 2)
+                word_set.add(word)
+                if scorer.index_documents:
+                    self.postings[field].setdefault(word, {})[doc_id] = tf
+            if scorer.index_documents:
+                # Matches the doclen of a document tokenized at test time
+                self.doc_lens[field][doc_id] = scorer.tf_to_doclen(terms)
+            self.doclen_sums[field] += math.sqrt(doclen_score)
+
+        # Add to document frequency
+        for w in word_set:
+            self.df[w] = self.df.get(w, 0) + 1
+
+    def merge(self, other: BM25Stats):
+        """Merge the statistics of a disjoint set of documents into self."""
+        self.N += other.N
+        for w, df in other.df.items():
+            self.df[w] = self.df.get(w, 0) + df
+        for field, total in other.doclen_sums.items():
+            self.doclen_sums[field] += total
+            for term, postings in other.postings[field].items():
+                self.postings[field].setdefault(term, {}).update(postings)
+            self.doc_lens[field].update(other.doc_lens[field])
+        return self
+
+    def subtract(self, other: BM25Stats):
+        """Remove the statistics of a subset of the documents from self."""
+        self.N -= other.N
+        for w, df in other.df.items():
+            self.df[w] -= df
+            if self.df[w] == 0:
+                del self.df[w]
+        for field, total in other.doclen_sums.items():
+            self.doclen_sums[field] -= total
+            for term, postings in other.postings[field].items():
+                term_postings = self.postings[field][term]
+                for doc_id in postings:
+                    del term_postings[doc_id]
+                if len(term_postings) == 0:
+                    del self.postings[field][term]
+            for doc_id in other.doc_lens[field]:
+                del self.doc_lens[field][doc_id]
+        return self
+
+
+def save_array(directory: str, filename: str, array: np.ndarray):
+    # Write to a temp file first, so that readers never see a partial file
+    path = os.path.join(directory, filename)
+    with open(path + ".tmp", "wb") as f:
+        np.save(f, array)
+    os.replace(path + ".tmp", path)
+
+
+def load_array(directory: str, filename: str, mmap_mode: str = None):
+    return np.load(os.path.join(directory, filename), mmap_mode=mmap_mode)
+
+
+# The BM25Scorer being trained and its training documents, inherited by forked
+# training workers so that they do not need to be pickled.
+TRAIN_SCORER = None
+TRAIN_DOCUMENTS = None
+
+
+def init_train_worker(scorer: BM25Scorer, documents: dict | Iterable | Dataset):
+    global TRAIN_SCORER, TRAIN_DOCUMENTS
+    TRAIN_SCORER, TRAIN_DOCUMENTS = scorer, documents
+
+
+def compute_stats_in_worker(batch: list):
+    return TRAIN_SCORER.compute_batch_stats(batch, TRAIN_DOCUMENTS)
+
+
+def build_doc_index(ids: list):
+    """
+    Return a KeyIndex over document ids, or a DocIdIndex if they cannot be
+    held in a KeyIndex (e.g. mixed int and str ids, or tuple ids).
+    """
+    try:
+        return KeyIndex.from_keys(ids)
+    except ValueError:
+        keys = np.empty(len(ids), dtype=object)
+        for i, id in enumerate(ids):
+            keys[i] = id
+        return DocIdIndex(keys)
+
+
+class DocIdIndex:
+    """
+    An index over any hashable document ids, in the same order as keys,
+    which finds the position of each id with a dict. It supports the parts
+    of the KeyIndex interface used by BM25Scorer, but is slower to look up
+    and its ids are pickled when saved.
+    """
+
+    def __init__(self, keys: np.ndarray) -> None:
+        """keys: object array of unique ids"""
+        self.keys = keys
+        self.positions = {id: i for i, id in enumerate(keys.tolist())}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def iterkeys(self):
+        return iter(self.keys.tolist())
+
+    def find(self, ids: list):
+        """Return the position of each id in the index, or -1 if not found."""
+        positions = np.full(len(ids), -1, dtype=np.int64)
+        for i, id in enumerate(ids):
+            try:
+                positions[i] = self.positions.get(id, -1)
+            except TypeError:  # Unhashable id
+                pass
+        return positions
+
+
+class TermMatrix:
+    """
+    A sparse matrix of term frequencies, with one row per document and one
+    column per term of the vocabulary, together with the doclen of each
+    document. Non-zero entries are kept sorted by the flat key
+    row * num_terms + term, so a batch of (row, term) entries is looked up
+    with a single binary search.
+    """
+
+    def __init__(
+        self,
+        rows: np.ndarray,
+        terms: np.ndarray,
+        tfs: np.ndarray,
+        doclens: np.ndarray,
+        num_terms: int,
+    ) -> None:
+        self.num_terms = num_terms
+        keys = rows * num_terms + terms
+        order = np.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        self.tfs = tfs[order]
+        self.doclens = doclens
+
+    @classmethod
+    def from_tf_dicts(
+        cls, tf_dicts: list[dict], find_terms: callable, num_terms: int, tf_to_doclen
+    ):
+        """Build from a {term: tf} dict per document, ignoring unknown terms."""
+        terms = find_terms([term for tf_dict in tf_dicts for term in tf_dict])
+        rows = np.repeat(
+            np.arange(len(tf_dicts)), [len(tf_dict) for tf_dict in tf_dicts]
+        )
+        tfs = np.array(
+            [tf for tf_dict in tf_dicts for tf in tf_dict.values()], dtype=np.float64
+        )
+        is_known = terms >= 0
+        doclens = np.array([tf_to_doclen(tf_dict) for tf_dict in tf_dicts])
+        return cls(rows[is_known], terms[is_known], tfs[is_known], doclens, num_terms)
+
+    ARRAYS = ["keys", "tfs", "doclens"]
+
+    def save(self, directory: str, prefix: str):
+        for name in self.ARRAYS:
+            save_array(directory, f"{prefix}{name}.npy", getattr(self, name))
+
+    @classmethod
+    def load(cls, directory: str, prefix: str, num_terms: int, mmap_mode: str = None):
+        matrix = cls.__new__(cls)
+        matrix.num_terms = num_terms
+        for name in cls.ARRAYS:
+            setattr(
+                matrix, name, load_array(directory, f"{prefix}{name}.npy", mmap_mode)
+            )
+        return matrix
+
+    def lookup(self, rows: np.ndarray, terms: np.ndarray):
+        """
+        Return the term frequency of each (row, term) entry, 0 if absent or
+        if the term was added to the vocabulary after the matrix was built.
+        """
+        if len(self.keys) == 0:
+            return np.zeros(len(rows))
+        keys = rows * self.num_terms + terms
+        positions = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        is_found = (self.keys[positions] == keys) & (terms < self.num_terms)
+        return np.where(is_found, self.tfs[positions], 0.0)
+
+
+class ImpactIndex:
+    """
+    Postings of the impact of each term on the score of each document, where
+    the score of a document for a query is the sum of the impacts of the
+    query terms. The postings of each term are kept in two orders:
+        - by document, to look up the impacts of given documents
+        - by descending impact, to find the documents with the highest
+          impacts, where the first impact is the upper bound of the term.
+    """
+
+    def __init__(
+        self, terms: np.ndarray, docs: np.ndarray, impacts: np.ndarray, num_terms: int
+    ) -> None:
+        """
+        terms, docs, impacts: one entry per (term, document) with a non-zero
+            impact, sorted by term and then document.
+        """
+        self.indptr = np.searchsorted(terms, np.arange(num_terms + 1))
+        self.docs = docs.astype(np.int64)
+        self.impacts = impacts
+        order = np.lexsort((-impacts, terms))
+        self.docs_by_impact = self.docs[order]
+        self.impacts_by_impact = impacts[order]
+        self.upper_bounds = np.zeros(num_terms)
+        is_nonempty = np.diff(self.indptr) > 0
+        self.upper_bounds[is_nonempty] = self.impacts_by_impact[
+            self.indptr[:-1][is_nonempty]
+        ]
+
+    ARRAYS = [
+        "indptr",
+        "docs",
+        "impacts",
+        "docs_by_impact",
+        "impacts_by_impact",
+        "upper_bounds",
+    ]
+
+    def save(self, directory: str, prefix: str):
+        for name in self.ARRAYS:
+            save_array(directory, f"{prefix}{name}.npy", getattr(self, name))
+
+    @classmethod
+    def load(cls, directory: str, prefix: str, mmap_mode: str = None):
+        index = cls.__new__(cls)
+        for name in cls.ARRAYS:
+            setattr(
+                index, name, load_array(directory, f"{prefix}{name}.npy", mmap_mode)
+            )
+        return index
+
+    def top_docs(self, term: int, n: int):
+        """Return the n documents with the highest impacts for term."""
+        start, end = self.indptr[term], self.indptr[term + 1]
+        return self.docs_by_impact[start : min(start + n, end)]
+
+    def docs_above(self, term: int, min_impact: float):
+        """Return the documents with an impact of at least min_impact for term."""
+        start, end = self.indptr[term], self.indptr[term + 1]
+        impacts = self.impacts_by_impact[start:end]
+        n = np.searchsorted(-impacts, -min_impact, side="right")
+        return self.docs_by_impact[start : start + n]
+
+    def score_docs(self, terms: np.ndarray, docs: np.ndarray):
+        """Return the sum of the impacts of terms for each of the sorted docs."""
+        scores = np.zeros(len(docs))
+        for term in terms:
+            start, end = self.indptr[term], self.indptr[term + 1]
+            if start == end:
+                continue
+            term_docs = self.docs[start:end]
+            positions = np.minimum(np.searchsorted(term_docs, docs), end - start - 1)
+            is_found = term_docs[positions] == docs
+            scores[is_found] += self.impacts[start:end][positions[is_found]]
+        return scores
@@ -4,7 +4,11 @@ import torch
 import numpy as np
 from tqdm import tqdm
 
-from mini_rec_sys.encoders import BaseBertEncoder
+from mini_rec_sys.encoders import (
+    BaseBertEncoder,
+    EmbeddingCache,
+    encoder_fingerprint,
+)
 from mini_rec_sys.scorers import BaseScorer
 from mini_rec_sys.utils import batcher
 
@@ -26,7 +30,17 @@ class DenseScorer(BaseScorer):
         q_encoder: BaseBertEncoder,
         p_encoder: BaseBertEncoder,
         batch_size: int = 32,
+        sort_by_length: bool = True,
+        embedding_cache: EmbeddingCache = None,
     ) -> None:
+        """
+        sort_by_length: whether to encode texts in order of their length, so
+            that texts in each batch have similar lengths and less padding.
+            Scores are returned in the original order either way.
+        embedding_cache: if provided, passage embeddings are looked up from
+            the cache for the current weights of p_encoder, and only passages
+            that are not cached are encoded (and added to the cache).
+        """
         super().__init__(cols=[query_key, test_documents_key, passage_text_key])
         self.q_encoder = q_encoder
         self.p_encoder = p_encoder
@@ -34,6 +48,8 @@ class DenseScorer(BaseScorer):
         self.query_key = query_key
         self.test_documents_key = test_documents_key
         self.passage_text_key = passage_text_key
+        self.sort_by_length = sort_by_length
+        self.embedding_cache = embedding_cache
 
     @torch.no_grad()
     def q_encode(self, texts: list[str]):
@@ -43,6 +59,42 @@ class DenseScorer(BaseScorer):
     def p_encode(self, texts: list[str]):
         return self.p_encoder(texts).cpu().detach().numpy()
 
+    def encode(self, texts: list[str], encode_fn: callable):
+        """
+        Encode texts in batches with encode_fn, returning the embeddings in
+        the order of texts. If self.sort_by_length, texts are encoded in
+        order of length to minimize padding.
+        """
+        if not self.sort_by_length:
+            return np.vstack(
+                [encode_fn(batch) for batch in batcher(texts, self.batch_size)]
+            )
+        order = np.argsort([len(text) for text in texts], kind="stable")
+        sorted_texts = [texts[i] for i in order]
+        embed = np.vstack(
+            [encode_fn(batch) for batch in batcher(sorted_texts, self.batch_size)]
+        )
+        result = np.empty_like(embed)
+        result[order] = embed
+        return result
+
+    def encode_passages(self, texts: list[str]):
+        """Encode passage texts, using the embedding cache if any."""
+        if self.embedding_cache is None:
+            return self.encode(texts, self.p_encode)
+        return self.embedding_cache.get_or_encode(
+            encoder_fingerprint(self.p_encoder),
+            texts,
+            lambda missing: self.encode(missing, self.p_encode),
+        )
+
+    def padding_ratios(self):
+        """Return the padding ratios of the query and passage encoders."""
+        return {
+            "query": self.q_encoder.padding_ratio,
+            "passage": self.p_encoder.padding_ratio,
+        }
+
     @torch.no_grad()
     def score(self, test_data: dict | list[dict]):
         """Generate list of scores for each row of test_data.
@@ -62,10 +114,7 @@ class DenseScorer(BaseScorer):
             item_lists: list[dict] = [test_data[self.test_documents_key]]
 
         # Encode queries
-        q_embed = []
-        for batch in batcher(queries, self.batch_size):
-            q_embed.append(self.q_encode(batch))
-        q_embed = np.vstack(q_embed)  # n_batch x embed_dim
+        q_embed = self.encode(queries, self.q_encode)  # n_batch x embed_dim
 
         # As there may be duplicate items across the batch, we set up a dict
         # of hash(item_text): idx and only encode each item once to
@@ -92,10 +141,7 @@ class DenseScorer(BaseScorer):
             idx_list.append(inner_list)
 
         # Batch encode all job texts
-        p_embed = []
-        for batch in batcher(item_texts, self.batch_size):
-            p_embed.append(self.p_encode(batch))
-        p_embed = np.vstack(p_embed)  # n_unique_jobs x embed_dim
+        p_embed = self.encode_passages(item_texts)  # n_unique_jobs x embed_dim
 
         # Score and extract scores to rank
         S = q_embed @ p_embed.T  # n_batch x n_unique_jobs
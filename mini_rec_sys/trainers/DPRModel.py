@@ -114,7 +114,8 @@ class DPRModel(BaseModel):
             FLAG_POSITIVE = False
             positive_weights = (
                 [1] * len(session.positive_items)
-                if not session.positive_weights
+                if session.positive_weights is None
+                or len(session.positive_weights) == 0
                 else session.positive_weights
             )
             positive_sampler = WeightedSampler(
@@ -156,7 +157,8 @@ class DPRModel(BaseModel):
             FLAG_NEGATIVE = False
             negative_weights = (
                 [1] * len(session.negative_items)
-                if not session.negative_items
+                if session.negative_weights is None
+                or len(session.negative_weights) == 0
                 else session.negative_weights
             )
             negative_sampler = WeightedSampler(
@@ -220,6 +222,15 @@ class DPRModel(BaseModel):
         """
         return -F.log_softmax(S, dim=1).trace() / len(S)
 
+    def on_train_epoch_end(self):
+        # Report the share of encoded tokens that were padding, which can be
+        # reduced by sampling batches with BatchedLengthSampler, using the
+        # lengths from get_passage_lengths
+        self.log("q_padding_ratio", self.q_encoder.padding_ratio, sync_dist=True)
+        self.log("p_padding_ratio", self.p_encoder.padding_ratio, sync_dist=True)
+        self.q_encoder.reset_padding_stats()
+        self.p_encoder.reset_padding_stats()
+
     def validation_step(self, batch: list[dict], batch_idx: int):
         if self.val_method == "default":
             return super().validation_step(batch, batch_idx)
@@ -239,7 +250,13 @@ class DPRModel(BaseModel):
         ndcg, se = Evaluator(scorer).evaluate_batch(
             batch, k=self.val_k, return_raw=False
         )
-        self.log(self.val_metric_name, ndcg, prog_bar=True, batch_size=len(batch))
+        self.log(
+            self.val_metric_name,
+            ndcg,
+            prog_bar=True,
+            batch_size=len(batch),
+            sync_dist=True,
+        )
         return ndcg
 
     def test_step(self, batch: list[dict], batch_idx: int):
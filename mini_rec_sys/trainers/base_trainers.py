@@ -1,13 +1,17 @@
 from __future__ import annotations
 from torch.optim import Optimizer, Adam
+from pytorch_lightning.strategies import DDPStrategy
 from torch.utils.data import DataLoader, Sampler
 import pytorch_lightning as pl
 from pytorch_lightning.callbacks import ModelCheckpoint
 import numpy as np
+import torch
 from typing import Union
 import os
 
 from mini_rec_sys.data import Session, SessionDataset, BatchedSequentialSampler
+from mini_rec_sys.data.datasets import worker_init_fn
+from mini_rec_sys.data.samplers import DistributedBatchSampler
 from mini_rec_sys.evaluators import mean_with_se
 from mini_rec_sys.constants import (
     VAL_METRIC_NAME,
@@ -52,6 +56,14 @@ class BaseModel(pl.LightningModule):
         self.test_dataset = test_dataset
         self.test_batch_size = test_batch_size
         self.test_metrics = []
+        self.test_batch_ends = []
+
+    def setup(self, stage: str):
+        # Split the cores of each node among its processes, instead of each
+        # process using all cores and oversubscribing them
+        if self.trainer.world_size > 1 and self.device.type == "cpu":
+            num_threads = (os.cpu_count() or 1) // self.trainer.num_devices
+            torch.set_num_threads(max(1, num_threads))
 
     def forward(self):
         """
@@ -76,7 +88,13 @@ class BaseModel(pl.LightningModule):
         i.e. we want the validation to be different from training.
         """
         loss = self.forward(batch)
-        self.log(VAL_METRIC_NAME, loss.item(), prog_bar=True, batch_size=len(batch))
+        self.log(
+            VAL_METRIC_NAME,
+            loss.item(),
+            prog_bar=True,
+            batch_size=len(batch),
+            sync_dist=True,
+        )
         return loss
 
     def test_step(self, batch: list[dict], batch_idx):
@@ -92,14 +110,41 @@ class BaseModel(pl.LightningModule):
         self.test_metrics.append(loss.item())
         return loss
 
+    def on_test_batch_end(self, outputs, batch, batch_idx, dataloader_idx=0):
+        # Record where the metrics of each batch end in self.test_metrics
+        self.test_batch_ends.append(len(self.test_metrics))
+
     def on_test_epoch_end(self):
-        metric, se = mean_with_se(self.test_metrics)
-        n = len(self.test_metrics)
+        metrics = self.test_metrics
+        if self.trainer.world_size > 1:
+            metrics = self.gather_test_metrics(metrics)
+        metric, se = mean_with_se(metrics)
+        n = len(metrics)
         self.test_metrics = []
+        self.test_batch_ends = []
         self.log(TEST_METRIC_NAME, metric, prog_bar=True)
         self.log(TEST_SE_NAME, se, prog_bar=True)
         self.log(TEST_N_NAME, n, prog_bar=True)
 
+    def gather_test_metrics(self, metrics: list[float]):
+        """
+        Collect the test metrics of all ranks. The batches that the sampler
+        repeats to give every rank the same number of batches are dropped, so
+        that each test session is only counted once.
+        """
+        sampler = getattr(self.trainer.test_dataloaders, "batch_sampler", None)
+        if isinstance(sampler, DistributedBatchSampler):
+            num_batches = sampler.num_unpadded_batches()
+            if num_batches < len(self.test_batch_ends):
+                ends = [0] + self.test_batch_ends
+                metrics = metrics[: ends[num_batches]]
+        # Ranks may have a different number of metrics, so pad before gathering
+        counts = self.all_gather(torch.tensor(len(metrics))).tolist()
+        padded = torch.zeros(max(counts), dtype=torch.float64)
+        padded[: len(metrics)] = torch.tensor(metrics, dtype=torch.float64)
+        gathered = self.all_gather(padded).tolist()
+        return [m for row, n in zip(gathered, counts) for m in row[:n]]
+
 
 def train(
     model: BaseModel,
@@ -113,16 +158,36 @@ def train(
     checkpoint_metric: str = None,
     checkpoint_behaviour: str = "min",
     default_root_dir: str = os.getcwd(),
+    num_processes: int = 1,
+    num_nodes: int = 1,
+    start_method: str = "popen",
     **kwargs,
 ):
     """
     Additional arguments / keyword arguments are passed into pl.Trainer.
+
+    Each dataloader worker opens its own handles to the dataset storage (see
+    worker_init_fn), so num_dataloader_workers > 1 is safe to use.
+
+    If num_processes > 1 or num_nodes > 1, trains with distributed data
+    parallel on CPU using the gloo backend, with num_processes processes on
+    each of num_nodes nodes. model.sampler must then give each rank its own
+    batches, e.g. BatchedSequentialSampler or BatchedWeightedSampler (with a
+    seed). For multiple nodes, the MASTER_ADDR, MASTER_PORT and NODE_RANK
+    environment variables must be set on each node.
+
+    start_method: how the processes are started, see DDPStrategy:
+        "popen": runs the training script again in each new process, which
+            is the most robust choice for scripts.
+        "spawn" / "fork": starts processes from within python, which works
+            in notebooks. "fork" is only available on unix-like systems.
     """
     train_loader = DataLoader(
         model.train_dataset,
         batch_sampler=model.sampler,
-        collate_fn=lambda x: x,
+        collate_fn=collate_batch,
         num_workers=num_dataloader_workers,
+        worker_init_fn=worker_init_fn,
     )
 
     if model.val_dataset:
@@ -131,8 +196,9 @@ def train(
             batch_sampler=BatchedSequentialSampler(
                 model.val_dataset, model.val_batch_size, drop_last=False
             ),
-            collate_fn=lambda x: x,
+            collate_fn=collate_batch,
             num_workers=num_dataloader_workers,
+            worker_init_fn=worker_init_fn,
         )
     else:
         val_loader = None
@@ -143,8 +209,9 @@ def train(
             batch_sampler=BatchedSequentialSampler(
                 model.test_dataset, model.test_batch_size, drop_last=False
             ),
-            collate_fn=lambda x: x,
+            collate_fn=collate_batch,
             num_workers=num_dataloader_workers,
+            worker_init_fn=worker_init_fn,
         )
     else:
         test_loader = None
@@ -156,6 +223,19 @@ def train(
             ModelCheckpoint(monitor=checkpoint_metric, mode=checkpoint_behaviour)
         ]
 
+    distributed_kwargs = {}
+    if num_processes > 1 or num_nodes > 1:
+        distributed_kwargs = dict(
+            accelerator="cpu",
+            devices=num_processes,
+            num_nodes=num_nodes,
+            strategy=DDPStrategy(
+                process_group_backend="gloo", start_method=start_method
+            ),
+            # Our batch samplers already split the batches among ranks
+            use_distributed_sampler=False,
+        )
+
     trainer = pl.Trainer(
         max_epochs=max_epochs,
         limit_train_batches=limit_train_batches,
@@ -164,7 +244,9 @@ def train(
         limit_test_batches=limit_test_batches,
         precision=precision,
         callbacks=callbacks,
-        default_root_dir=default_root_dir**kwargs,
+        default_root_dir=default_root_dir,
+        **distributed_kwargs,
+        **kwargs,
     )
     trainer.fit(
         model=model,
@@ -176,3 +258,11 @@ def train(
             dataloaders=test_loader,
             ckpt_path="best",
         )
+
+
+def collate_batch(batch: list[dict]):
+    """
+    Return the batch of session dicts as is. Unlike a lambda, it can be
+    pickled, which is required to start processes with spawn.
+    """
+    return batch
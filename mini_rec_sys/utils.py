@@ -54,6 +54,16 @@ def batcher(iterable, n=1):
         yield iterable[idx : min(idx + n, l)]
 
 
+def chunker(iterable, n=1):
+    """
+    Like batcher, but works on any iterable (e.g. generators) by lazily
+    yielding lists of up to n elements.
+    """
+    iterator = iter(iterable)
+    while chunk := list(itertools.islice(iterator, n)):
+        yield chunk
+
+
 def clean(text):
     """
     Clean text by removing html etc.
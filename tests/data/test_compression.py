@@ -0,0 +1,34 @@
+from mini_rec_sys.data.compression import ValueCodec
+import pickle
+import pytest
+
+from pdb import set_trace
+
+
+class TestValueCodec:
+    def test_round_trip(self):
+        value = {"title": "a title", "text": "some long text " * 100}
+        for method in ["zlib", "zstd"]:
+            codec = ValueCodec(method)
+            encoded = codec.encode(value)
+            assert codec.decode(encoded) == value
+            assert codec.compression_ratio > 5
+
+    def test_trained_dictionary(self, tmp_path):
+        values = [{"title": f"title number {i} of the catalog"} for i in range(500)]
+        codec = ValueCodec.train(values, dict_size=4096)
+        assert codec.dictionary is not None
+        sizes = [len(codec.encode(v)) for v in values]
+        plain_sizes = [len(ValueCodec("zstd").encode(v)) for v in values]
+        assert sum(sizes) < sum(plain_sizes)
+
+        codec.save(tmp_path)
+        loaded = pickle.loads(pickle.dumps(ValueCodec.load(tmp_path)))
+        assert loaded.decode(codec.encode(values[0])) == values[0]
+        assert ValueCodec.load(tmp_path / "missing") is None
+
+    def test_invalid_method(self):
+        with pytest.raises(AssertionError):
+            ValueCodec("snappy")
+        with pytest.raises(AssertionError):
+            ValueCodec("zlib", dictionary=b"abc")
@@ -1,7 +1,17 @@
-from mini_rec_sys.data import Session, SessionDataset
-from mini_rec_sys.data.datasets import Dataset
+from mini_rec_sys.data import Session, CompactSession, SessionDataset
+from mini_rec_sys.data.datasets import Dataset, iter_json_items, worker_init_fn
+from torch.utils.data import DataLoader
 from pydantic.dataclasses import ValidationError
+import pandas as pd
+import fastparquet
+from pathlib import Path
+import numpy as np
 import pytest
+import json
+import gzip
+import os
+import io
+import pickle
 
 from pdb import set_trace
 
@@ -22,6 +32,191 @@ class TestDataset:
         items = set([v["text"] for k, v in iter(dataset)])
         assert items == set([v["text"] for v in default_documents.values()])
 
+    def test_load_many(self, default_documents):
+        for storage in ["diskcache", "columnar"]:
+            dataset = Dataset(
+                data=default_documents, load_fn=lambda x: x["title"], storage=storage
+            )
+            ids = [3, 1, 100, 3, "1"]
+            expected = [dataset.load(id) for id in ids]
+            assert dataset.load_many(ids) == expected
+            assert expected[2] is None and expected[4] is None
+
+    def test_batched_writes(self, default_documents, capsys):
+        dataset = Dataset(data=default_documents, write_batch_size=2)
+        assert len(dataset) == len(default_documents)
+        for i in default_documents:
+            assert dataset.load(i) == default_documents[i]
+        assert "rows/sec" in capsys.readouterr().out
+
+    def test_sharded_keys(self, default_documents):
+        dataset = Dataset(data=default_documents)
+        shards = [list(dataset.iterkeys(i, 3)) for i in range(3)]
+        assert sorted(sum(shards, [])) == sorted(default_documents)
+
+    def test_dataloader_workers(self, default_documents):
+        dataset = Dataset(data=default_documents)
+        loader = DataLoader(
+            dataset.as_iterable(),
+            batch_size=None,
+            num_workers=2,
+            worker_init_fn=worker_init_fn,
+        )
+        titles = [row["title"] for row in loader]
+        assert sorted(titles) == sorted(v["title"] for v in default_documents.values())
+
+    def test_pickling_reopens_storage(self, default_documents):
+        dataset = Dataset(data=default_documents)
+        copied = pickle.loads(pickle.dumps(dataset))
+        assert copied.storage_handle is None
+        for i in default_documents:
+            assert copied.load(i) == default_documents[i]
+
+    def test_parallel_ingestion(self, default_documents):
+        data = {i: {"title": f"title {i}"} for i in range(100)}
+        dataset = Dataset(
+            data=data,
+            store_fn=lambda id, row: {**row, "length": len(row["title"])},
+            write_batch_size=7,
+            num_ingest_workers=2,
+        )
+        assert len(dataset) == len(data)
+        for i in data:
+            assert dataset.load(i) == {**data[i], "length": len(data[i]["title"])}
+
+    def test_parquet_row_groups_and_columns(self, default_documents, tmp_path):
+        df = pd.DataFrame([{"id": k, **v} for k, v in default_documents.items()])
+        fastparquet.write(str(tmp_path / "part-0.parquet"), df, row_group_offsets=2)
+        dataset = Dataset(data=str(tmp_path), columns=["title"])
+        assert len(dataset) == len(default_documents)
+        for i in default_documents:
+            assert dataset.load(i) == {"id": i, "title": default_documents[i]["title"]}
+
+    def test_iter_json_items(self, default_documents):
+        text = json.dumps({str(k): v for k, v in default_documents.items()}, indent=2)
+        items = list(iter_json_items(io.StringIO(text), chunk_size=7))
+        assert items == [(str(k), v) for k, v in default_documents.items()]
+        assert list(iter_json_items(io.StringIO(" { } "))) == []
+
+        # Numbers split by a chunk boundary are not decoded early
+        data = {str(i): v for i, v in enumerate([1.5, -2e10, 3, 12.25e-3, True])}
+        for text in [json.dumps(data), json.dumps(data, indent=1)]:
+            for chunk_size in range(1, 8):
+                items = iter_json_items(io.StringIO(text), chunk_size=chunk_size)
+                assert dict(items) == data
+
+    def test_json_files(self, default_documents, tmp_path):
+        with open(tmp_path / "part-0.json", "w") as f:
+            json.dump({str(k): v for k, v in default_documents.items()}, f)
+        dataset = Dataset(data=str(tmp_path))
+        for i in default_documents:
+            assert dataset.load(str(i)) == default_documents[i]
+
+    def test_compressed_jsonl_files(self, default_documents, tmp_path):
+        with gzip.open(tmp_path / "part-0.jsonl.gz", "wt") as f:
+            for k, v in default_documents.items():
+                f.write(json.dumps({"id": k, **v}) + "\n")
+        dataset = Dataset(data=str(tmp_path))
+        for i in default_documents:
+            assert dataset.load(i) == {"id": i, **default_documents[i]}
+
+    def test_compression(self, default_documents, tmp_path, capsys):
+        for compression, dict_size in [("zlib", 0), ("zstd", 0), ("zstd", 1024)]:
+            location = str(tmp_path / f"{compression}_{dict_size}")
+            dataset = Dataset(
+                db_location=location,
+                data=default_documents,
+                compression=compression,
+                compression_dict_size=dict_size,
+            )
+            assert "ratio" in capsys.readouterr().out
+            reloaded = pickle.loads(pickle.dumps(Dataset(db_location=location)))
+            for data in [dataset, reloaded]:
+                for i in default_documents:
+                    assert data.load(i) == default_documents[i]
+                assert data.load_many([1, 100]) == [default_documents[1], None]
+            assert isinstance(dataset.cache.get(1), bytes)
+
+            # Changes are written with the compression saved with the db
+            reloaded.apply_changes(upserts={1: {"title": "new"}})
+            assert Dataset(db_location=location).load(1) == {"title": "new"}
+
+        location = str(tmp_path / "uncompressed")
+        Dataset(db_location=location, data=default_documents)
+        with pytest.raises(ValueError):
+            Dataset(db_location=location, compression="zlib")
+
+    def test_repopulate_rebuilds_key_index(self, default_documents, tmp_path):
+        location = str(tmp_path / "items")
+        dataset = Dataset(db_location=location, data=default_documents)
+        assert set(dataset.load_key_index().iterkeys()) == set(default_documents)
+
+        # Same number of ids, but different ids
+        dataset.cache.clear()
+        data = {k + 100: v for k, v in default_documents.items()}
+        dataset = Dataset(db_location=location, data=data)
+        assert set(dataset.load_key_index().iterkeys()) == set(data)
+        reloaded = Dataset(db_location=location)
+        assert set(reloaded.load_key_index().iterkeys()) == set(data)
+
+    def test_small_db_reuses_key_index(self, default_documents, tmp_path, capsys):
+        location = str(tmp_path / "items")
+        dataset = Dataset(db_location=location, data=default_documents)
+        assert os.path.exists(os.path.join(dataset.index_directory, "key_index.npy"))
+        capsys.readouterr()
+        reloaded = Dataset(db_location=location)
+        assert set(reloaded.load_key_index().iterkeys()) == set(default_documents)
+        assert "Building key index" not in capsys.readouterr().out
+
+        # A new version with the same number of ids is picked up on reopen
+        dataset.apply_changes(upserts={6: {"title": "new"}}, deletes=[1])
+        reloaded.reopen()
+        assert set(reloaded.load_key_index().iterkeys()) == {2, 3, 4, 5, 6}
+        assert "Building key index" not in capsys.readouterr().out
+
+    def test_apply_changes(self, default_documents, tmp_path):
+        for storage in ["diskcache", "columnar"]:
+            location = str(tmp_path / storage)
+            dataset = Dataset(
+                db_location=location,
+                data=default_documents,
+                storage=storage,
+                cache_bytes=10000,
+            )
+            reader = Dataset(db_location=location, storage=storage)
+            cached_reader = Dataset(
+                db_location=location, storage=storage, cache_bytes=10000
+            )
+            assert cached_reader.load(1) == default_documents[1]
+            assert cached_reader.load(2) == default_documents[2]
+            assert dataset.load(1) == default_documents[1]
+            dataset.apply_changes(
+                upserts={1: {"title": "new"}, 100: {"title": "added"}}, deletes=[2]
+            )
+            assert dataset.version == 1
+            assert dataset.load(1) == {"title": "new"}
+            assert dataset.load(2) is None and dataset.load(100) == {"title": "added"}
+            expected = set(default_documents) - {2} | {100}
+            assert set(dataset.iterkeys()) == expected and len(dataset) == len(expected)
+            assert set(dataset.load_key_index().iterkeys()) == expected
+
+            # Readers keep their version until reopened
+            assert reader.load(2) == default_documents[2] and reader.version == 0
+            reader.reopen()
+            assert reader.version == 1 and reader.load(2) is None
+            cached_reader.reopen()
+            assert cached_reader.version == 1 and len(cached_reader) == len(expected)
+            assert cached_reader.load(1) == {"title": "new"}
+            assert cached_reader.load(2) is None
+            assert cached_reader.load(100) == {"title": "added"}
+
+            dataset.apply_changes(deletes=[100])
+            dataset.compact()
+            reopened = Dataset(db_location=location, storage=storage)
+            assert reopened.version == 3
+            assert set(reopened.iterkeys()) == set(default_documents) - {2}
+            assert reopened.load(1) == {"title": "new"}
+
 
 class TestSessionDataset:
     def test_session_dataset_init_no_errors(self, default_session_data):
@@ -37,6 +232,166 @@ class TestSessionDataset:
             data=default_session_data,
         )
 
+    def test_load_items(self, default_documents, default_session_data):
+        dataset = SessionDataset(
+            id_name="session_id",
+            store_fn=lambda id, row: Session(
+                session_id=id,
+                positive_items=row["positive_items"],
+                negative_items=row["negative_items"],
+                positive_relevances=row["positive_relevances"],
+                query=row["query"],
+            ),
+            data=default_session_data,
+            item_dataset=Dataset(data=default_documents),
+        )
+        items = dataset.load_items([2, 100, 1])
+        assert items == [
+            {"item_id": 2, **default_documents[2]},
+            {"item_id": 100},
+            {"item_id": 1, **default_documents[1]},
+        ]
+        assert dataset.load_item(1) == items[2]
+        assert dataset.load_users("user") == {"user_id": "user"}
+
+    def test_split_dataset(self, default_session_data):
+        dataset = SessionDataset(
+            id_name="session_id",
+            store_fn=lambda id, row: Session(
+                session_id=id,
+                positive_items=row["positive_items"],
+                negative_items=row["negative_items"],
+                positive_relevances=row["positive_relevances"],
+                query=row["query"],
+            ),
+            data=default_session_data,
+        )
+        for method in ["hash", "range"]:
+            train = dataset.split_dataset(fraction=(0.0, 0.5), method=method)
+            test = dataset.split_dataset(fraction=(0.5, 1.0), method=method)
+            train_keys, test_keys = set(train.iterkeys()), set(test.iterkeys())
+            assert len(train) + len(test) == len(dataset)
+            assert train_keys.union(test_keys) == set(default_session_data)
+            assert all(train[k] is not None for k in train_keys)
+            assert all(train[k] is None for k in test_keys)
+
+        named = dataset.split_dataset(fraction=(0.0, 0.5), name="train")
+        assert os.path.exists(os.path.join(dataset.db_location, "splits", "train.npz"))
+        reloaded = dataset.split_dataset(fraction=(0.0, 0.5), name="train")
+        assert list(reloaded.iterkeys()) == list(named.iterkeys())
+
+        # A different fraction or method under the same name is recomputed
+        for fraction, method in [((0.0, 0.2), "hash"), ((0.0, 0.2), "range")]:
+            expected = dataset.split_dataset(fraction=fraction, method=method)
+            changed = dataset.split_dataset(
+                fraction=fraction, method=method, name="train"
+            )
+            assert list(changed.iterkeys()) == list(expected.iterkeys())
+            assert len(changed) < len(named)
+
+        odd = dataset.split_dataset(lambda k: int(k.split("_")[1]) % 2 == 1)
+        assert len(odd) == len(default_session_data) // 2
+
+        # A named split of a child is not reused for the full dataset
+        half = dataset.split_dataset(fraction=(0.0, 0.5), method="range")
+        child = half.split_dataset(fraction=(0.0, 0.5), method="range", name="b")
+        full = dataset.split_dataset(fraction=(0.0, 0.5), method="range", name="b")
+        assert len(child) == len(half) // 2
+        assert list(full.iterkeys()) == list(half.iterkeys())
+
+        # A split_fn that selects nothing gives an empty dataset
+        empty = dataset.split_dataset(lambda k: False)
+        assert len(empty) == 0
+        assert list(empty.iterkeys()) == []
+        assert not empty.in_subset(next(dataset.iterkeys()))
+
+    def test_side_columns(self, default_session_data, tmp_path):
+        def store_fn(id, row):
+            return Session(
+                session_id=id,
+                positive_items=row["positive_items"],
+                negative_items=row["negative_items"],
+                positive_relevances=row["positive_relevances"],
+                query=row["query"],
+                session_weight=None if id == "session_1" else 3,
+            )
+
+        location = str(tmp_path / "sessions")
+        dataset = SessionDataset(
+            db_location=location,
+            id_name="session_id",
+            store_fn=store_fn,
+            data=default_session_data,
+        )
+        weights = dataset.load_session_weights(["session_1", "session_2", "x"])
+        assert weights[:2].tolist() == [1.0, 3.0] and np.isnan(weights[2])
+        assert dataset.load_side_column("num_items", ["session_3"]).tolist() == [2]
+
+        # Side columns are rebuilt if missing, and updated with changes
+        for path in Path(location).glob("side_column_*.npy"):
+            path.unlink()
+        reloaded = SessionDataset(db_location=location, store_fn=store_fn)
+        reloaded.load_session_weights(["session_1"])
+        assert len(list(Path(location).glob("side_column_*.npy"))) == 3
+        row = default_session_data["session_2"]
+        reloaded.apply_changes(upserts={"session_51": row}, deletes=["session_2"])
+        weights = reloaded.load_session_weights(
+            ["session_1", "session_2", "session_51"]
+        )
+        assert weights[[0, 2]].tolist() == [1.0, 3.0] and np.isnan(weights[1])
+
+        # Deletes only, without upserts
+        reloaded.apply_changes(deletes=["session_51"])
+        assert reloaded.version == 2 and reloaded.load("session_51") is None
+        weights = reloaded.load_session_weights(["session_1", "session_51"])
+        assert weights[0] == 1.0 and np.isnan(weights[1])
+
+    def test_compact_sessions(self, default_documents, default_session_data):
+        dataset = SessionDataset(
+            id_name="session_id",
+            store_fn=lambda id, row: Session(
+                session_id=id,
+                positive_items=row["positive_items"],
+                negative_items=row["negative_items"],
+                positive_relevances=row["positive_relevances"],
+                query=row["query"],
+            ),
+            data=default_session_data,
+            item_dataset=Dataset(data=default_documents),
+            compact=True,
+        )
+        assert dataset.has_negative_items
+        row = dataset["session_1"]
+        assert isinstance(row["session"], CompactSession)
+        raw = default_session_data["session_1"]
+        items = raw["negative_items"] + raw["positive_items"]
+        assert row["items"].tolist() == items
+        assert row["item_attributes"] == [
+            {"item_id": i, **default_documents[i]} for i in items
+        ]
+
+    def test_compact_sessions_mixed_ids(self, default_documents):
+        documents = {**default_documents, "doc_1": {"text": "str id"}}
+        session = Session(
+            session_id="s",
+            positive_items=["doc_1"],
+            negative_items=[1],
+            positive_relevances=[1],
+            query="q",
+        )
+        dataset = SessionDataset(
+            id_name="session_id",
+            store_fn=lambda id, row: row,
+            data={"s": session},
+            item_dataset=Dataset(data=documents),
+            compact=True,
+        )
+        for row in [dataset["s"], next(iter(dataset.as_iterable()))]:
+            assert row["items"].tolist() == [1, "doc_1"]
+            assert [a["item_id"] for a in row["item_attributes"]] == [1, "doc_1"]
+            texts = [a["text"] for a in row["item_attributes"]]
+            assert texts == [default_documents[1]["text"], "str id"]
+
     def test_session_dataset_must_load_sessions(self):
         with pytest.raises(AssertionError):
             dataset = SessionDataset(data={"a": 1}, store_fn=lambda id, row: row)
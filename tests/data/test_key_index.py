@@ -0,0 +1,41 @@
+from mini_rec_sys.data.key_index import KeyIndex
+import numpy as np
+import pytest
+
+from pdb import set_trace
+
+
+class TestKeyIndex:
+    def test_find(self):
+        index = KeyIndex.from_keys([5, 1, 3, 3])
+        assert list(index.iterkeys()) == [1, 3, 5]
+        assert index.find([3, 4, "3", 5]).tolist() == [1, -1, -1, 2]
+        assert 1 in index and "1" not in index
+
+    def test_mixed_keys_raise_error(self):
+        with pytest.raises(ValueError):
+            KeyIndex.from_keys([1, "a"])
+
+    def test_save_and_load(self, tmp_path):
+        index = KeyIndex.from_keys(["b", "a", "c"])
+        index.save(tmp_path)
+        loaded = KeyIndex.load(tmp_path)
+        assert list(loaded.iterkeys()) == ["a", "b", "c"]
+        assert np.array_equal(loaded.hashes, index.hashes)
+
+    def test_update(self):
+        index = KeyIndex.from_keys(["b", "d"])
+        updated = index.update(["a", "dddd", "b"], ["d", "e"])
+        assert list(updated.iterkeys()) == ["a", "b", "dddd"]
+        assert np.array_equal(updated.hashes, KeyIndex.from_keys(updated.keys).hashes)
+        with pytest.raises(ValueError):
+            index.update([1], [])
+
+    def test_splits_partition_keys(self):
+        index = KeyIndex.from_keys(range(1000))
+        for method in ["hash", "range"]:
+            train = index[index.split(0.0, 0.8, method=method)]
+            test = index[index.split(0.8, 1.0, method=method)]
+            assert len(train) + len(test) == len(index)
+            assert set(train.iterkeys()).isdisjoint(test.iterkeys())
+        assert 700 < len(index[index.split(0.0, 0.8)]) < 900
@@ -0,0 +1,52 @@
+from mini_rec_sys.data.memory_cache import MemoryCache, estimate_size
+from mini_rec_sys.data.datasets import Dataset
+
+from pdb import set_trace
+
+
+class TestMemoryCache:
+    def test_lru_eviction(self):
+        size = estimate_size("a" * 10)
+        cache = MemoryCache(max_bytes=2 * size, policy="lru")
+        cache.put(1, "a" * 10)
+        cache.put(2, "b" * 10)
+        assert cache.get(1) == "a" * 10  # 2 is now least recently used
+        cache.put(3, "c" * 10)
+        assert 2 not in cache and 1 in cache and 3 in cache
+        assert cache.stats()["evictions"] == 1
+        assert cache.num_bytes <= cache.max_bytes
+
+    def test_lfu_eviction(self):
+        size = estimate_size("a" * 10)
+        cache = MemoryCache(max_bytes=2 * size, policy="lfu")
+        cache.put(1, "a" * 10)
+        cache.put(2, "b" * 10)
+        cache.get(1)
+        cache.get(1)
+        cache.get(2)
+        cache.put(3, "c" * 10)
+        assert 2 not in cache and 1 in cache and 3 in cache
+        cache.put(4, "d" * 10)  # 3 has the lowest count
+        assert 3 not in cache and 1 in cache and 4 in cache
+
+    def test_objects_larger_than_budget_are_not_cached(self):
+        cache = MemoryCache(max_bytes=10)
+        cache.put(1, "a" * 100)
+        assert len(cache) == 0 and cache.num_bytes == 0
+
+
+class TestDatasetMemoryCache:
+    def test_hits_and_misses(self, default_documents):
+        dataset = Dataset(data=default_documents, cache_bytes=int(1e6))
+        for _ in range(3):
+            for i in default_documents:
+                assert dataset.load(i) == default_documents[i]
+        assert dataset.load_many([1, 2, 100]) == [
+            default_documents[1],
+            default_documents[2],
+            None,
+        ]
+        stats = dataset.cache_stats()
+        assert stats["misses"] == len(default_documents) + 1
+        assert stats["hits"] == 2 * len(default_documents) + 2
+        assert stats["num_objects"] == len(default_documents)
@@ -1,4 +1,34 @@
-from mini_rec_sys.data import Sampler, BatchedSequentialSampler, SessionDataset, Session
+from mini_rec_sys.data import (
+    Sampler,
+    BatchedSequentialSampler,
+    BatchedWeightedSampler,
+    SessionDataset,
+    Session,
+)
+from mini_rec_sys.data.samplers import (
+    WeightedSampler,
+    LengthBucketSampler,
+    get_passage_lengths,
+)
+from mini_rec_sys.data.datasets import Dataset
+from mini_rec_sys.data import BatchedLengthSampler
+from collections import Counter
+import numpy as np
+
+
+def weighted_session_dataset(default_session_data):
+    return SessionDataset(
+        id_name="session_id",
+        store_fn=lambda id, row: Session(
+            session_id=id,
+            positive_items=row["positive_items"],
+            negative_items=row["negative_items"],
+            positive_relevances=row["positive_relevances"],
+            query=row["query"],
+            session_weight=int(id.split("_")[1]) % 4,
+        ),
+        data=default_session_data,
+    )
 
 
 class TestSampler:
@@ -23,3 +53,108 @@ class TestSampler:
         for batch in batches:
             collect_batches.update(batch)
         assert collect_batches == set(default_session_data.keys())
+
+    def test_weighted_sampler_without_replacement(self, default_session_data):
+        dataset = weighted_session_dataset(default_session_data)
+        sampler = WeightedSampler(dataset, seed=0, chunk_size=7)
+        expected = {k: int(k.split("_")[1]) % 4 for k in default_session_data}
+        expected = {k: w for k, w in expected.items() if w > 0}
+        for _ in range(2):
+            keys = list(sampler)
+            assert len(keys) == len(sampler) == sum(expected.values())
+            assert Counter(keys) == expected
+        assert keys != sorted(keys)
+
+        # Epochs larger than numpy's hypergeometric limit are approximated
+        remaining = np.array([10**9, 10**9, 5])
+        counts = sampler.draw_counts(remaining, remaining.sum(), 1000)
+        assert counts.sum() == 1000 and np.all(counts <= remaining)
+
+    def test_weighted_sampler_with_replacement(self, default_session_data):
+        dataset = weighted_session_dataset(default_session_data)
+        sampler = WeightedSampler(
+            dataset, num_instances=30000, replacement=True, seed=0
+        )
+        counts = Counter(sampler)
+        assert sum(counts.values()) == len(sampler) == 30000
+        assert "session_4" not in counts
+        assert 2.5 < counts["session_3"] / counts["session_1"] < 3.5
+
+        batched = BatchedWeightedSampler(
+            dataset, batch_size=8, num_instances=100, replacement=True
+        )
+        assert len(list(batched)) == len(batched) == 12
+
+    def test_distributed_samplers(self, default_session_data):
+        dataset = weighted_session_dataset(default_session_data)
+        for drop_last in [True, False]:
+            rank_batches = [
+                list(BatchedSequentialSampler(dataset, 4, drop_last, rank, 3))
+                for rank in range(3)
+            ]
+            assert len(set(len(batches) for batches in rank_batches)) == 1
+            keys = [k for batches in rank_batches for batch in batches for k in batch]
+            if drop_last:
+                assert len(keys) == len(set(keys)) == 48
+            else:
+                assert set(keys) == set(default_session_data)
+
+        samplers = [
+            BatchedWeightedSampler(dataset, 4, seed=1, rank=rank, world_size=2)
+            for rank in range(2)
+        ]
+        epochs = []
+        for epoch in range(2):
+            for sampler in samplers:
+                sampler.set_epoch(epoch)
+            epochs.append([list(sampler) for sampler in samplers])
+            keys = [k for batches in epochs[-1] for batch in batches for k in batch]
+            assert Counter(keys) == Counter(list(samplers[0].sampler)[: len(keys)])
+        assert epochs[0] != epochs[1]
+        samplers[0].set_epoch(0)
+        assert list(samplers[0]) == epochs[0][0]
+
+    def test_length_bucket_sampler(self, default_session_data):
+        dataset = weighted_session_dataset(default_session_data)
+        lengths = np.arange(len(dataset)) % 10
+        sampler = LengthBucketSampler(
+            dataset, batch_size=5, lengths=lengths, bucket_size=5, seed=0
+        )
+        shuffled = LengthBucketSampler(
+            dataset, batch_size=5, lengths=lengths, bucket_size=1, seed=0
+        )
+        assert sampler.padding_ratio() < shuffled.padding_ratio()
+        assert sorted(sampler) == sorted(default_session_data)
+
+        batched = BatchedLengthSampler(dataset, 8, "query_length", seed=0)
+        batches = list(batched)
+        assert len(batches) == len(batched) == 6
+        batched.set_epoch(1)
+        assert list(batched) != batches
+        query_lengths = dataset.load_side_column("query_length", batches[0])
+        assert query_lengths.tolist() == [1.0] * 8
+
+    def test_passage_lengths(self, default_documents, default_session_data):
+        dataset = SessionDataset(
+            id_name="session_id",
+            store_fn=lambda id, row: Session(
+                session_id=id,
+                positive_items=row["positive_items"],
+                negative_items=row["negative_items"],
+                positive_relevances=row["positive_relevances"],
+                query=row["query"],
+            ),
+            data=default_session_data,
+            item_dataset=Dataset(data=default_documents),
+            compact=True,
+        )
+        lengths = get_passage_lengths(dataset, "text", batch_size=7)
+        for key, length in zip(dataset.get_index().iterkeys(), lengths):
+            row = default_session_data[key]
+            items = row["positive_items"] + row["negative_items"]
+            words = [len(default_documents[i]["text"].split()) for i in items]
+            assert length == np.mean(words)
+
+        sampler = BatchedLengthSampler(dataset, 5, lengths, bucket_size=10, seed=0)
+        random = BatchedLengthSampler(dataset, 5, lengths, bucket_size=1, seed=0)
+        assert sampler.sampler.padding_ratio() < random.sampler.padding_ratio()
@@ -1,5 +1,7 @@
-from mini_rec_sys.data import Session
+from mini_rec_sys.data import Session, CompactSession
 import pytest
+import pickle
+import numpy as np
 from pydantic.dataclasses import ValidationError
 
 from pdb import set_trace
@@ -49,3 +51,36 @@ class TestSession:
                 positive_relevances=[1],
                 negative_items=["a", "b"],
             )
+
+
+class TestCompactSession:
+    def test_round_trip(self):
+        session = Session(
+            session_id="123",
+            positive_items=["a", "b"],
+            positive_weights=[1, 2],
+            positive_relevances=[1, 2],
+            negative_items=["c"],
+            query="query",
+            session_weight=0.5,
+        )
+        compact = pickle.loads(pickle.dumps(CompactSession.from_session(session)))
+        assert compact.items.tolist() == session.items
+        assert compact.relevances.tolist() == session.relevances
+        assert compact.positive_items.dtype.kind == "U"
+        assert compact.to_session() == session
+        assert not hasattr(compact, "__dict__")
+
+        # Loaded arrays are writable, like those of a new CompactSession
+        compact.positive_items.sort()
+        np.random.default_rng(0).shuffle(compact.positive_weights)
+        compact.positive_relevances[0] = 3
+
+    def test_no_negative_items(self):
+        session = Session(
+            session_id=1, positive_items=[1, 2], positive_relevances=[1, 1]
+        )
+        compact = CompactSession.from_session(session)
+        assert compact.negative_items is None
+        assert compact.items.dtype == np.int64
+        assert compact.relevances.tolist() == [1, 1]
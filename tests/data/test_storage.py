@@ -0,0 +1,89 @@
+from mini_rec_sys.data.storage import ColumnarStorage, open_storage
+from mini_rec_sys.data.datasets import Dataset
+import pytest
+
+from pdb import set_trace
+
+
+class TestColumnarStorage:
+    def write(self, rows: dict, directory: str = None):
+        storage = ColumnarStorage(directory)
+        with storage.transact():
+            for k, v in rows.items():
+                storage[k] = v
+        storage.finalize()
+        return storage
+
+    def test_dict_rows(self, default_documents):
+        rows = {
+            k: {**v, "length": len(v["text"]), "score": 0.5, "tags": [k]}
+            for k, v in default_documents.items()
+        }
+        rows[1]["title"] = None
+        del rows[2]["score"]
+        storage = self.write(rows)
+        assert len(storage) == len(rows)
+        for k, v in rows.items():
+            assert storage.get(k) == v
+        assert storage.get(100) is None
+        assert storage.get("1") is None
+        assert list(storage.iterkeys()) == sorted(rows)
+
+    def test_object_rows_and_reopen(self, tmp_path):
+        rows = {"b": "some text", "a": "more text", "c": None}
+        storage = self.write(rows, tmp_path)
+        reopened = open_storage("columnar", tmp_path)
+        for k, v in rows.items():
+            assert reopened.get(k) == v
+        assert list(reopened.iterkeys()) == ["a", "b", "c"]
+
+        # Columnar storage is detected when opened as the default storage
+        detected = open_storage("diskcache", tmp_path)
+        assert isinstance(detected, ColumnarStorage) and len(detected) == len(rows)
+
+    def test_immutable_after_finalize(self, default_documents):
+        storage = self.write(default_documents)
+        with pytest.raises(ValueError):
+            storage[6] = {"title": "bird"}
+
+    def test_schema_changes_across_batches(self):
+        batches = [
+            {1: {"count": 1, "big": 1, "text": "a"}, 2: {"count": None}},
+            {3: {"count": 2.5, "new": [1]}, 4: {"big": 2**70, "text": 5}},
+            {5: {"count": 3, "new": None, "later": "x"}, 6: {}},
+        ]
+        storage = ColumnarStorage()
+        for batch in batches:
+            with storage.transact():
+                for k, v in batch.items():
+                    storage[k] = v
+        storage.finalize()
+        kinds = dict(storage.columns)
+        assert kinds["count"] == "float64" and kinds["big"] == "object"
+        assert kinds["text"] == "object" and kinds["later"] == "str"
+        for batch in batches:
+            for k, v in batch.items():
+                assert storage.get(k) == v
+        assert storage.get(4)["big"] == 2**70 and type(storage.get(1)["count"]) == float
+
+
+class TestColumnarDataset:
+    def test_loading(self, default_documents):
+        dataset = Dataset(
+            data=default_documents, load_fn=lambda x: x["title"], storage="columnar"
+        )
+        assert len(dataset) == len(default_documents)
+        for i in default_documents:
+            assert dataset.load(i) == default_documents[i]["title"]
+        assert set(dataset.iterkeys()) == set(default_documents)
+
+    def test_reload_from_db_location(self, default_documents, tmp_path):
+        Dataset(db_location=str(tmp_path), data=default_documents, storage="columnar")
+        dataset = Dataset(db_location=str(tmp_path), storage="columnar")
+        for i in default_documents:
+            assert dataset.load(i) == default_documents[i]
+
+        # The storage type is detected if not given
+        dataset = Dataset(db_location=str(tmp_path))
+        assert dataset.storage == "columnar" and len(dataset) == len(default_documents)
+        assert dataset.load(1) == default_documents[1]
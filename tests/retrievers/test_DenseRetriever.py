@@ -0,0 +1,106 @@
+from mini_rec_sys.data import ItemDataset
+from mini_rec_sys.retrievers import DenseRetriever
+from mini_rec_sys.scorers import DenseScorer
+import numpy as np
+import pytest
+import random
+import torch
+from torch import nn
+from pdb import set_trace
+
+
+class LetterEncoder(nn.Module):
+    """Embeds texts by their normalized letter counts, projected by weight."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.weight = nn.Parameter(torch.eye(26))
+
+    def forward(self, texts):
+        counts = torch.zeros(len(texts), 26)
+        for i, text in enumerate(texts):
+            for c in text:
+                if "a" <= c <= "z":
+                    counts[i, ord(c) - ord("a")] += 1
+        embed = counts @ self.weight
+        return embed / embed.norm(dim=1, keepdim=True).clamp(min=1e-6)
+
+
+def random_items(n: int):
+    rng = random.Random(0)
+    words = ["".join(rng.choices("abcdefghij", k=5)) for _ in range(50)]
+    return {i: {"title": " ".join(rng.sample(words, k=3))} for i in range(n)}
+
+
+def make_scorer():
+    encoder = LetterEncoder()
+    return DenseScorer(
+        query_key="query",
+        test_documents_key="docs",
+        passage_text_key="title",
+        q_encoder=encoder,
+        p_encoder=encoder,
+        batch_size=64,
+    )
+
+
+class TestDenseRetriever:
+    def test_flat_matches_scorer(self, default_documents: dict):
+        scorer = make_scorer()
+        retriever = DenseRetriever(scorer, build_batch_size=2)
+        retriever.build(ItemDataset(id_name="item_id", data=default_documents))
+
+        for query in ["mouse", "cheese", "woof"]:
+            ids, scores = retriever.retrieve(query, k=3, return_scores=True)
+            docs = list(default_documents.values())
+            expected = scorer.score({"query": query, "docs": docs})
+            order = np.argsort(expected, kind="stable")[::-1][:3]
+            assert np.allclose(scores, np.array(expected)[order], atol=1e-5)
+            assert scores == sorted(scores, reverse=True)
+            assert ids[0] == list(default_documents)[order[0]]
+        assert retriever.retrieve("mouse", k=1) == [1]
+        assert len(retriever.retrieve("mouse", k=10)) == len(default_documents)
+        assert retriever.retrieve(["mouse", "dog"], k=1) == [[1], [4]]
+
+    def test_index_types_and_save_load(self, tmp_path):
+        items = random_items(500)
+        queries = [items[i]["title"] for i in range(0, 500, 50)]
+        flat = DenseRetriever(make_scorer(), build_batch_size=128)
+        flat.build(items)
+        expected = flat.retrieve(queries, k=5)
+
+        for index_type, params in [
+            ("ivf", {"nlist": 8, "nprobe": 8, "train_size": 200}),
+            ("hnsw", {"hnsw_m": 16, "ef_search": 200}),
+        ]:
+            retriever = DenseRetriever(
+                make_scorer(), index_type, build_batch_size=128, **params
+            )
+            retriever.build(items)
+            ids = retriever.retrieve(queries, k=5)
+            recall = np.mean([len(set(a) & set(b)) / 5 for a, b in zip(ids, expected)])
+            assert recall >= 0.9, f"Recall of {index_type} is {recall}."
+
+            directory = str(tmp_path / index_type)
+            retriever.save(directory)
+            for mmap in [False, True]:
+                loaded = DenseRetriever.load(directory, make_scorer(), mmap=mmap)
+                assert loaded.retrieve(queries, k=5) == ids
+                assert loaded.index.ntotal == len(items)
+
+    def test_item_id_types(self, default_documents: dict, tmp_path):
+        for ids in [list(default_documents), [f"item_{k}" for k in default_documents]]:
+            items = dict(zip(ids, default_documents.values()))
+            retriever = DenseRetriever(make_scorer())
+            retriever.build(items)
+            retrieved = retriever.retrieve("mouse", k=5)
+            assert sorted(retrieved) == sorted(ids) and retrieved[0] == ids[0]
+            retriever.save(str(tmp_path))
+            loaded = DenseRetriever.load(str(tmp_path), make_scorer())
+            assert loaded.retrieve("mouse", k=5) == retrieved
+            assert set(map(type, loaded.retrieve("mouse", k=5))) == {type(ids[0])}
+
+        with pytest.raises(ValueError):
+            DenseRetriever(make_scorer()).build(
+                {1: {"title": "a"}, "1": {"title": "b"}}
+            )
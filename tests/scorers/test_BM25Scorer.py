@@ -1,4 +1,9 @@
 from mini_rec_sys.scorers import BM25Scorer
+from mini_rec_sys.scorers.BM25Scorer import MIN_SCORE, BM25Stats
+from mini_rec_sys.data import ItemDataset
+from mini_rec_sys.analyzers import Analyzer
+import numpy as np
+import pytest
 from pdb import set_trace
 
 
@@ -11,3 +16,258 @@ class TestBM25Scorer:
         )
         scores = scorer.score_single(input_data)
         assert scores[0] > scores[1] > scores[2], "Score order not correct."
+
+    def test_score_known_documents_from_index(self, default_documents):
+        scorer = BM25Scorer(
+            "query", "docs", default_documents, fields=["title", "text"]
+        )
+        unknown = [dict(doc) for doc in default_documents.values()]
+        known = [{"item_id": k, **doc} for k, doc in default_documents.items()]
+        for query in ["mouse", "cheese cat", "roof woof", "unseen"]:
+            expected = scorer.score({"query": query, "docs": unknown})
+            assert scorer.score({"query": query, "docs": known}) == expected
+            assert (
+                scorer.score({"query": query, "docs": list(default_documents)})
+                == expected
+            )
+
+        # Known documents are scored from the index and not re-tokenized
+        stale = [{"item_id": 1, "title": "", "text": ""}, 100, None]
+        scores = scorer.score({"query": "mouse", "docs": stale})
+        assert scores[0] > 0 and scores[1:] == [MIN_SCORE, MIN_SCORE]
+
+    def test_score_batch_matches_score_single(self, default_documents):
+        scorer = BM25Scorer(
+            "query",
+            "docs",
+            default_documents,
+            fields=["title", "text"],
+            field_weights={"title": 2.0, "text": 1.0},
+        )
+        docs = [{"item_id": k, **doc} for k, doc in default_documents.items()]
+        docs += [{"title": "mouse", "text": "a new mouse mouse doc"}, None, 100, 3]
+        rows = [
+            {"query": query, "docs": docs}
+            for query in ["mouse", "cheese cat", "roof woof dog", "unseen", ""]
+        ]
+        rows.append({"query": "mouse", "docs": []})
+        # Each unique new document is tokenized once per batch
+        tf_to_doclen, num_calls = scorer.tf_to_doclen, [0]
+
+        def counting_tf_to_doclen(*args):
+            num_calls[0] += 1
+            return tf_to_doclen(*args)
+
+        scorer.tf_to_doclen = counting_tf_to_doclen
+        batch_scores = scorer.score(rows)
+        assert num_calls[0] == len(scorer.fields)
+        del scorer.tf_to_doclen
+        for row, scores in zip(rows, batch_scores):
+            assert np.allclose(scores, scorer.score_single(row))
+        assert scorer.score([]) == []
+
+    def test_mixed_and_tuple_ids(self, default_documents, tmp_path):
+        docs = list(default_documents.values())
+        expected_scorer = BM25Scorer(
+            "query", "docs", default_documents, fields=["title", "text"]
+        )
+        for i, ids in enumerate([[1, "2", 3, "4", 5], [("a", i) for i in range(5)]]):
+            documents = dict(zip(ids, docs))
+            scorer = BM25Scorer("query", "docs", documents, fields=["title", "text"])
+            for query in ["mouse", "cheese cat"]:
+                expected = expected_scorer.score({"query": query, "docs": docs})
+                assert scorer.score({"query": query, "docs": ids}) == expected
+            assert scorer.retrieve("mouse", k=1) == [ids[0]]
+
+            scorer.remove_documents([ids[0]])
+            scorer.add_documents([(ids[0], docs[0])])
+            scorer.save(str(tmp_path / str(i)))
+            loaded = BM25Scorer.load(str(tmp_path / str(i)))
+            assert loaded.score({"query": "mouse", "docs": ids}) == scorer.score(
+                {"query": "mouse", "docs": ids}
+            )
+            assert loaded.retrieve("mouse", k=2) == scorer.retrieve("mouse", k=2)
+            assert set(map(type, loaded.get_doc_ids(np.arange(5)))) == set(
+                map(type, ids)
+            )
+
+    def test_retrieve_matches_exhaustive_scoring(self):
+        rng = np.random.default_rng(0)
+        vocab = [f"w{i}" for i in range(50)]
+        documents = {
+            i: {
+                "title": " ".join(rng.choice(vocab, rng.integers(1, 5))),
+                "text": " ".join(rng.choice(vocab, rng.integers(5, 40))),
+            }
+            for i in range(500)
+        }
+        scorer = BM25Scorer("query", "docs", documents, fields=["title", "text"])
+        queries = ["w0", "w1 w2 w3", "w4 w4 w10 w49 unseen", "w5 w6 w7 w8 w9 w11"]
+        for query in queries + ["unseen", ""]:
+            scores = scorer.score({"query": query, "docs": list(documents)})
+            expected = sorted(
+                (s for s in scores if s > MIN_SCORE and s > 0), reverse=True
+            )[:10]
+            for k in [1, 3, 10]:
+                ids, retrieved = scorer.retrieve(query, k=k, return_scores=True)
+                assert np.allclose(retrieved, expected[:k])
+                assert all(np.isclose(scores[i], s) for i, s in zip(ids, retrieved))
+
+    def test_streaming_and_parallel_training_match(self, default_documents):
+        fields = ["title", "text"]
+        expected = BM25Scorer("query", "docs", default_documents, fields=fields)
+        item_dataset = ItemDataset(id_name="item_id", data=default_documents)
+        scorers = [
+            BM25Scorer(
+                "query",
+                "docs",
+                iter(default_documents.items()),
+                fields=fields,
+                train_batch_size=2,
+            ),
+            BM25Scorer(
+                "query",
+                "docs",
+                default_documents,
+                fields=fields,
+                num_train_processes=2,
+                train_batch_size=1,
+            ),
+            BM25Scorer(
+                "query",
+                "docs",
+                item_dataset,
+                fields=fields,
+                num_train_processes=2,
+                train_batch_size=2,
+            ),
+        ]
+        for scorer in scorers:
+            assert scorer.N == expected.N and scorer.df == expected.df
+            assert scorer.postings == expected.postings
+            assert scorer.doc_lens == expected.doc_lens
+            for field in fields:
+                assert np.isclose(
+                    scorer.field_doclens[field], expected.field_doclens[field]
+                )
+
+        # Stats of shards computed separately merge exactly
+        items = list(default_documents.items())
+        stats = BM25Stats(fields)
+        for shard in [items[:2], items[2:]]:
+            stats.merge(expected.compute_stats(shard))
+        scorer = BM25Scorer("query", "docs", {}, fields=fields)
+        scorer.set_stats(stats)
+        docs = list(default_documents)
+        for query in ["mouse", "cheese cat"]:
+            assert scorer.score({"query": query, "docs": docs}) == expected.score(
+                {"query": query, "docs": docs}
+            )
+
+    def test_train_without_index(self, default_documents):
+        fields = ["title", "text"]
+        expected = BM25Scorer("query", "docs", default_documents, fields=fields)
+        scorer = BM25Scorer(
+            "query", "docs", default_documents, fields=fields, index_documents=False
+        )
+        assert scorer.postings == {field: {} for field in fields}
+        docs = list(default_documents.values())
+        for query in ["mouse", "cheese cat"]:
+            assert np.allclose(
+                scorer.score({"query": query, "docs": docs}),
+                expected.score({"query": query, "docs": docs}),
+            )
+
+    def test_save_and_load(self, default_documents, tmp_path):
+        scorer = BM25Scorer(
+            "query",
+            "docs",
+            default_documents,
+            fields=["title", "text"],
+            field_weights={"title": 2.0, "text": 1.0},
+        )
+        scorer.save(tmp_path)
+        loaded = BM25Scorer.load(tmp_path)
+        assert isinstance(loaded.term_matrices["text"].keys, np.memmap)
+        docs = list(default_documents) + list(default_documents.values()) + [None]
+        for query in ["mouse", "cheese cat", "unseen"]:
+            row = {"query": query, "docs": docs}
+            assert np.allclose(loaded.score(row), scorer.score(row))
+            assert loaded.retrieve(query, k=3) == scorer.retrieve(query, k=3)
+
+        # Without the index, only the corpus statistics are saved
+        scorer = BM25Scorer(
+            "query", "docs", default_documents, fields="text", index_documents=False
+        )
+        scorer.save(tmp_path / "stats")
+        loaded = BM25Scorer.load(tmp_path / "stats", mmap=False)
+        row = {"query": "mouse cheese", "docs": list(default_documents.values())}
+        assert np.allclose(loaded.score(row), scorer.score(row))
+
+    def test_load_requires_analyzer_with_preprocess_fn(
+        self, default_documents, tmp_path
+    ):
+        analyzer = Analyzer(preprocess_fn=lambda text: text.replace("mouse", "rat"))
+        scorer = BM25Scorer(
+            "query", "docs", default_documents, fields=["text"], analyzer=analyzer
+        )
+        scorer.save(tmp_path)
+        with pytest.raises(ValueError):
+            BM25Scorer.load(tmp_path)
+        loaded = BM25Scorer.load(tmp_path, analyzer=analyzer)
+        row = {"query": "mouse", "docs": list(default_documents)}
+        assert loaded.score(row) == scorer.score(row)
+        assert max(loaded.score(row)) > 0
+
+    def test_add_and_remove_documents(self, tmp_path):
+        rng = np.random.default_rng(0)
+
+        def make_documents(ids, vocab_size):
+            vocab = [f"w{i}" for i in range(vocab_size)]
+            return {
+                i: {
+                    "title": " ".join(rng.choice(vocab, rng.integers(0, 4))),
+                    "text": " ".join(rng.choice(vocab, rng.integers(1, 30))),
+                }
+                for i in ids
+            }
+
+        fields = ["title", "text"]
+        documents = make_documents(range(200), 40)
+        # Added documents include new terms, and replace documents 0 to 9
+        added = make_documents(list(range(10)) + list(range(200, 250)), 60)
+        removed = list(range(10, 30)) + [210, 1000]
+        expected_documents = {**documents, **added}
+        for i in removed:
+            expected_documents.pop(i, None)
+        expected = BM25Scorer("query", "docs", expected_documents, fields=fields)
+
+        scorer = BM25Scorer("query", "docs", documents, fields=fields)
+        scorer.save(tmp_path)
+        loaded = BM25Scorer.load(tmp_path)
+        docs = list(range(260)) + [{"title": "w1 w55", "text": "w2 w59 unseen"}]
+        queries = ["w0", "w1 w2 w45", "w59 w3", "unseen"]
+        for s in [scorer, loaded]:
+            s.add_documents(added)
+            s.remove_documents(removed)
+            for step in ["changes", "compacted"]:
+                assert s.N == expected.N
+                for field in fields:
+                    assert np.isclose(
+                        s.field_doclens[field], expected.field_doclens[field]
+                    )
+                for query in queries:
+                    row = {"query": query, "docs": docs}
+                    assert np.allclose(s.score(row), expected.score(row))
+                    ids, scores = s.retrieve(query, k=5, return_scores=True)
+                    assert np.allclose(
+                        scores, expected.retrieve(query, k=5, return_scores=True)[1]
+                    )
+                s.compact()
+            assert len(s.doc_index) == expected.N
+            assert len(s.vocab) == len(expected.vocab)
+
+        # The in-memory index is updated too
+        assert scorer.df == expected.df and scorer.postings == expected.postings
+        row = {"query": "w1 w2 w45", "docs": docs}
+        assert np.allclose(scorer.score_single(row), expected.score_single(row))
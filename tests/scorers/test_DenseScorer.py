@@ -1,5 +1,8 @@
 from mini_rec_sys.scorers import DenseScorer
-from mini_rec_sys.encoders import BaseBertEncoder
+from mini_rec_sys.encoders import BaseBertEncoder, EmbeddingCache
+import numpy as np
+import torch
+from torch import nn
 from pdb import set_trace
 
 
@@ -19,3 +22,109 @@ class TestDenseScorer:
         )
         scores = scorer.score(input_data)
         assert scores[0] > scores[1] > scores[2], "Score order not correct."
+
+    def test_encode_restores_order(self):
+        texts = ["a much longer text", "short", "a medium text", "tiny", "x"]
+        batches = []
+
+        def encode_fn(batch):
+            batches.append(batch)
+            return np.array([[len(text)] for text in batch])
+
+        expected = np.array([[len(text)] for text in texts])
+        for sort_by_length in [True, False]:
+            scorer = DenseScorer(
+                query_key="query",
+                test_documents_key="docs",
+                passage_text_key="title",
+                q_encoder=None,
+                p_encoder=None,
+                batch_size=2,
+                sort_by_length=sort_by_length,
+            )
+            assert np.array_equal(scorer.encode(texts, encode_fn), expected)
+        assert batches[:3] == [["x", "tiny"], ["short", "a medium text"], [texts[0]]]
+
+
+class CountingEncoder(nn.Module):
+    """Embeds texts by their lengths, counting the texts encoded."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.weight = nn.Parameter(torch.tensor([1.0, -1.0]))
+        self.num_encoded = 0
+
+    def forward(self, texts):
+        self.num_encoded += len(texts)
+        lengths = torch.tensor([[float(len(text))] for text in texts])
+        return lengths * self.weight
+
+
+class TestEmbeddingCache:
+    def make_scorer(self, encoder, cache):
+        return DenseScorer(
+            query_key="query",
+            test_documents_key="docs",
+            passage_text_key="title",
+            q_encoder=CountingEncoder(),
+            p_encoder=encoder,
+            batch_size=2,
+            embedding_cache=cache,
+        )
+
+    def test_rerun_does_not_encode(self, default_documents: dict, tmp_path):
+        docs = list(default_documents.values())
+        test_data = [{"query": "mouse", "docs": docs}, {"query": "a", "docs": docs}]
+        encoder = CountingEncoder()
+        expected = self.make_scorer(encoder, None).score(test_data)
+
+        encoder.num_encoded = 0
+        cache = EmbeddingCache(str(tmp_path))
+        assert self.make_scorer(encoder, cache).score(test_data) == expected
+        assert encoder.num_encoded == len(docs)
+        assert (cache.hits, cache.misses) == (0, len(docs))
+
+        # A new cache on the same directory, as in a new evaluation run
+        encoder.num_encoded = 0
+        cache = EmbeddingCache(str(tmp_path))
+        scorer = self.make_scorer(encoder, cache)
+        assert scorer.score(test_data) == expected
+        assert encoder.num_encoded == 0
+        assert (cache.hits, cache.misses) == (len(docs), 0)
+
+        # Only new passages are encoded
+        new_docs = docs[:1] + [{"title": "a brand new passage"}]
+        scorer.score({"query": "mouse", "docs": new_docs})
+        assert encoder.num_encoded == 1
+
+    def test_weight_change_misses(self, tmp_path):
+        encoder = CountingEncoder()
+        cache = EmbeddingCache(str(tmp_path))
+        scorer = self.make_scorer(encoder, cache)
+        test_data = {"query": "mouse", "docs": [{"title": "abc"}, {"title": "de"}]}
+        assert scorer.score(test_data) == [30.0, 20.0]
+
+        with torch.no_grad():
+            encoder.weight.mul_(2)
+        assert scorer.score(test_data) == [60.0, 40.0]
+        assert encoder.num_encoded == 4
+        assert len(cache.stores) == 2
+
+    def test_index_and_reopen(self, tmp_path):
+        texts = [f"text {i}" for i in range(50)]
+        encode_fn = lambda batch: np.array([[len(t), i] for i, t in enumerate(batch)])
+        cache = EmbeddingCache(str(tmp_path), max_unindexed=8)
+        expected = np.vstack(
+            [
+                cache.get_or_encode("f", batch, encode_fn)
+                for batch in [texts[:20], texts[20:]]
+            ]
+        )
+        store = cache.stores["f"]
+        assert len(store) == 50 and len(store.unindexed) <= 8
+
+        for max_unindexed in [8, 100]:
+            cache = EmbeddingCache(str(tmp_path), max_unindexed=max_unindexed)
+            result = cache.get_or_encode("f", texts[::-1], None)
+            assert np.array_equal(result, expected[::-1])
+            assert cache.misses == 0
@@ -0,0 +1,55 @@
+from mini_rec_sys.analyzers import Analyzer
+from mini_rec_sys.scorers import BM25Scorer
+from mini_rec_sys.utils import clean
+from collections import Counter
+from pdb import set_trace
+
+TEXTS = [
+    "I am a <b>Mouse</b>, i like cheese!",
+    "cat/dog and the\nhouse-roof",
+    "a < b and\rc > d <br/>",
+    "Café 42 résumé naïve",
+    "",
+    None,
+    "cat/dog and the\nhouse-roof",
+]
+
+
+class TestAnalyzer:
+    def test_words(self):
+        analyzer = Analyzer()
+        assert analyzer.words(TEXTS[0]) == ["mouse", "like", "cheese"]
+        assert analyzer.words(TEXTS[1]) == ["cat", "dog", "house", "roof"]
+        assert analyzer.words(TEXTS[2]) == ["d"]
+        assert analyzer.words(TEXTS[3]) == ["caf", "rsum", "nave"]
+        assert analyzer.words("") == analyzer.words(None) == []
+
+    def test_analyze_batch_matches_single_texts(self):
+        analyzer = Analyzer(cache_size=3)
+        expected = [Counter(analyzer.words(text)) for text in TEXTS]
+        assert analyzer.analyze_batch(TEXTS) == expected
+        assert analyzer.misses == 4 and analyzer.hits == 0
+        assert len(analyzer.cache) == 3 and TEXTS[0] not in analyzer.cache
+
+        # Cached texts are not analyzed again
+        assert analyzer.analyze_batch(TEXTS[1:4]) == expected[1:4]
+        assert analyzer.misses == 4 and analyzer.hits == 3
+
+    def test_preprocess_fn(self):
+        analyzer = Analyzer(preprocess_fn=clean)
+        text = "<p>kitchen(s)</p> s/he"
+        assert analyzer.words(text) == ["kitchens", "she", "or", "he"]
+        assert analyzer.analyze_batch([text]) == [Counter(analyzer.words(text))]
+
+    def test_cached_scoring(self, default_documents):
+        analyzer = Analyzer(cache_size=100)
+        scorer = BM25Scorer(
+            "query", "docs", default_documents, fields="text", analyzer=analyzer
+        )
+        row = {"query": "mouse cheese", "docs": list(default_documents.values())}
+        scores = scorer.score(row)
+        analyzer.clear_cache()
+        assert scorer.score(row) == scores
+        misses = analyzer.misses
+        assert scorer.score(row) == scores
+        assert analyzer.misses == misses
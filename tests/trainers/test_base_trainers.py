@@ -0,0 +1,122 @@
+from mini_rec_sys.data import SessionDataset, Session, BatchedWeightedSampler
+from mini_rec_sys.trainers import BaseModel, train
+import torch
+import json
+import os
+
+
+class LinearModel(BaseModel):
+    def __init__(self, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.linear = torch.nn.Linear(1, 1)
+
+    def forward(self, batch: list[dict]):
+        x = torch.tensor([[float(len(row["query"]))] for row in batch])
+        return (self.linear(x) - 1.0).pow(2).mean()
+
+
+class RecordingModel(LinearModel):
+    """
+    Records the sessions and test metrics of each rank to output_dir. Each
+    call to fit / test forks new processes, so the records are written at
+    the end of each epoch.
+    """
+
+    def __init__(self, output_dir: str, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.output_dir = output_dir
+        self.train_ids = []
+        self.test_ids = []
+        self.gathered_metrics = None
+
+    def training_step(self, batch: list[dict], batch_idx: int):
+        self.train_ids.extend(r["session_id"] for r in batch)
+        return super().training_step(batch, batch_idx)
+
+    def on_train_epoch_end(self):
+        self.write(f"train_{self.current_epoch}", self.train_ids)
+        self.train_ids = []
+
+    def test_step(self, batch: list[dict], batch_idx: int):
+        self.test_ids.append([r["session_id"] for r in batch])
+        return super().test_step(batch, batch_idx)
+
+    def gather_test_metrics(self, metrics: list[float]):
+        self.gathered_metrics = super().gather_test_metrics(metrics)
+        return self.gathered_metrics
+
+    def on_test_epoch_end(self):
+        local_metrics = list(self.test_metrics)
+        super().on_test_epoch_end()
+        self.write(
+            "test",
+            dict(
+                test_ids=self.test_ids,
+                local_metrics=local_metrics,
+                gathered_metrics=self.gathered_metrics,
+            ),
+        )
+
+    def write(self, name: str, value):
+        path = os.path.join(self.output_dir, f"{name}_rank_{self.global_rank}.json")
+        with open(path, "w") as f:
+            json.dump(value, f)
+
+
+def test_distributed_training(default_session_data, tmp_path):
+    dataset = SessionDataset(
+        id_name="session_id",
+        data=default_session_data,
+        store_fn=lambda id, row: Session(
+            session_id=id,
+            positive_items=row["positive_items"],
+            positive_relevances=row["positive_relevances"],
+            negative_items=row["negative_items"],
+            query=row["query"],
+        ),
+    )
+    # 3 test batches of 5 sessions, so the second rank is padded with a batch
+    test_dataset = dataset.split_dataset(lambda k: int(k.split("_")[1]) <= 15)
+    model = RecordingModel(
+        output_dir=str(tmp_path),
+        train_dataset=dataset,
+        sampler=BatchedWeightedSampler(dataset, batch_size=5, seed=0),
+        test_dataset=test_dataset,
+        test_batch_size=5,
+        learning_rate=1e-2,
+    )
+    train(
+        model,
+        max_epochs=2,
+        limit_train_batches=3,
+        limit_test_batches=3,
+        num_dataloader_workers=0,
+        num_processes=2,
+        start_method="fork",
+        default_root_dir=str(tmp_path),
+        enable_progress_bar=False,
+    )
+
+    def read(name: str):
+        res = []
+        for rank in range(2):
+            with open(os.path.join(tmp_path, f"{name}_rank_{rank}.json")) as f:
+                res.append(json.load(f))
+        return res
+
+    # Ranks train on disjoint batches of the same epoch
+    for epoch in range(2):
+        ids = [set(r) for r in read(f"train_{epoch}")]
+        assert len(ids[0]) == len(ids[1]) == 15
+        assert not ids[0] & ids[1]
+
+    ranks = read("test")
+
+    # Test metrics are gathered across ranks, without the padded batch
+    assert len(ranks[0]["test_ids"]) == len(ranks[1]["test_ids"]) == 2
+    assert ranks[1]["test_ids"][1] == ranks[1]["test_ids"][0]
+    test_ids = ranks[0]["test_ids"] + ranks[1]["test_ids"][:1]
+    assert sorted(sum(test_ids, [])) == sorted(test_dataset.iterkeys())
+    expected = ranks[0]["local_metrics"] + ranks[1]["local_metrics"][:1]
+    for r in ranks:
+        assert sorted(r["gathered_metrics"]) == sorted(expected)